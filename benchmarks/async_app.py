@@ -0,0 +1,162 @@
+"""
+Throughput of the register endpoints served by the sync app (the
+threaded werkzeug server) and by the async app of src/asgi.py
+(hypercorn), under many concurrent cashiers.
+
+Each cashier scans --scans products with /add/<id>, reads /invoice
+and confirms with /confirm, over and over for --seconds. Every
+server gets a fresh SQLite file with the same catalog.
+
+Run it from the project parent directory:
+
+    python -m benchmarks.async_app --cashiers 4 16 --seconds 10
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from src import create_app
+
+PRODUCTS = 50
+
+SERVERS = {
+    "sync": [sys.executable, "-m", "flask", "--app", "src", "run", "--with-threads", "--port", "{port}"],
+    "async": [sys.executable, "-m", "hypercorn", "src.asgi:create_async_app()", "--bind", "127.0.0.1:{port}"],
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def product_name(number):
+    # Product names only accept letters.
+    return "Product " + "".join(chr(ord("a") + int(digit)) for digit in str(number))
+
+
+def seed(uri, cashiers):
+    """
+    Create the catalog and the cashiers, return their tokens.
+    """
+
+    app = create_app(uri)
+    client = app.test_client()
+
+    client.post("/register", json={"username": "admin", "password": "admin", "admin_key": app.config["ADMIN_KEY"]})
+    headers = {"x-access-tokens": client.post("/login", auth=("admin", "admin")).json["token"]}
+
+    for number in range(PRODUCTS):
+        client.post("/product/create", json={"name": product_name(number), "price": 10, "weight": 1.0, "unit": "kg"},
+                    headers=headers)
+    client.post("/product/restock", json={"items": [{"id": number + 1, "quantity": 10**9} for number in range(PRODUCTS)]},
+                headers=headers)
+
+    tokens = []
+    for number in range(cashiers):
+        user = ("Cashier{}".format(number), "cashier")
+        client.post("/register", json={"username": user[0], "password": user[1]})
+        tokens.append(client.post("/login", auth=user).json["token"])
+
+    with app.app_context():
+        from src.models import db
+        db.engine.dispose()
+
+    return tokens
+
+
+def wait_until_serving(port, timeout=30):
+
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+
+    raise RuntimeError("the server did not start on port {}".format(port))
+
+
+def get(url, token):
+
+    request = urllib.request.Request(url, headers={"x-access-tokens": token})
+
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def run(server, cashiers, scans, seconds):
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        uri = "sqlite:///{}".format(os.path.join(directory, "bench.db"))
+        tokens = seed(uri, cashiers)
+
+        port = free_port()
+        env = dict(os.environ, DATABASE_URL=uri)
+        command = [part.format(port=port) for part in SERVERS[server]]
+        process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        try:
+            wait_until_serving(port)
+
+            base = "http://127.0.0.1:{}".format(port)
+            requests = []
+            deadline = time.monotonic() + seconds
+
+            def cashier(number, token):
+                count = 0
+                while time.monotonic() < deadline:
+                    for scan in range(scans):
+                        get("{}/add/{}".format(base, (number + scan) % PRODUCTS + 1), token)
+                    get(base + "/invoice", token)
+                    get(base + "/confirm", token)
+                    count += scans + 2
+                requests.append(count)
+
+            workers = [threading.Thread(target=cashier, args=(number, token)) for number, token in enumerate(tokens)]
+
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+
+        finally:
+            process.terminate()
+            process.wait()
+
+    return sum(requests) / elapsed
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cashiers", type=int, nargs="+", default=[4, 16])
+    parser.add_argument("--scans", type=int, default=5)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--servers", nargs="+", default=list(SERVERS), choices=list(SERVERS))
+    args = parser.parse_args()
+
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    os.environ.setdefault("ADMIN_KEY", "benchmark")
+
+    print("{:<8} {:>9} {:>12}".format("server", "cashiers", "requests/s"))
+
+    for cashiers in args.cashiers:
+        for server in args.servers:
+            print("{:<8} {:>9} {:>12.1f}".format(server, cashiers, run(server, cashiers, args.scans, args.seconds)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Bytes on the wire and time per response of /products (a full page)
+and /report (one row per product) in the full and in the compact
+shape, sent as is, gzip compressed and brotli compressed (when the
+brotli package is installed).
+
+The catalog of --products products is created through the API on a
+fresh SQLite file and every product gets a sale today, so the report
+has --products rows too.
+
+Run it from the project parent directory:
+
+    python -m benchmarks.compression --products 1000 --rounds 50
+"""
+import argparse
+import datetime
+import os
+import tempfile
+import time
+from src import compression, create_app, db, rollups
+from src.models import Product
+from .load import TestClient, seed
+
+
+def encodings():
+
+    found = ["identity", "gzip"]
+
+    if compression.brotli is not None:
+        found.append("br")
+
+    return found
+
+
+def record_sales(app):
+
+    today = datetime.datetime.utcnow().date()
+
+    with app.app_context():
+        lines = [(name, 1, price) for name, price in db.session.query(Product.name, Product.price)]
+        rollups.record_sales(today, lines)
+        db.session.commit()
+
+
+def measure(client, send, rounds):
+    """
+    Return the body size in bytes and the mean ms per response.
+    """
+
+    response = send(client)
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        send(client)
+
+    return len(response.get_data()), (time.perf_counter() - start) / rounds * 1000
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    os.environ.setdefault("ADMIN_KEY", "benchmark")
+
+    if compression.brotli is None:
+        print("brotli is not installed, only gzip is measured.\n")
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        app = create_app("sqlite:///{}".format(os.path.join(directory, "compression.db")))
+        admin, _, _ = seed(TestClient(app), args.products, 0, os.environ["ADMIN_KEY"])
+        record_sales(app)
+
+        client = app.test_client()
+        token = client.post("/login", auth=admin).json["token"]
+        today = datetime.datetime.utcnow().date().isoformat()
+
+        print("{:<10} {:<8} {:<9} {:>10} {:>8}".format("endpoint", "shape", "encoding", "bytes", "ms"))
+
+        for compact in [False, True]:
+            for encoding in encodings():
+
+                headers = {"x-access-tokens": token, "Accept-Encoding": encoding}
+                requests = {
+                    "/products": lambda client: client.get("/products?limit=1000" + ("&compact=1" if compact else ""),
+                                                           headers=headers),
+                    "/report": lambda client: client.post("/report", json={"from": today, "to": today, "compact": compact},
+                                                          headers=headers),
+                }
+
+                for endpoint, send in requests.items():
+                    size, ms = measure(client, send, args.rounds)
+                    print("{:<10} {:<8} {:<9} {:>10} {:>8.3f}".format(endpoint, "compact" if compact else "full",
+                                                                       encoding, size, ms))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Serialization time of the JSON providers of src/serialization.py
+for /products, /invoice and /report payloads, the time of building
+the response of a jsonify call.
+
+Run it from the project parent directory:
+
+    python -m benchmarks.json_provider --rounds 200
+"""
+import argparse
+import random
+import time
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+from src import catalog, serialization
+
+
+def product(number):
+    return {"id": number, "name": "Product {}".format(number), "price": random.randint(100, 50000),
+            "weight": round(random.uniform(0.1, 5), 2), "unit": random.choice(["mg", "g", "kg"]),
+            "quantity": random.randint(0, 500)}
+
+
+def payloads(products):
+    """
+    A full /products page, a 40 lines /invoice and a /report of
+    the given number of products.
+    """
+
+    page = [product(number) for number in range(1, catalog.MAX_PAGE_SIZE + 1)]
+
+    invoice = [{key: value for key, value in product(number).items() if key != "id"} for number in range(40)]
+
+    report = {"date": {"from": "2023-05-01", "to": "2023-05-31"},
+              "products": {"Product {}".format(number): {"quantity": random.randint(1, 900),
+                                                         "total_price": random.randint(100, 10**7)}
+                           for number in range(products)},
+              "total_profits": random.randint(10**6, 10**9)}
+
+    return {"/products": {"list_of_products": page, "next_after_id": catalog.MAX_PAGE_SIZE},
+            "/invoice": {"cashier": "cashier", "list_of_products": invoice},
+            "/report": {"report": report}}
+
+
+def providers():
+
+    found = {"stdlib": DefaultJSONProvider}
+
+    if serialization.orjson is not None:
+        found["orjson"] = serialization.OrjsonProvider
+
+    return found
+
+
+def mean_ms(function, rounds):
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        function()
+
+    return (time.perf_counter() - start) / rounds * 1000
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--report-products", type=int, default=2000)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    found = providers()
+
+    if "orjson" not in found:
+        print("orjson is not installed, only the stdlib provider is measured.\n")
+
+    print("{:<10} {:>10} {:>10}".format("payload", "provider", "ms"))
+
+    with app.app_context():
+        for name, payload in payloads(args.report_products).items():
+            for provider, cls in found.items():
+                json = cls(app)
+                print("{:<10} {:>10} {:>10.3f}".format(name, provider, mean_ms(lambda: json.response(payload), args.rounds)))
+
+
+if __name__ == "__main__":
+    main()
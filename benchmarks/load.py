@@ -0,0 +1,285 @@
+"""
+Load test of the API simulating concurrent cashiers, reports the
+p50/p95/p99 latency and the requests/s of every endpoint.
+
+The catalog (--products) and the cashiers (--cashiers) are created
+through the API, then every cashier runs register sessions (/login,
+--scans x /add/<id>, /invoice, /confirm) while --reporters admins
+call /report, all of them for --seconds. It runs against the Flask
+test client on a fresh SQLite file, or against a live server with
+--url (the admin needs ADMIN_KEY, e.g. bash scripts/serve.sh).
+
+Run it from the project parent directory:
+
+    python -m benchmarks.load --products 500 --cashiers 8 --seconds 20
+    python -m benchmarks.load --url http://127.0.0.1:5000 --output load.jsonl
+
+--output appends the results as a JSON line, to follow the
+numbers of a setup over time.
+"""
+import argparse
+import base64
+import datetime
+import json
+import os
+import random
+import string
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from src import create_app
+from src.routes import MAX_RESTOCK_ITEMS
+
+PASSWORD = "benchmark"
+
+
+class TestClient:
+    """
+    Requests to an app in process, one werkzeug client per thread.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def request(self, method, path, body=None, data=None, headers=None, auth=None):
+
+        if not hasattr(self.local, "client"):
+            self.local.client = self.app.test_client()
+
+        response = self.local.client.open(path, method=method, json=body, data=data, headers=headers, auth=auth)
+
+        return response.status_code, response.get_json(silent=True)
+
+
+class HTTPClient:
+    """
+    Requests to a live server, body is sent as JSON and data as is.
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def request(self, method, path, body=None, data=None, headers=None, auth=None):
+
+        headers = dict(headers or {})
+
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+
+        if auth is not None:
+            headers["Authorization"] = "Basic " + base64.b64encode("{}:{}".format(*auth).encode()).decode()
+
+        request = urllib.request.Request(self.url + path, data=data, headers=headers, method=method)
+
+        try:
+            with urllib.request.urlopen(request) as response:
+                status, content = response.status, response.read()
+        except urllib.error.HTTPError as error:
+            status, content = error.code, error.read()
+
+        try:
+            return status, json.loads(content)
+        except ValueError:
+            return status, None
+
+
+class Recorder:
+    """
+    Latencies of the requests per endpoint, thread safe.
+    """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def call(self, client, endpoint, method, path, **kwargs):
+
+        start = time.perf_counter()
+        status, body = client.request(method, path, **kwargs)
+        elapsed = time.perf_counter() - start
+
+        with self.lock:
+            self.latencies[endpoint].append(elapsed)
+            if status >= 400:
+                self.errors[endpoint] += 1
+
+        return status, body
+
+
+def percentile(values, p):
+    """
+    Nearest rank percentile of sorted values.
+    """
+
+    rank = max(1, int(len(values) * p / 100 + 0.5))
+
+    return values[min(rank, len(values)) - 1]
+
+
+def summary(recorder, elapsed):
+
+    results = {}
+
+    for endpoint, latencies in sorted(recorder.latencies.items()):
+        latencies = sorted(latencies)
+        results[endpoint] = {"requests": len(latencies),
+                             "errors": recorder.errors[endpoint],
+                             "requests_per_second": len(latencies) / elapsed,
+                             "p50_ms": percentile(latencies, 50) * 1000,
+                             "p95_ms": percentile(latencies, 95) * 1000,
+                             "p99_ms": percentile(latencies, 99) * 1000}
+
+    return results
+
+
+def letters(number):
+    # Product names only accept letters.
+    return "".join(string.ascii_lowercase[int(digit)] for digit in str(number))
+
+
+def seed(client, products, cashiers, admin_key):
+    """
+    Create the admin, the catalog and the cashiers through the API,
+    return the admin credentials, the product ids and the cashiers.
+    Names get a random tag, so a live server can be seeded again.
+    """
+
+    tag = "".join(random.choice(string.ascii_lowercase) for _ in range(6))
+
+    admin = ("admin" + tag, PASSWORD)
+    client.request("POST", "/register", body={"username": admin[0], "password": PASSWORD, "admin_key": admin_key})
+    status, body = client.request("POST", "/login", auth=admin)
+
+    if status != 200:
+        raise RuntimeError("could not log in as admin, check ADMIN_KEY: {}".format(body))
+
+    headers = {"x-access-tokens": body["token"]}
+
+    rows = "".join(json.dumps({"name": "{} {}".format(tag, letters(number)), "price": random.randint(100, 50000),
+                               "weight": 1.0, "unit": "kg"}) + "\n" for number in range(products))
+    status, body = client.request("POST", "/product/import", data=rows.encode(),
+                                  headers=dict(headers, **{"Content-Type": "application/x-ndjson"}))
+
+    if status != 200 or body["imported"] != products:
+        raise RuntimeError("could not import the products: {}".format(body))
+
+    names = {"{} {}".format(tag, letters(number)) for number in range(products)}
+    product_ids = []
+    after_id = 0
+
+    while after_id is not None:
+        status, body = client.request("GET", "/products?fields=id,name&limit=1000&after_id={}".format(after_id),
+                                      headers=headers)
+        product_ids += [product["id"] for product in body["list_of_products"] if product["name"] in names]
+        after_id = body["next_after_id"]
+
+    for start in range(0, len(product_ids), MAX_RESTOCK_ITEMS):
+        items = [{"id": product_id, "quantity": 10**6} for product_id in product_ids[start:start + MAX_RESTOCK_ITEMS]]
+        client.request("POST", "/product/restock", body={"items": items}, headers=headers)
+
+    users = []
+    for number in range(cashiers):
+        user = ("cashier{}{}".format(tag, number), PASSWORD)
+        client.request("POST", "/register", body={"username": user[0], "password": PASSWORD})
+        users.append(user)
+
+    return admin, product_ids, users
+
+
+def cashier_session(client, recorder, user, product_ids, scans):
+
+    status, body = recorder.call(client, "/login", "POST", "/login", auth=user)
+
+    if status != 200:
+        return
+
+    headers = {"x-access-tokens": body["token"]}
+
+    for product_id in random.sample(product_ids, min(scans, len(product_ids))):
+        recorder.call(client, "/add/<id>", "GET", "/add/{}".format(product_id), headers=headers)
+
+    recorder.call(client, "/invoice", "GET", "/invoice", headers=headers)
+    recorder.call(client, "/confirm", "GET", "/confirm", headers=headers)
+
+
+def run(client, admin, product_ids, users, reporters, scans, seconds, report_interval):
+
+    recorder = Recorder()
+    deadline = time.monotonic() + seconds
+    today = datetime.datetime.utcnow().date().isoformat()
+
+    def cashier(user):
+        while time.monotonic() < deadline:
+            cashier_session(client, recorder, user, product_ids, scans)
+
+    def reporter():
+        token = client.request("POST", "/login", auth=admin)[1]["token"]
+        while time.monotonic() < deadline:
+            recorder.call(client, "/report", "POST", "/report", body={"from": today, "to": today},
+                          headers={"x-access-tokens": token})
+            time.sleep(report_interval)
+
+    workers = [threading.Thread(target=cashier, args=(user,)) for user in users]
+    workers += [threading.Thread(target=reporter) for _ in range(reporters)]
+
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    return summary(recorder, elapsed)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="base URL of a live server, the Flask test client is used if missing")
+    parser.add_argument("--products", type=int, default=200)
+    parser.add_argument("--cashiers", type=int, default=8)
+    parser.add_argument("--reporters", type=int, default=1)
+    parser.add_argument("--scans", type=int, default=10, help="products scanned per session")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--report-interval", type=float, default=0.5, help="seconds between the /report calls of an admin")
+    parser.add_argument("--output", help="append the results as a JSON line to this file")
+    args = parser.parse_args()
+
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    os.environ.setdefault("ADMIN_KEY", "benchmark")
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        if args.url:
+            client = HTTPClient(args.url)
+        else:
+            client = TestClient(create_app("sqlite:///{}".format(os.path.join(directory, "load.db"))))
+
+        admin, product_ids, users = seed(client, args.products, args.cashiers, os.environ["ADMIN_KEY"])
+        results = run(client, admin, product_ids, users, args.reporters, args.scans, args.seconds, args.report_interval)
+
+    print("{:<10} {:>9} {:>7} {:>9} {:>9} {:>9} {:>9}".format("endpoint", "requests", "errors", "req/s",
+                                                                "p50 ms", "p95 ms", "p99 ms"))
+
+    for endpoint, stats in results.items():
+        print("{:<10} {:>9} {:>7} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+            endpoint, stats["requests"], stats["errors"], stats["requests_per_second"],
+            stats["p50_ms"], stats["p95_ms"], stats["p99_ms"]))
+
+    if args.output:
+        record = {"date": datetime.datetime.utcnow().isoformat(),
+                  "target": args.url or "test client",
+                  "settings": {key: value for key, value in vars(args).items() if key not in ["url", "output"]},
+                  "results": results}
+        with open(args.output, "a") as output:
+            output.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    main()
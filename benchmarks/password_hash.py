@@ -0,0 +1,70 @@
+"""
+Cost of the password hash methods (PASSWORD_HASH_METHOD) and of a
+/login compared with a /token/refresh, to tune the login latency
+against the hashing work an attacker has to do per guess.
+
+Run it from the project parent directory:
+
+    python -m benchmarks.password_hash --rounds 20
+"""
+import argparse
+import time
+from werkzeug.security import generate_password_hash, check_password_hash
+from src import create_app
+
+METHODS = ["sha256", "pbkdf2:sha256:1000", "pbkdf2:sha256:50000", "pbkdf2:sha256:260000"]
+
+PASSWORD = "benchmark-password"
+
+
+def mean_ms(function, rounds):
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        function()
+
+    return (time.perf_counter() - start) / rounds * 1000
+
+
+def bench_methods(methods, rounds):
+
+    print("{:<24} {:>12}".format("method", "check (ms)"))
+
+    for method in methods:
+        hashed = generate_password_hash(PASSWORD, method=method)
+        print("{:<24} {:>12.3f}".format(method, mean_ms(lambda: check_password_hash(hashed, PASSWORD), rounds)))
+
+
+def bench_endpoints(methods, rounds):
+
+    print("\n{:<24} {:>12} {:>14}".format("method", "/login (ms)", "/refresh (ms)"))
+
+    for method in methods:
+
+        app = create_app("sqlite://")
+        app.config["SECRET_KEY"] = app.config["SECRET_KEY"] or "benchmark"
+        app.config["PASSWORD_HASH_METHOD"] = method
+        client = app.test_client()
+
+        client.post("/register", json={"username": "cashier", "password": PASSWORD})
+        refresh_token = client.post("/login", auth=("cashier", PASSWORD)).json["refresh_token"]
+
+        login = mean_ms(lambda: client.post("/login", auth=("cashier", PASSWORD)), rounds)
+        refresh = mean_ms(lambda: client.post("/token/refresh", json={"refresh_token": refresh_token}), rounds)
+
+        print("{:<24} {:>12.3f} {:>14.3f}".format(method, login, refresh))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--methods", nargs="+", default=METHODS)
+    args = parser.parse_args()
+
+    bench_methods(args.methods, args.rounds)
+    bench_endpoints(args.methods, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Commit throughput of the SQLite profiles of src/database.py.
+
+Every transaction reserves one product and adds a cart line, like
+a scan at the register, from one or many threads (cashiers) on a
+fresh database file per profile.
+
+Run it from the project parent directory:
+
+    python -m benchmarks.sqlite_profile --transactions 2000 --threads 1 4
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+from sqlalchemy import create_engine, event, text
+from src.database import SQLITE_PROFILES, apply_pragmas, sqlite_engine_options
+
+SCHEMA = [
+    "CREATE TABLE product_quantity (id INTEGER PRIMARY KEY, quantity INTEGER, product_id INTEGER)",
+    "CREATE TABLE currentinvoice_product (id INTEGER PRIMARY KEY, currentinvoice_id INTEGER, product_id INTEGER, quantity INTEGER)",
+]
+
+
+def create_database(path, profile):
+
+    uri = "sqlite:///{}".format(path)
+    pragmas = SQLITE_PROFILES[profile]
+
+    engine = create_engine(uri, **sqlite_engine_options(profile, uri))
+    event.listen(engine, "connect", lambda dbapi_connection, record: apply_pragmas(dbapi_connection, pragmas))
+
+    with engine.begin() as connection:
+        for statement in SCHEMA:
+            connection.execute(text(statement))
+        connection.execute(text("INSERT INTO product_quantity (quantity, product_id) VALUES (:quantity, 1)"),
+                           {"quantity": 10**9})
+
+    return engine
+
+
+def scan(engine, cashier):
+
+    with engine.begin() as connection:
+        connection.execute(text("UPDATE product_quantity SET quantity = quantity - 1 WHERE product_id = 1 AND quantity >= 1"))
+        connection.execute(text("INSERT INTO currentinvoice_product (currentinvoice_id, product_id, quantity) VALUES (:cashier, 1, 1)"),
+                           {"cashier": cashier})
+
+
+def run(profile, transactions, threads):
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        engine = create_database(os.path.join(directory, "bench.db"), profile)
+        per_thread = transactions // threads
+
+        def cashier(number):
+            for _ in range(per_thread):
+                scan(engine, number)
+
+        workers = [threading.Thread(target=cashier, args=(number,)) for number in range(threads)]
+
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+
+        engine.dispose()
+
+    return per_thread * threads / elapsed
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--transactions", type=int, default=2000)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--profiles", nargs="+", default=list(SQLITE_PROFILES), choices=list(SQLITE_PROFILES))
+    args = parser.parse_args()
+
+    print("{:<12} {:>8} {:>14}".format("profile", "threads", "commits/s"))
+
+    for threads in args.threads:
+        for profile in args.profiles:
+            print("{:<12} {:>8} {:>14.1f}".format(profile, threads, run(profile, args.transactions, threads)))
+
+
+if __name__ == "__main__":
+    main()
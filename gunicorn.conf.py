@@ -0,0 +1,38 @@
+"""
+Settings of the production server (scripts/serve.sh), gunicorn
+with WEB_CONCURRENCY worker processes of WEB_THREADS threads.
+
+The database is created and migrated once by the master process
+before the workers are forked, the workers build the app without
+touching the schema. With WEB_PRELOAD the app is loaded once in
+the master and shared copy-on-write by the workers, each worker
+drops the pooled connections it inherits (see src.after_fork).
+"""
+import multiprocessing
+from os import environ
+from dotenv import load_dotenv
+
+load_dotenv()
+
+wsgi_app = "src:create_app(bootstrap=False)"
+
+bind = environ.get("WEB_BIND", "0.0.0.0:5000")
+workers = int(environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+threads = int(environ.get("WEB_THREADS", 4))
+preload_app = environ.get("WEB_PRELOAD", "true").lower() in ["1", "true", "yes"]
+timeout = int(environ.get("WEB_TIMEOUT", 30))
+
+
+def on_starting(server):
+    from src import create_app, db
+
+    app = create_app()
+
+    with app.app_context():
+        db.engine.dispose()
+
+
+def post_fork(server, worker):
+    from src import after_fork
+
+    after_fork(worker.app.wsgi())
@@ -1,6 +1,6 @@
 #!/bin/bash
 
 source src/venv/bin/activate
-flask --app src/ run --host=0.0.0.0 --port=5000
+gunicorn --config gunicorn.conf.py
 
 exit 0
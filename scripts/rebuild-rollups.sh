@@ -0,0 +1,6 @@
+#!/bin/bash
+
+source src/venv/bin/activate
+flask --app src/ rebuild-rollups
+
+exit 0
@@ -0,0 +1,6 @@
+#!/bin/bash
+
+source src/venv/bin/activate
+hypercorn "src.asgi:create_async_app()" --bind 0.0.0.0:5000
+
+exit 0
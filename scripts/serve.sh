@@ -0,0 +1,6 @@
+#!/bin/bash
+
+source src/venv/bin/activate
+gunicorn --config gunicorn.conf.py
+
+exit 0
@@ -1,9 +1,13 @@
 from flask import Flask
 from dotenv import load_dotenv
-from os import environ
+from os import environ, path
 from flask_cors import CORS
 from .models import db
+from . import auth, catalog, compression, database, metrics, migrations, profiling, reports, serialization, stock
 from .routes import main
+from .rollups import rebuild_rollups_command
+from .migrations import upgrade_db_command
+from .stock import compact_stock_command
 from sqlalchemy import create_engine
 from sqlalchemy_utils import database_exists, create_database
 
@@ -21,10 +25,37 @@ def validate_database(DB_URI):
     else:
         print("Database loaded from " + DB_URI)
         status = True
-        
+
+    engine.dispose()
+
     return status
 
-def create_app(db_uri=None):
+def bootstrap_database(app):
+    """
+    Create the database if needed and apply the pending migrations,
+    must run in a single process (e.g. before forking the workers).
+    """
+
+    validate_database(app.config["SQLALCHEMY_DATABASE_URI"])
+    with app.app_context():
+        migrations.upgrade()
+        catalog.init_version()
+
+def after_fork(app):
+    """
+    Reset the state a forked worker inherits from the process that
+    created the app: the pooled connections (left open for the
+    parent) and the product cache. Threads don't survive the fork,
+    the stock compactor of the worker is started here.
+    """
+
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+    catalog.init_product_cache(app)
+    app.extensions["stock_compactor"].start()
+
+def create_app(db_uri=None, bootstrap=True):
 
     load_dotenv()
 
@@ -33,19 +64,58 @@ def create_app(db_uri=None):
 
     app.config["SECRET_KEY"] = environ.get("SECRET_KEY")
     
-    if db_uri is None:
+    if db_uri is None and environ.get("DATABASE_URL"):
+        app.config["SQLALCHEMY_DATABASE_URI"] = environ.get("DATABASE_URL")
+    elif db_uri is None:
         app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:////" + environ.get("DB_PATH")
     else:
         app.config["SQLALCHEMY_DATABASE_URI"] = db_uri
 
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = True
     app.config["ADMIN_KEY"] = environ.get("ADMIN_KEY")
+    app.config["PRODUCT_CACHE_SIZE"] = int(environ.get("PRODUCT_CACHE_SIZE", 4096))
+    app.config["CATALOG_SYNC_INTERVAL"] = float(environ.get("CATALOG_SYNC_INTERVAL", 1.0))
+    app.config["REPORT_CACHE_SIZE"] = int(environ.get("REPORT_CACHE_SIZE", 256))
+    app.config["REPORT_CACHE_OPEN_TTL"] = float(environ.get("REPORT_CACHE_OPEN_TTL", 5))
+    app.config["REPORT_CACHE_FILE"] = environ.get("REPORT_CACHE_FILE")
+    app.config["REPORT_CACHE_CLOSE_DELAY"] = float(environ.get("REPORT_CACHE_CLOSE_DELAY", 300))
+    app.config["AUTH_CACHE_SIZE"] = int(environ.get("AUTH_CACHE_SIZE", 1024))
+    app.config["AUTH_CACHE_TTL"] = float(environ.get("AUTH_CACHE_TTL", 60))
+    app.config["ACCESS_TOKEN_MINUTES"] = float(environ.get("ACCESS_TOKEN_MINUTES", 15))
+    app.config["REFRESH_TOKEN_DAYS"] = float(environ.get("REFRESH_TOKEN_DAYS", 30))
+    app.config["PASSWORD_HASH_METHOD"] = environ.get("PASSWORD_HASH_METHOD", "sha256")
+    app.config["STOCK_RETRY_ATTEMPTS"] = int(environ.get("STOCK_RETRY_ATTEMPTS", 5))
+    app.config["STOCK_RETRY_BACKOFF"] = float(environ.get("STOCK_RETRY_BACKOFF", 0.01))
+    app.config["STOCK_COMPACT_INTERVAL"] = float(environ.get("STOCK_COMPACT_INTERVAL", 60))
+    app.config["JSON_PROVIDER"] = environ.get("JSON_PROVIDER", "auto")
+    app.config["COMPRESS_MIN_SIZE"] = int(environ.get("COMPRESS_MIN_SIZE", 1024))
+    app.config["COMPRESS_LEVEL"] = int(environ.get("COMPRESS_LEVEL", 6))
+    app.config["COMPRESS_BROTLI_QUALITY"] = int(environ.get("COMPRESS_BROTLI_QUALITY", 4))
+    app.config["PROFILE_SAMPLE_RATE"] = float(environ.get("PROFILE_SAMPLE_RATE", 0))
+    app.config["PROFILE_MODE"] = environ.get("PROFILE_MODE", "sample")
+    app.config["PROFILE_INTERVAL"] = float(environ.get("PROFILE_INTERVAL", 0.005))
+    app.config["PROFILE_DIR"] = environ.get("PROFILE_DIR", path.join(app.instance_path, "profiles"))
+    app.config["PROFILE_TOKEN_MAX_AGE"] = int(environ.get("PROFILE_TOKEN_MAX_AGE", 3600))
+    database.load_config(app, environ)
 
 
+    serialization.init_app(app)
     app.register_blueprint(main)
+    profiling.init_app(app, main)
+    app.cli.add_command(rebuild_rollups_command)
+    app.cli.add_command(upgrade_db_command)
+    app.cli.add_command(compact_stock_command)
 
     db.init_app(app)
-    if not validate_database(app.config["SQLALCHEMY_DATABASE_URI"]):
-        db.create_all(app=app)
+    database.init_app(app)
+    metrics.init_app(app)
+    compression.init_app(app)
+    catalog.init_app(app)
+    reports.init_app(app)
+    stock.init_app(app)
+    auth.init_app(app)
+
+    if bootstrap:
+        bootstrap_database(app)
 
     return app
@@ -0,0 +1,341 @@
+"""
+Asyncio serving mode, a Quart app with async views for the hot
+register endpoints (/add/<id>, /invoice, /confirm and /products)
+on an async SQLAlchemy engine (aiosqlite or asyncpg), so a worker
+keeps serving other scans while one waits for the database.
+
+The views run the same statements as src/routes.py, the rest of
+the API (users, catalog admin, reports) is served by create_app.
+Run it with:
+
+    hypercorn 'src.asgi:create_async_app()' --bind 0.0.0.0:5000
+"""
+import asyncio
+import time
+from datetime import datetime
+from functools import wraps
+import jwt
+from quart import Quart, Blueprint, request, jsonify, current_app
+from flask import Flask
+from sqlalchemy import event, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine
+from . import create_app, auth, cart, catalog, database, http_status, rollups, stock
+from .cache import TTLCache
+from .models import db, Users, Product, Product_Quantity, Invoice, CurrentInvoice
+from .utils import columns
+
+main = Blueprint("main", __name__)
+
+
+def engine():
+    return current_app.extensions["async_engine"]
+
+
+async def etag():
+
+    async with engine().connect() as connection:
+        versions = (await connection.execute(catalog.version_query())).one()
+
+    return catalog.etag(versions)
+
+
+async def authenticate(token):
+    """
+    Async auth.authenticate, the decoded tokens are cached for
+    AUTH_CACHE_TTL seconds at most.
+    """
+
+    cache = current_app.extensions["auth_cache"]
+    user = cache.get(token)
+
+    if user is not None:
+        return user
+
+    data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms="HS256")
+
+    async with engine().connect() as connection:
+        result = await connection.execute(select(Users.id, Users.public_id, Users.username, Users.admin)
+                                          .where(Users.public_id == data['public_id']))
+        row = result.first()
+
+    if row is None:
+        raise LookupError("user {} not found".format(data['public_id']))
+
+    user = auth.AuthUser(*row)
+    expires = min(time.time() + current_app.config["AUTH_CACHE_TTL"], data['exp'])
+    cache.set(token, user, expires)
+
+    return user
+
+
+async def with_retries(work):
+    """
+    Async stock.with_retries, work() runs and commits a transaction.
+    """
+
+    attempts = current_app.config["STOCK_RETRY_ATTEMPTS"]
+    backoff = current_app.config["STOCK_RETRY_BACKOFF"]
+
+    for attempt in range(attempts):
+
+        try:
+            return await work()
+        except OperationalError as error:
+            if not stock.is_busy(error):
+                raise
+
+        if attempt < attempts - 1:
+            await asyncio.sleep(stock.backoff_delay(backoff, attempt))
+
+    raise stock.StockBusyError("stock is busy after {} attempts".format(attempts))
+
+
+async def current_invoice_id(connection, user_id):
+    result = await connection.execute(select(CurrentInvoice.id).where(CurrentInvoice.user_id == user_id))
+    return result.scalar()
+
+
+def token_required(f):
+    @wraps(f)
+    async def decorated(*args, **kwargs):
+
+        token = request.headers.get('x-access-tokens')
+
+        if not token:
+            return jsonify({'message': 'a valid token is missing'}), http_status.UNAUTHORIZED
+
+        try:
+            current_user = await authenticate(token)
+        except Exception as e:
+            print("Exception: ", e)
+            return jsonify({'message': 'token is invalid'}), http_status.UNAUTHORIZED
+
+        return await f(current_user, *args, **kwargs)
+
+    return decorated
+
+
+@main.route('/products', methods=['GET'])
+@token_required
+async def get_products(current_user):
+    """
+    Same as the /products of the sync app, with the same ETags.
+    """
+
+    compact = request.args.get('compact', '').lower() in ['1', 'true']
+    tag = await etag()
+
+    if compact:
+        tag += '-compact'
+
+    # The ETags given by a compressing proxy (or the sync app) are weak.
+    if request.if_none_match.contains_weak(tag):
+        response = await current_app.make_response(('', http_status.NOTMODIFIED))
+        response.set_etag(tag)
+        return response
+
+    arguments, message = catalog.page_arguments(request.args)
+
+    if arguments is None:
+        return jsonify({'message': message}), http_status.FORBIDDEN
+
+    fields, after_id, limit = arguments
+
+    async with engine().connect() as connection:
+        rows = (await connection.execute(catalog.products_page_query(fields, after_id, limit))).all()
+
+    if 'quantity' in fields:
+        quantity = fields.index('quantity') + 1
+        for row in rows:
+            if row[quantity] is None:
+                return jsonify({'message' : 'no quantity found for product {}'.format(row[0])}), http_status.NOTFOUND
+
+    if compact:
+        output = columns(fields, [row[1:] for row in rows])
+    else:
+        output = [dict(zip(fields, row[1:])) for row in rows]
+
+    next_after_id = None
+    if len(rows) == limit:
+        next_after_id = rows[-1][0]
+
+    response = jsonify({'list_of_products' : output, 'next_after_id': next_after_id})
+    response.set_etag(tag)
+
+    return response
+
+
+@main.route('/add/<product_id>', methods=['POST', 'GET'])
+@token_required
+async def add_to_invoice(current_user, product_id):
+    """
+    Same as the /add/<product_id> of the sync app, the scan is
+    retried while the database is busy with other cashiers.
+    """
+
+    try:
+        product_id = int(product_id)
+    except ValueError:
+        return jsonify({'message': 'product does not exist'}), http_status.NOTFOUND
+
+    async def scan():
+        """
+        Return None if the product does not exist, else whether
+        the stock was reserved.
+        """
+
+        async with engine().connect() as connection:
+            async with connection.begin() as transaction:
+
+                for stmt in stock.reserve_statements(product_id, user_id=current_user.id,
+                                                     dialect=connection.dialect.name):
+                    result = await connection.execute(stmt)
+
+                if result.rowcount != 1:
+                    return False
+
+                product = await connection.execute(select(Product.id).where(Product.id == product_id))
+
+                if product.scalar() is None:
+                    await transaction.rollback()
+                    return None
+
+                currentinvoice_id = await current_invoice_id(connection, current_user.id)
+
+                if currentinvoice_id is None:
+                    result = await connection.execute(CurrentInvoice.__table__.insert().values(user_id=current_user.id))
+                    currentinvoice_id = result.inserted_primary_key[0]
+
+                await connection.execute(cart.add_line_statement(currentinvoice_id, product_id,
+                                                                 dialect=connection.dialect.name))
+
+        return True
+
+    try:
+        reserved = await with_retries(scan)
+    except stock.StockBusyError:
+        return jsonify({'message': 'the inventory is busy, try again'}), http_status.SERVICEUNAVAILABLE
+
+    if reserved is None:
+        return jsonify({'message': 'product does not exist'}), http_status.NOTFOUND
+
+    if not reserved:
+
+        async with engine().connect() as connection:
+            product = (await connection.execute(select(Product.id).where(Product.id == product_id))).first()
+            quantity = (await connection.execute(select(Product_Quantity.id)
+                                                 .where(Product_Quantity.product_id == product_id))).first()
+
+        if product is None:
+            return jsonify({'message': 'product does not exist'}), http_status.NOTFOUND
+
+        if quantity is None:
+            return jsonify({'message': 'product quantity not found'}), http_status.NOTFOUND
+
+        return jsonify({'message': 'not enough products in inventory'}), http_status.FORBIDDEN
+
+    return jsonify({'message' : 'product added to your invoice'})
+
+
+@main.route('/invoice', methods=['GET'])
+@token_required
+async def get_current_invoice(current_user):
+    """
+    Same as the /invoice of the sync app.
+    """
+
+    async with engine().connect() as connection:
+
+        currentinvoice_id = await current_invoice_id(connection, current_user.id)
+
+        if currentinvoice_id is None:
+            return jsonify({'message': 'no current invoice associated to {}'.format(current_user.username)}), http_status.NOTFOUND
+
+        lines = (await connection.execute(cart.lines_query(currentinvoice_id))).all()
+
+    products = []
+    for name, weight, unit, price, quantity in lines:
+        products.append({'name': name,
+                         'weight': weight,
+                         'unit': unit,
+                         'price': price,
+                         'quantity': quantity})
+
+    return jsonify({'cashier' : current_user.username, 'list_of_products' : products})
+
+
+@main.route('/confirm', methods=['GET'])
+@token_required
+async def confirm_purchase(current_user):
+    """
+    Same as the /confirm of the sync app, the invoice, the cart
+    and the daily sales rollups change in one transaction.
+    """
+
+    async with engine().begin() as connection:
+
+        currentinvoice_id = await current_invoice_id(connection, current_user.id)
+
+        if currentinvoice_id is None:
+            return jsonify({'message': 'no current invoice associated to {}'.format(current_user.username)}), http_status.NOTFOUND
+
+        sales = (await connection.execute(cart.sales_query(currentinvoice_id))).all()
+        total, item_count = cart.totals(sales)
+
+        date = datetime.utcnow()
+        result = await connection.execute(Invoice.__table__.insert().values(
+            user_id=current_user.id, date=date, total=total, item_count=item_count))
+        invoice_id = result.inserted_primary_key[0]
+
+        for stmt in cart.checkout_statements(currentinvoice_id, invoice_id, current_user.id):
+            await connection.execute(stmt)
+
+        rows = rollups.sales_rows(date.date(), sales)
+
+        if rows:
+            await connection.execute(rollups.record_sales_statement(connection.dialect.name), rows)
+
+    return jsonify({'message' : 'invoice confirmed'})
+
+
+def create_async_app(db_uri=None):
+    """
+    Create the Quart app. The configuration is loaded by create_app,
+    which also brings the database up to date before serving.
+    """
+
+    sync_app = create_app(db_uri)
+
+    with sync_app.app_context():
+        db.engine.dispose()
+
+    app = Quart(__name__)
+    app.config.update({key: value for key, value in sync_app.config.items()
+                       if key not in Flask.default_config or key == "SECRET_KEY"})
+
+    uri = app.config["SQLALCHEMY_DATABASE_URI"]
+    async_engine = create_async_engine(database.async_url(uri), **database.async_engine_options(app.config))
+
+    if async_engine.dialect.name == "sqlite":
+        pragmas = database.sqlite_pragmas(app.config)
+        if pragmas:
+            event.listen(async_engine.sync_engine, "connect",
+                         lambda dbapi_connection, record: database.apply_pragmas(dbapi_connection, pragmas))
+
+    app.extensions["async_engine"] = async_engine
+    app.extensions["auth_cache"] = TTLCache(app.config["AUTH_CACHE_SIZE"])
+
+    app.register_blueprint(main)
+
+    # The stock ledger is compacted with the sync engine.
+    @app.before_serving
+    async def start_compactor():
+        sync_app.extensions["stock_compactor"].start()
+
+    @app.after_serving
+    async def dispose_engine():
+        sync_app.extensions["stock_compactor"].stop()
+        await async_engine.dispose()
+
+    return app
@@ -0,0 +1,155 @@
+"""
+Authentication helpers for token_required, the decoded tokens
+are cached in process as lightweight user records so the hot
+endpoints don't query the users table on every request. A change
+to a user reaches the caches of the other workers only when their
+entries expire, AUTH_CACHE_TTL bounds how long it takes.
+
+Access tokens are short lived JWTs, the refresh tokens given at
+login exchange for new ones without hashing the password again.
+"""
+import datetime
+import hashlib
+import secrets
+import time
+import jwt
+from collections import namedtuple
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from .cache import TTLCache
+from .models import db, Users, Refresh_Token
+
+AuthUser = namedtuple("AuthUser", ["id", "public_id", "username", "admin"])
+
+
+def init_app(app):
+    app.extensions["auth_cache"] = TTLCache(app.config["AUTH_CACHE_SIZE"])
+
+
+def auth_cache():
+    return current_app.extensions["auth_cache"]
+
+
+def authenticate(token):
+    """
+    Return the AuthUser of a token, decoding it and querying the user
+    only on a cache miss. An entry lives AUTH_CACHE_TTL seconds at most
+    and never longer than the token itself. Raise an exception if the
+    token is invalid or its user does not exist.
+    """
+
+    cache = auth_cache()
+    user = cache.get(token)
+
+    if user is not None:
+        return user
+
+    data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms="HS256")
+    row = Users.query.filter_by(public_id=data['public_id']).first()
+
+    if row is None:
+        raise LookupError("user {} not found".format(data['public_id']))
+
+    user = AuthUser(row.id, row.public_id, row.username, row.admin)
+    expires = min(time.time() + current_app.config["AUTH_CACHE_TTL"], data['exp'])
+    cache.set(token, user, expires)
+
+    return user
+
+
+def encode_token(public_id):
+    """
+    Create an access token valid for ACCESS_TOKEN_MINUTES.
+    """
+
+    expires = datetime.datetime.utcnow() + datetime.timedelta(minutes=current_app.config["ACCESS_TOKEN_MINUTES"])
+
+    return jwt.encode({'public_id': public_id, 'exp': expires}, current_app.config['SECRET_KEY'])
+
+
+def hash_refresh_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def issue_refresh_token(user_id):
+    """
+    Create a refresh token valid for REFRESH_TOKEN_DAYS and delete
+    the expired and revoked ones of the user, so the table doesn't
+    grow with every login. The caller commits the transaction.
+    """
+
+    now = datetime.datetime.utcnow()
+    table = Refresh_Token.__table__
+
+    db.session.execute(table.delete()
+                       .where(table.c.user_id == user_id)
+                       .where((table.c.revoked == True) | (table.c.expires_at <= now)))
+
+    token = secrets.token_urlsafe(32)
+    expires = now + datetime.timedelta(days=current_app.config["REFRESH_TOKEN_DAYS"])
+
+    db.session.add(Refresh_Token(token_hash=hash_refresh_token(token),
+                                 user_id=user_id,
+                                 expires_at=expires))
+
+    return token
+
+
+def refresh_token_owner(token):
+    """
+    Return the public_id of the user of a valid refresh token
+    (not revoked nor expired) or None, with a single query.
+    """
+
+    return db.session.query(Users.public_id)\
+        .join(Refresh_Token, Refresh_Token.user_id == Users.id)\
+        .filter(Refresh_Token.token_hash == hash_refresh_token(token),
+                Refresh_Token.revoked == False,
+                Refresh_Token.expires_at > datetime.datetime.utcnow())\
+        .scalar()
+
+
+def revoke_refresh_token(token):
+    """
+    Revoke a refresh token, return False if it does not exist.
+    The caller commits the transaction.
+    """
+
+    table = Refresh_Token.__table__
+    result = db.session.execute(table.update()
+                                .where(table.c.token_hash == hash_refresh_token(token))
+                                .values(revoked=True))
+
+    return result.rowcount == 1
+
+
+def invalidate_user(public_id):
+    """
+    Drop every cached token of the given user in this process, the
+    other workers only drop them when their entries expire.
+    """
+
+    auth_cache().discard(lambda user: user.public_id == public_id)
+
+
+@event.listens_for(Users, "after_update")
+@event.listens_for(Users, "after_delete")
+def _user_changed(mapper, connection, target):
+    session = object_session(target)
+    session.info.setdefault("changed_users", set()).add(target.public_id)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_changed_users(session):
+
+    changed_users = session.info.pop("changed_users", set())
+
+    if has_app_context() and "auth_cache" in current_app.extensions:
+        for public_id in changed_users:
+            invalidate_user(public_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_changed_users(session):
+    session.info.pop("changed_users", None)
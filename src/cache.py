@@ -0,0 +1,108 @@
+"""
+Small in-process caches shared by the app modules.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread safe mapping bounded to maxsize entries, the least
+    recently used entry is evicted first. Hits and misses are
+    counted so the size can be tuned from the stats.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+
+        with self.lock:
+            if key not in self.data:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self.data.move_to_end(key)
+            return self.data[key]
+
+    def set(self, key, value):
+
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key):
+
+        with self.lock:
+            return self.data.pop(key, None)
+
+    def discard(self, predicate):
+        """
+        Remove every entry whose value matches the predicate.
+        """
+
+        with self.lock:
+            for key in [key for key, value in self.data.items() if predicate(value)]:
+                del self.data[key]
+
+    def clear(self):
+
+        with self.lock:
+            self.data.clear()
+
+    def items(self):
+        """
+        Return a snapshot of the (key, value) entries.
+        """
+
+        with self.lock:
+            return list(self.data.items())
+
+    def stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "size": len(self.data),
+                "maxsize": self.maxsize}
+
+
+class TTLCache(LRUCache):
+    """
+    LRU cache whose entries also expire, each value is stored
+    with the epoch time (as in time.time()) it stops being valid.
+    """
+
+    def get(self, key, default=None):
+
+        with self.lock:
+            entry = self.data.get(key)
+
+            if entry is None or entry[0] <= time.time():
+                self.data.pop(key, None)
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self.data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, expires):
+        super().set(key, (expires, value))
+
+    def discard(self, predicate):
+        super().discard(lambda entry: predicate(entry[1]))
+
+    def items(self):
+        now = time.time()
+        return [(key, entry[1]) for key, entry in super().items() if entry[0] > now]
@@ -0,0 +1,113 @@
+"""
+Current invoice (cart) statements, a cart line is a
+(product_id, quantity) pair so every operation costs the
+same number of statements whatever the size of the basket.
+
+The *_statement(s) and *_query builders don't depend on the
+session, the async app of src/asgi.py executes the same SQL.
+"""
+from sqlalchemy import select
+from .models import db, upsert, Product, Invoice_Product, CurrentInvoice, CurrentInvoice_Product
+from .stock import sale_statement
+
+
+def add_line_statement(currentinvoice_id, product_id, quantity=1, dialect=None):
+    """
+    Upsert of the cart line, a product that is already in the
+    cart gets its quantity incremented.
+    """
+
+    table = CurrentInvoice_Product.__table__
+    stmt = upsert(CurrentInvoice_Product, dialect).values(currentinvoice_id=currentinvoice_id,
+                                                           product_id=product_id,
+                                                           quantity=quantity)
+
+    return stmt.on_conflict_do_update(index_elements=[table.c.currentinvoice_id, table.c.product_id],
+                                      set_={"quantity": table.c.quantity + stmt.excluded.quantity})
+
+
+def add_line(currentinvoice_id, product_id, quantity=1):
+    """
+    Add the product to the cart with a single upsert.
+    """
+
+    db.session.execute(add_line_statement(currentinvoice_id, product_id, quantity))
+
+
+def lines_query(currentinvoice_id):
+    return select(Product.name, Product.weight, Product.unit, Product.price, CurrentInvoice_Product.quantity)\
+        .join(Product, Product.id == CurrentInvoice_Product.product_id)\
+        .where(CurrentInvoice_Product.currentinvoice_id == currentinvoice_id)\
+        .order_by(CurrentInvoice_Product.id)
+
+
+def lines(currentinvoice_id):
+    """
+    Return the cart lines joined with their products in scan order.
+    """
+
+    return db.session.execute(lines_query(currentinvoice_id)).all()
+
+
+def checkout_statements(currentinvoice_id, invoice_id, user_id=None):
+    """
+    The INSERT ... SELECT copying the cart lines with their product
+    info into the invoice, the one recording them as sales in the
+    stock ledger and the two DELETE statements of the cart.
+    """
+
+    lines = select(Product.name,
+                   Product.weight,
+                   Product.price,
+                   Product.unit,
+                   CurrentInvoice_Product.quantity,
+                   db.literal(invoice_id, db.Integer))\
+        .select_from(CurrentInvoice_Product)\
+        .join(Product, Product.id == CurrentInvoice_Product.product_id)\
+        .where(CurrentInvoice_Product.currentinvoice_id == currentinvoice_id)
+
+    table = Invoice_Product.__table__
+
+    return [table.insert().from_select(["name", "weight", "price", "unit", "quantity", "invoice_id"], lines),
+            sale_statement(currentinvoice_id, invoice_id, user_id),
+            CurrentInvoice_Product.__table__.delete()
+            .where(CurrentInvoice_Product.currentinvoice_id == currentinvoice_id),
+            CurrentInvoice.__table__.delete()
+            .where(CurrentInvoice.id == currentinvoice_id)]
+
+
+def checkout(currentinvoice_id, invoice_id, user_id=None):
+    """
+    Move the cart into the invoice and delete it, the cost doesn't
+    depend on the number of lines. The caller owns the transaction.
+    """
+
+    for stmt in checkout_statements(currentinvoice_id, invoice_id, user_id):
+        db.session.execute(stmt)
+
+
+def sales_query(currentinvoice_id):
+    return select(Product.name,
+                  db.func.sum(CurrentInvoice_Product.quantity),
+                  db.func.sum(CurrentInvoice_Product.quantity * Product.price))\
+        .join(Product, Product.id == CurrentInvoice_Product.product_id)\
+        .where(CurrentInvoice_Product.currentinvoice_id == currentinvoice_id)\
+        .group_by(Product.name)
+
+
+def sales(currentinvoice_id):
+    """
+    Return the (name, quantity, revenue) lines of the cart, read
+    before the checkout to store the invoice totals and update the
+    daily sales rollups.
+    """
+
+    return db.session.execute(sales_query(currentinvoice_id)).all()
+
+
+def totals(sales):
+    """
+    Return the total and the item count of the sales lines.
+    """
+
+    return sum(revenue for _, _, revenue in sales), sum(quantity for _, quantity, _ in sales)
@@ -0,0 +1,302 @@
+"""
+Product catalog helpers, the catalog version used as ETag
+by /products, the single JOIN query behind its pages and
+the in-process product cache used by the register paths.
+"""
+import threading
+import time
+import uuid
+from collections import namedtuple
+from flask import current_app
+from sqlalchemy import select
+from .cache import LRUCache
+from .models import db, upsert, Product, Product_Quantity, Catalog_Version, Stock_Movement
+from .stock import available_quantity
+from .utils import is_integer
+
+# Fields a client can ask for with /products?fields=...
+PRODUCT_FIELDS = {
+    "id": lambda: Product.id,
+    "name": lambda: Product.name,
+    "weight": lambda: Product.weight,
+    "price": lambda: Product.price,
+    "unit": lambda: Product.unit,
+    "quantity": available_quantity,
+}
+
+CachedProduct = namedtuple("CachedProduct", ["id", "name", "price", "weight", "unit"])
+
+# Bound of the values in a single IN (...) list, old SQLite
+# versions reject statements with more than 999 parameters.
+IN_CHUNK_SIZE = 500
+
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 1000
+
+
+class ProductCache:
+    """
+    Bounded LRU cache of the products, each product is stored under
+    ("id", id) and ("name", name). The entries belong to a version
+    of the Catalog_Version row, the row is read again at most every
+    sync_interval seconds and a new version (written by another
+    worker) drops every entry.
+
+    The generation guards against a reader caching a row it loaded
+    before an invalidation happened.
+    """
+
+    def __init__(self, maxsize, sync_interval):
+        self.products = LRUCache(maxsize)
+        self.sync_interval = sync_interval
+        self.version = None
+        self.synced_at = None
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def sync(self, version=None):
+        """
+        Drop the entries if the Catalog_Version row changed, the row
+        is only read when the caller didn't already read it.
+        """
+
+        now = time.monotonic()
+
+        if version is None:
+
+            if self.synced_at is not None and now - self.synced_at < self.sync_interval:
+                return
+
+            version = shared_version()
+
+        with self.lock:
+            self.synced_at = now
+            if version != self.version:
+                self.version = version
+                self.generation += 1
+                self.products.clear()
+
+    def lookup(self, key, load):
+
+        self.sync()
+
+        product = self.products.get(key)
+
+        if product is not None:
+            return product
+
+        generation = self.generation
+        row = load()
+
+        if row is None:
+            return None
+
+        product = CachedProduct(row.id, row.name, row.price, row.weight, row.unit)
+
+        with self.lock:
+            if generation == self.generation:
+                self.products.set(("id", product.id), product)
+                self.products.set(("name", product.name), product)
+
+        return product
+
+    def invalidate(self):
+
+        with self.lock:
+            self.synced_at = None
+            self.generation += 1
+            self.products.clear()
+
+    def stats(self):
+
+        stats = self.products.stats()
+        stats["version"] = self.version
+
+        return stats
+
+
+def init_app(app):
+    init_product_cache(app)
+
+
+def init_product_cache(app):
+    app.extensions["product_cache"] = ProductCache(app.config["PRODUCT_CACHE_SIZE"],
+                                                   app.config["CATALOG_SYNC_INTERVAL"])
+
+
+def product_cache():
+    return current_app.extensions["product_cache"]
+
+
+def shared_version():
+    return db.session.query(Catalog_Version.version).filter_by(id=1).scalar() or 0
+
+
+def init_version():
+    """
+    Create the Catalog_Version row and draw its nonce if it has none,
+    runs once per database (see src.bootstrap_database). Every worker
+    then gives the same ETag for the same catalog, and an ETag of
+    another database never matches.
+    """
+
+    table = Catalog_Version.__table__
+    stmt = upsert(Catalog_Version).values(id=1, version=0, nonce=uuid.uuid4().hex[:8])
+    stmt = stmt.on_conflict_do_update(index_elements=[table.c.id],
+                                      set_={"nonce": db.func.coalesce(table.c.nonce, stmt.excluded.nonce)})
+
+    db.session.execute(stmt)
+    db.session.commit()
+
+
+def version_query():
+    """
+    Select the (nonce, catalog version, last stock movement id) of
+    the ETag of /products with a single query. The Catalog_Version
+    row is bumped by every change to the products and every change
+    to their quantities appends a movement, so the versions change
+    whenever /products would.
+    """
+
+    def version(column):
+        return select(column).where(Catalog_Version.id == 1).scalar_subquery()
+
+    return select(db.func.coalesce(version(Catalog_Version.nonce), ""),
+                  db.func.coalesce(version(Catalog_Version.version), 0),
+                  db.func.coalesce(select(db.func.max(Stock_Movement.id)).scalar_subquery(), 0))
+
+
+def etag(versions):
+    return "{}-{}-{}".format(*versions)
+
+
+def products_etag():
+
+    versions = db.session.execute(version_query()).one()
+    product_cache().sync(versions[1])
+
+    return etag(versions)
+
+
+def bump_shared_version():
+    """
+    Increment the Catalog_Version row inside the caller transaction,
+    must be called before committing a change to the products.
+    """
+
+    table = Catalog_Version.__table__
+    stmt = upsert(Catalog_Version).values(id=1, version=1)
+    stmt = stmt.on_conflict_do_update(index_elements=[table.c.id],
+                                      set_={"version": table.c.version + 1})
+
+    db.session.execute(stmt)
+
+
+def products_changed():
+    """
+    Must be called after committing a change to the products,
+    drops the local product cache.
+    """
+
+    product_cache().invalidate()
+
+
+def get_product(product_id):
+    """
+    Return the CachedProduct with the given id or None.
+    """
+
+    try:
+        product_id = int(product_id)
+    except (TypeError, ValueError):
+        return None
+
+    return product_cache().lookup(("id", product_id),
+                                  lambda: Product.query.filter_by(id=product_id).first())
+
+
+def get_product_by_name(name):
+    """
+    Return the CachedProduct with the given name or None.
+    """
+
+    return product_cache().lookup(("name", name),
+                                  lambda: Product.query.filter_by(name=name).first())
+
+
+def page_arguments(args):
+    """
+    Validate the after_id, limit and fields arguments of /products,
+    return ((fields, after_id, limit), None) or (None, message).
+    """
+
+    after_id = args.get('after_id', '0')
+    limit = args.get('limit', str(DEFAULT_PAGE_SIZE))
+
+    if not is_integer(after_id) or not is_integer(limit):
+        return None, 'invalid value for after_id or limit, must be an integer'
+
+    limit = int(limit)
+
+    if limit <= 0 or limit > MAX_PAGE_SIZE:
+        return None, 'invalid value for limit, 0 < limit <= {}'.format(MAX_PAGE_SIZE)
+
+    fields = list(PRODUCT_FIELDS)
+    if 'fields' in args:
+        fields = args['fields'].split(',')
+
+    if not fields or any(field not in PRODUCT_FIELDS for field in fields):
+        return None, 'invalid value for fields, must be in {}'.format(', '.join(PRODUCT_FIELDS))
+
+    return (fields, int(after_id), limit), None
+
+
+def products_page_query(fields, after_id=0, limit=DEFAULT_PAGE_SIZE):
+    """
+    Select the id and the requested fields of the products after the
+    given id ordered by id, Product_Quantity is only joined when the
+    quantity is requested.
+    """
+
+    query = select(Product.id, *[PRODUCT_FIELDS[field]() for field in fields])
+
+    if "quantity" in fields:
+        query = query.outerjoin(Product_Quantity, Product_Quantity.product_id == Product.id)
+
+    return query.where(Product.id > after_id)\
+        .order_by(Product.id)\
+        .limit(limit)
+
+
+def products_page(fields, after_id=0, limit=DEFAULT_PAGE_SIZE):
+    """
+    Return a list of (id, row) tuples with the products after the given
+    id ordered by id, each row is the tuple of the requested fields.
+    """
+
+    rows = db.session.execute(products_page_query(fields, after_id, limit)).all()
+
+    return [(row[0], row[1:]) for row in rows]
+
+
+def chunks(values, size=IN_CHUNK_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def product_ids(ids=(), names=()):
+    """
+    Resolve product ids and names with batched IN queries, return two
+    dicts {id: name} and {name: id} with the products that exist.
+    """
+
+    by_id = {}
+    for chunk in chunks(set(ids)):
+        by_id.update(db.session.query(Product.id, Product.name).filter(Product.id.in_(chunk)).all())
+
+    by_name = {}
+    for chunk in chunks(set(names)):
+        by_name.update(db.session.query(Product.name, Product.id).filter(Product.name.in_(chunk)).all())
+
+    return by_id, by_name
@@ -0,0 +1,71 @@
+"""
+Compression of the responses, negotiated with the Accept-Encoding
+header of the request. Bodies of COMPRESS_MIN_SIZE bytes or more
+are compressed with brotli (when the brotli package is installed)
+or gzip, smaller ones cost more CPU than the bytes they save.
+Streamed responses (e.g. /export) are left as they are.
+"""
+import gzip
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = ["application/json", "text/csv", "text/plain", "application/x-ndjson"]
+
+
+def encoders():
+    """
+    Return the {encoding: compress(data)} functions available,
+    in order of preference.
+    """
+
+    config = current_app.config
+    found = {}
+
+    if brotli is not None:
+        found["br"] = lambda data: brotli.compress(data, quality=config["COMPRESS_BROTLI_QUALITY"])
+
+    found["gzip"] = lambda data: gzip.compress(data, compresslevel=config["COMPRESS_LEVEL"], mtime=0)
+
+    return found
+
+
+def compress(response):
+
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or "Content-Encoding" in response.headers or response.mimetype not in COMPRESSIBLE):
+        return response
+
+    response.vary.add("Accept-Encoding")
+
+    if response.content_length is None or response.content_length < current_app.config["COMPRESS_MIN_SIZE"]:
+        return response
+
+    available = encoders()
+    encoding = request.accept_encodings.best_match(list(available))
+
+    if encoding is None:
+        return response
+
+    response.set_data(available[encoding](response.get_data()))
+    response.headers["Content-Encoding"] = encoding
+
+    # The compressed body is another representation of the resource.
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+
+    return response
+
+
+def init_app(app):
+    """
+    Must run after metrics.init_app, the last registered after
+    request hook runs first and the compression time then counts
+    in the latency of the request.
+    """
+
+    app.after_request(compress)
@@ -0,0 +1,204 @@
+"""
+Connection settings of the database engine. SQLite connections
+get the PRAGMAs of the configured profile through the engine
+connect event, every new connection of the pool is tuned.
+PostgreSQL engines get an explicitly sized pool and a statement
+timeout. The async app gets the same settings on the asyncio
+drivers (aiosqlite and asyncpg).
+"""
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from .models import db
+
+# PRAGMA name -> accepted values (None means any integer).
+SQLITE_PRAGMAS = {
+    "journal_mode": ["DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"],
+    "synchronous": ["OFF", "NORMAL", "FULL", "EXTRA"],
+    "cache_size": None,
+    "mmap_size": None,
+    "temp_store": ["DEFAULT", "FILE", "MEMORY"],
+    "busy_timeout": None,
+}
+
+SQLITE_PROFILES = {
+    # SQLite defaults, rollback journal and a full fsync on every commit.
+    "default": {},
+    # WAL lets readers run while a checkout commits, NORMAL only syncs
+    # the WAL at checkpoints (a crash can lose the last commits but
+    # never corrupts the database), 64MB of page cache, 256MB mmap
+    # and writers wait 5s for the lock instead of failing.
+    "production": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -64000,
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+}
+
+
+# Pool settings of the server databases, key -> (default, type).
+POOL_SETTINGS = {
+    "DB_POOL_SIZE": (10, int),
+    "DB_MAX_OVERFLOW": (20, int),
+    "DB_POOL_TIMEOUT": (30, float),
+    "DB_POOL_RECYCLE": (1800, int),
+    "DB_POOL_PRE_PING": ("true", str),
+    "DB_STATEMENT_TIMEOUT": (5000, int),
+}
+
+
+def load_config(app, environ):
+    """
+    Read SQLITE_PROFILE, the SQLITE_<PRAGMA> overrides (e.g.
+    SQLITE_SYNCHRONOUS=FULL) and the DB_<POOL SETTING> keys
+    into the app config.
+    """
+
+    app.config["SQLITE_PROFILE"] = environ.get("SQLITE_PROFILE", "production")
+
+    for pragma in SQLITE_PRAGMAS:
+        key = "SQLITE_" + pragma.upper()
+        if environ.get(key):
+            app.config[key] = environ.get(key)
+
+    for key, (default, cast) in POOL_SETTINGS.items():
+        app.config[key] = cast(environ.get(key, default))
+
+
+def sqlite_pragmas(config):
+    """
+    Return the {pragma: value} settings of the profile with the
+    overrides applied, raise ValueError on an invalid value.
+    """
+
+    if config["SQLITE_PROFILE"] not in SQLITE_PROFILES:
+        raise ValueError("invalid SQLITE_PROFILE, must be {}".format(", ".join(SQLITE_PROFILES)))
+
+    pragmas = dict(SQLITE_PROFILES[config["SQLITE_PROFILE"]])
+
+    for pragma, choices in SQLITE_PRAGMAS.items():
+
+        value = config.get("SQLITE_" + pragma.upper())
+
+        if value is None:
+            continue
+
+        value = str(value).upper()
+
+        if (choices is None and not value.lstrip('-').isnumeric()) or (choices is not None and value not in choices):
+            raise ValueError("invalid value for SQLITE_{}: {}".format(pragma.upper(), value))
+
+        pragmas[pragma] = value
+
+    return pragmas
+
+
+def sqlite_engine_options(profile, uri):
+    """
+    SQLAlchemy 1.4 opens a new connection for every checkout of a
+    SQLite file (NullPool), so the PRAGMAs would run again on every
+    transaction. Tuned profiles keep the connections in a QueuePool,
+    shared between threads like SQLAlchemy 2.0 does.
+    """
+
+    url = make_url(uri)
+
+    if profile == "default" or url.get_backend_name() != "sqlite" or url.database in (None, "", ":memory:"):
+        return {}
+
+    return {"poolclass": QueuePool, "connect_args": {"check_same_thread": False}}
+
+
+def postgresql_engine_options(config):
+    """
+    Pool sized by DB_POOL_SIZE + DB_MAX_OVERFLOW per process, with
+    a ping before each checkout (connections dropped by the server
+    are replaced instead of failing a request), recycled after
+    DB_POOL_RECYCLE seconds and DB_STATEMENT_TIMEOUT milliseconds
+    as the limit of a single statement.
+    """
+
+    return {"pool_size": config["DB_POOL_SIZE"],
+            "max_overflow": config["DB_MAX_OVERFLOW"],
+            "pool_timeout": config["DB_POOL_TIMEOUT"],
+            "pool_recycle": config["DB_POOL_RECYCLE"],
+            "pool_pre_ping": config["DB_POOL_PRE_PING"].lower() in ["1", "true", "yes"],
+            "connect_args": {"options": "-c statement_timeout={}".format(config["DB_STATEMENT_TIMEOUT"])}}
+
+
+def engine_options(config):
+
+    uri = config["SQLALCHEMY_DATABASE_URI"]
+
+    if make_url(uri).get_backend_name() == "postgresql":
+        return postgresql_engine_options(config)
+
+    return sqlite_engine_options(config["SQLITE_PROFILE"], uri)
+
+
+# Backend -> asyncio driver used by the async app.
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+
+def async_url(uri):
+    """
+    Return the URL of the database on its asyncio driver, raise
+    ValueError for an in-memory SQLite database (every connection
+    of the async engine would open an empty database).
+    """
+
+    url = make_url(uri)
+    backend = url.get_backend_name()
+
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError("no asyncio driver for {}".format(backend))
+
+    if backend == "sqlite" and url.database in (None, "", ":memory:"):
+        raise ValueError("the async app needs a SQLite file or a server database")
+
+    return url.set(drivername=ASYNC_DRIVERS[backend])
+
+
+def async_engine_options(config):
+
+    options = engine_options(config)
+
+    if make_url(config["SQLALCHEMY_DATABASE_URI"]).get_backend_name() == "postgresql":
+        options["connect_args"] = {"server_settings": {"statement_timeout": str(config["DB_STATEMENT_TIMEOUT"])}}
+    elif options:
+        options = {"poolclass": AsyncAdaptedQueuePool}
+
+    return options
+
+
+def apply_pragmas(dbapi_connection, pragmas):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in pragmas.items():
+        cursor.execute("PRAGMA {} = {}".format(pragma, value))
+    cursor.close()
+
+
+def init_app(app):
+    """
+    Set the engine options and attach the connect listener to the
+    engine of the app, must run before the engine is created.
+    """
+
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {}).update(engine_options(app.config))
+
+    with app.app_context():
+        engine = db.engine
+
+    if engine.dialect.name != "sqlite":
+        return
+
+    pragmas = sqlite_pragmas(app.config)
+
+    if pragmas:
+        event.listen(engine, "connect", lambda dbapi_connection, record: apply_pragmas(dbapi_connection, pragmas))
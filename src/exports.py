@@ -0,0 +1,97 @@
+"""
+Streaming export of the invoice line items for accounting, the
+rows are fetched from the database in batches (yield_per) and
+written to the response as they arrive, so the memory used does
+not depend on the number of rows.
+"""
+import csv
+import io
+import json
+from .models import db, Invoice, Invoice_Product
+from .reports import date_bounds
+
+FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+COLUMNS = ["invoice_id", "date", "cashier", "name", "weight", "price", "unit", "quantity"]
+
+BATCH_SIZE = 1000
+
+
+def line_items(initial_date, final_date):
+    """
+    Iterate the line items of the invoices between the two days,
+    ordered by invoice date, fetching BATCH_SIZE rows at a time.
+    """
+
+    start, end = date_bounds(initial_date, final_date)
+
+    return db.session.query(Invoice.id,
+                            Invoice.date,
+                            Invoice.user_id,
+                            Invoice_Product.name,
+                            Invoice_Product.weight,
+                            Invoice_Product.price,
+                            Invoice_Product.unit,
+                            Invoice_Product.quantity)\
+        .join(Invoice_Product, Invoice_Product.invoice_id == Invoice.id)\
+        .filter(Invoice.date >= start, Invoice.date < end)\
+        .order_by(Invoice.date, Invoice.id, Invoice_Product.id)\
+        .execution_options(stream_results=True)\
+        .yield_per(BATCH_SIZE)
+
+
+def values(row):
+    return [row[0], row[1].isoformat()] + list(row[2:])
+
+
+def csv_chunks(rows):
+    """
+    Yield the CSV header and then one chunk of text per batch.
+    """
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow(COLUMNS)
+    yield buffer.getvalue()
+
+    for batch in batches(rows):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(values(row) for row in batch)
+        yield buffer.getvalue()
+
+
+def ndjson_chunks(rows):
+    """
+    Yield one chunk of JSON lines per batch.
+    """
+
+    for batch in batches(rows):
+        yield "".join(json.dumps(dict(zip(COLUMNS, values(row)))) + "\n" for row in batch)
+
+
+def batches(rows):
+
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+CHUNKS = {
+    "csv": csv_chunks,
+    "ndjson": ndjson_chunks,
+}
+
+
+def export_chunks(file_format, initial_date, final_date):
+    return CHUNKS[file_format](line_items(initial_date, final_date))
@@ -1,6 +1,8 @@
 OK = 200 # indicates that the request has succeeded.
 CREATED = 201 # indicates that the request has succeeded and has led to the creation of a resource.
+NOTMODIFIED = 304 # indicates that there is no need to retransmit the requested resource, the client cached copy is still valid.
 UNAUTHORIZED = 401 # indicates that the client request has not been completed because it lacks valid authentication credentials for the requested resource.
 FORBIDDEN = 403 # indicates that the server understands the request but refuses to authorize it.
 NOTFOUND = 404 # indicates that the server cannot find the requested resource.
 CONFLICT = 409 # indicates a request conflict with the current state of the target resource.
+SERVICEUNAVAILABLE = 503 # indicates that the server is not ready to handle the request, the client can try again later.
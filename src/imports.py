@@ -0,0 +1,158 @@
+"""
+Streaming product catalog import, the request body (CSV with a
+name,price,weight,unit header or NDJSON, one product object per
+line) is read line by line and written in batches, so the memory
+used doesn't depend on the size of the file.
+"""
+import codecs
+import csv
+import json
+from . import catalog
+from .models import db, Product, Product_Quantity
+from .utils import validate_product
+
+FORMATS = {
+    "csv": ["text/csv"],
+    "ndjson": ["application/x-ndjson", "application/ndjson", "application/jsonl"],
+}
+
+BATCH_SIZE = 500
+
+# Only the first rejected rows are reported one by one.
+MAX_REPORTED_REJECTS = 100
+
+
+def detect_format(requested, content_type):
+    """
+    Return the format given as ?format= or the one matching the
+    content type of the request, None if it is not supported.
+    """
+
+    if requested is not None:
+        return requested if requested in FORMATS else None
+
+    for name, mimetypes in FORMATS.items():
+        if content_type in mimetypes:
+            return name
+
+    return None
+
+
+def read_rows(stream, format):
+    """
+    Yield (line, row) tuples from a binary stream, row is a dict
+    or None if the line could not be parsed. Only readline() is
+    used, the WSGI input of some servers is not a full file object.
+    A leading BOM is skipped, a line that is not UTF-8 raises
+    UnicodeDecodeError.
+    """
+
+    text = codecs.iterdecode(iter(stream.readline, b""), "utf-8-sig")
+
+    if format == "csv":
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+        return
+
+    for line, content in enumerate(text, start=1):
+
+        if not content.strip():
+            continue
+
+        try:
+            row = json.loads(content)
+        except ValueError:
+            row = None
+
+        yield line, row if isinstance(row, dict) else None
+
+
+def insert_batch(products):
+    """
+    Insert the {name: values} products that are not already in DB,
+    return the list of names that were already taken.
+    """
+
+    names = list(products)
+    existing = {name for (name,) in db.session.query(Product.name).filter(Product.name.in_(names))}
+    new_names = [name for name in names if name not in existing]
+
+    if new_names:
+        db.session.execute(Product.__table__.insert(), [products[name] for name in new_names])
+
+        quantities = db.session.query(Product.id, db.literal(0, db.Integer)).filter(Product.name.in_(new_names))
+        db.session.execute(Product_Quantity.__table__.insert().from_select(
+            ["product_id", "quantity"], quantities))
+
+        catalog.bump_shared_version()
+        db.session.commit()
+        catalog.products_changed()
+
+    return [name for name in names if name in existing]
+
+
+def import_products(rows):
+    """
+    Validate the rows with the same rules as /product/create and
+    insert them in batches of BATCH_SIZE, each batch is committed
+    on its own. Returns the import summary, a file that is not
+    UTF-8 stops the import at the first bad line and is reported
+    as "error" next to the rows imported so far.
+    """
+
+    summary = {"imported": 0, "rejected": 0, "rejected_rows": []}
+
+    def reject(line, message):
+        summary["rejected"] += 1
+        if len(summary["rejected_rows"]) < MAX_REPORTED_REJECTS:
+            summary["rejected_rows"].append({"line": line, "message": message})
+
+    batch = {}
+    lines = {}
+
+    def flush():
+        taken = insert_batch(batch)
+        for name in taken:
+            reject(lines[name], 'product already exists')
+        summary["imported"] += len(batch) - len(taken)
+        batch.clear()
+        lines.clear()
+
+    rows = iter(rows)
+    line = 0
+
+    while True:
+
+        try:
+            line, row = next(rows)
+        except StopIteration:
+            break
+        except UnicodeDecodeError:
+            summary["error"] = {"line": line + 1, "message": 'invalid encoding, must be UTF-8'}
+            break
+
+        if row is None:
+            reject(line, 'invalid row')
+            continue
+
+        values, message = validate_product(row)
+
+        if values is None:
+            reject(line, message)
+            continue
+
+        if values["name"] in batch:
+            reject(line, 'product already exists')
+            continue
+
+        batch[values["name"]] = values
+        lines[values["name"]] = line
+
+        if len(batch) >= BATCH_SIZE:
+            flush()
+
+    if batch:
+        flush()
+
+    return summary
@@ -0,0 +1,161 @@
+"""
+Invoice history served by /invoices and /invoices/<id>, for receipt
+reprints and returns. The pages are ordered by (date, id), newest
+first, and keyset paginated: the cursor of the next page is the
+(date, id) of the last invoice of the previous one, so a page costs
+the same at any depth. The line items of a whole page are read with
+a single IN query.
+"""
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import select, tuple_
+from .catalog import IN_CHUNK_SIZE
+from .models import db, Invoice, Invoice_Product
+from .reports import date_bounds, parse_date
+from .utils import is_integer
+
+DEFAULT_PAGE_SIZE = 50
+# The invoice ids of a page fit in one IN (...) list.
+MAX_PAGE_SIZE = IN_CHUNK_SIZE
+
+INVOICE_COLUMNS = [Invoice.id, Invoice.date, Invoice.user_id, Invoice.total, Invoice.item_count]
+
+LINE_FIELDS = ["name", "weight", "price", "unit", "quantity"]
+
+
+def encode_cursor(date, invoice_id):
+    return "{},{}".format(date.isoformat(), invoice_id)
+
+
+def decode_cursor(cursor):
+    """
+    Return the (date, id) of a cursor, None if it is invalid.
+    """
+
+    try:
+        date, invoice_id = cursor.split(",")
+        return datetime.fromisoformat(date), int(invoice_id)
+    except ValueError:
+        return None
+
+
+def page_arguments(args):
+    """
+    Validate the from, to, cashier_id, cursor and limit arguments of
+    /invoices, return ((filters, cursor, limit), None) or (None, message).
+    """
+
+    filters = {}
+
+    for name, key in [("initial_date", "from"), ("final_date", "to")]:
+        if key in args:
+            filters[name] = parse_date(args[key])
+            if filters[name] is None:
+                return None, 'invalid value for {}, dates must be YYYY-MM-DD'.format(key)
+
+    if 'cashier_id' in args:
+        if not is_integer(args['cashier_id']):
+            return None, 'invalid value for cashier_id, must be an integer'
+        filters["cashier_id"] = int(args['cashier_id'])
+
+    cursor = None
+    if 'cursor' in args:
+        cursor = decode_cursor(args['cursor'])
+        if cursor is None:
+            return None, 'invalid value for cursor, use the next_cursor of the previous page'
+
+    limit = args.get('limit', str(DEFAULT_PAGE_SIZE))
+
+    if not is_integer(limit) or not 0 < int(limit) <= MAX_PAGE_SIZE:
+        return None, 'invalid value for limit, 0 < limit <= {}'.format(MAX_PAGE_SIZE)
+
+    return (filters, cursor, int(limit)), None
+
+
+def invoices_page_query(initial_date=None, final_date=None, cashier_id=None, cursor=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Select the invoices before the cursor, newest first. The filters
+    and the cursor are ranges of ix_invoice_date, or of
+    ix_invoice_user_id_date for a cashier, so the database never sorts.
+    """
+
+    query = select(*INVOICE_COLUMNS)
+
+    if initial_date is not None:
+        query = query.where(Invoice.date >= date_bounds(initial_date, initial_date)[0])
+
+    if final_date is not None:
+        query = query.where(Invoice.date < date_bounds(final_date, final_date)[1])
+
+    if cashier_id is not None:
+        query = query.where(Invoice.user_id == cashier_id)
+
+    if cursor is not None:
+        query = query.where(tuple_(Invoice.date, Invoice.id) < tuple_(*cursor))
+
+    return query.order_by(Invoice.date.desc(), Invoice.id.desc()).limit(limit)
+
+
+def line_items(invoice_ids):
+    """
+    Return {invoice id: [line]} for the given invoices, the lines
+    are dicts of LINE_FIELDS in the order they were sold.
+    """
+
+    rows = db.session.execute(
+        select(Invoice_Product.invoice_id, *[getattr(Invoice_Product, field) for field in LINE_FIELDS])
+        .where(Invoice_Product.invoice_id.in_(invoice_ids))
+        .order_by(Invoice_Product.invoice_id, Invoice_Product.id)).all()
+
+    lines = defaultdict(list)
+    for row in rows:
+        lines[row[0]].append(dict(zip(LINE_FIELDS, row[1:])))
+
+    return lines
+
+
+def invoice_data(row, lines):
+    invoice_id, date, cashier_id, total, item_count = row
+    return {"id": invoice_id, "date": date.isoformat(), "cashier_id": cashier_id,
+            "total": total, "item_count": item_count, "list_of_products": lines}
+
+
+def invoices_page(filters, cursor=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Return the invoices of a page with their line items, and the
+    cursor of the next page (None on the last page). Two queries
+    whatever the page size.
+    """
+
+    rows = db.session.execute(invoices_page_query(cursor=cursor, limit=limit, **filters)).all()
+
+    if not rows:
+        return [], None
+
+    lines = line_items([row[0] for row in rows])
+    page = [invoice_data(row, lines[row[0]]) for row in rows]
+
+    next_cursor = None
+    if len(rows) == limit:
+        next_cursor = encode_cursor(rows[-1][1], rows[-1][0])
+
+    return page, next_cursor
+
+
+def get_invoice(invoice_id, cashier_id=None):
+    """
+    Return an invoice with its line items, None if it doesn't
+    exist or (with a cashier_id) belongs to another cashier.
+    """
+
+    query = select(*INVOICE_COLUMNS).where(Invoice.id == invoice_id)
+
+    if cashier_id is not None:
+        query = query.where(Invoice.user_id == cashier_id)
+
+    row = db.session.execute(query).first()
+
+    if row is None:
+        return None
+
+    return invoice_data(row, line_items([row[0]])[row[0]])
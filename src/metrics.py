@@ -0,0 +1,196 @@
+"""
+Request and SQL metrics of the app in the Prometheus text format,
+served by /metrics. The latency, the number of SQL statements and
+the time spent in the database of every request are recorded per
+endpoint (the route rule, e.g. /add/<product_id>), so an N+1 query
+shows up as a growing statement count of its endpoint.
+
+The statements are counted with the cursor events of the engine
+and the requests with the before/after request hooks. Every
+process keeps its own metrics, with several workers Prometheus
+adds them up by instance.
+"""
+import threading
+import time
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from .models import db
+
+# Upper bounds of the histogram buckets.
+DURATION_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+STATEMENT_BUCKETS = [0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89]
+
+
+def format_labels(labels):
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return ",".join('{}="{}"'.format(name, value) for name, value in zip(labels, escaped))
+
+
+class Counter:
+
+    def __init__(self, name, description, labels):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def value(self, labels):
+        return self.values.get(labels, 0)
+
+    def render(self):
+
+        yield "# HELP {} {}".format(self.name, self.description)
+        yield "# TYPE {} counter".format(self.name)
+
+        for labels, value in sorted(self.values.items()):
+            yield "{}{{{}}} {}".format(self.name, format_labels(dict(zip(self.labels, labels))), value)
+
+
+class Histogram:
+    """
+    Cumulative histogram, the counts of a label set are kept per
+    bucket and summed on render.
+    """
+
+    def __init__(self, name, description, labels, buckets):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.counts = {}
+        self.sums = {}
+
+    def observe(self, labels, value):
+
+        counts = self.counts.setdefault(labels, [0] * (len(self.buckets) + 1))
+
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        else:
+            counts[-1] += 1
+
+        self.sums[labels] = self.sums.get(labels, 0) + value
+
+    def count(self, labels):
+        return sum(self.counts.get(labels, []))
+
+    def sum(self, labels):
+        return self.sums.get(labels, 0)
+
+    def render(self):
+
+        yield "# HELP {} {}".format(self.name, self.description)
+        yield "# TYPE {} histogram".format(self.name)
+
+        for labels, counts in sorted(self.counts.items()):
+
+            names = dict(zip(self.labels, labels))
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + ["+Inf"], counts):
+                cumulative += count
+                yield "{}_bucket{{{}}} {}".format(self.name, format_labels(dict(names, le=bound)), cumulative)
+
+            yield "{}_sum{{{}}} {}".format(self.name, format_labels(names), self.sums[labels])
+            yield "{}_count{{{}}} {}".format(self.name, format_labels(names), cumulative)
+
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = Counter("pos_http_requests_total",
+                                "Requests served per endpoint, method and status.",
+                                ["endpoint", "method", "status"])
+        self.duration = Histogram("pos_http_request_duration_seconds",
+                                  "Latency of the requests per endpoint.",
+                                  ["endpoint", "method"], DURATION_BUCKETS)
+        self.statements = Histogram("pos_sql_statements_per_request",
+                                    "SQL statements executed by each request per endpoint.",
+                                    ["endpoint", "method"], STATEMENT_BUCKETS)
+        self.db_time = Histogram("pos_db_duration_seconds",
+                                 "Time spent running SQL statements by each request per endpoint.",
+                                 ["endpoint", "method"], DURATION_BUCKETS)
+
+    def record(self, endpoint, method, status, duration, statements, db_time):
+
+        labels = (endpoint, method)
+
+        with self.lock:
+            self.requests.inc((endpoint, method, str(status)))
+            self.duration.observe(labels, duration)
+            self.statements.observe(labels, statements)
+            self.db_time.observe(labels, db_time)
+
+    def render(self):
+
+        with self.lock:
+            lines = [line for metric in [self.requests, self.duration, self.statements, self.db_time]
+                     for line in metric.render()]
+
+        return "\n".join(lines) + "\n"
+
+
+def init_app(app):
+    """
+    Attach the request hooks to the app and the cursor events
+    to its engine.
+    """
+
+    app.extensions["metrics"] = Metrics()
+    app.before_request(_start_request)
+    app.after_request(_record_request)
+
+    with app.app_context():
+        engine = db.engine
+
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _cursor_error)
+
+
+def metrics():
+    return current_app.extensions["metrics"]
+
+
+def endpoint_name():
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+def _start_request():
+    g.metrics_start = time.perf_counter()
+    g.sql_statements = 0
+    g.sql_time = 0.0
+
+
+def _record_request(response):
+
+    if "metrics_start" in g:
+        metrics().record(endpoint_name(), request.method, response.status_code,
+                         time.perf_counter() - g.metrics_start, g.sql_statements, g.sql_time)
+
+    return response
+
+
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+
+    elapsed = time.perf_counter() - connection.info["metrics_query_start"].pop()
+
+    if has_request_context() and "metrics_start" in g:
+        g.sql_statements += 1
+        g.sql_time += elapsed
+
+
+def _cursor_error(context):
+    # A failed statement never reaches after_cursor_execute.
+    if context.connection is not None and context.connection.info.get("metrics_query_start"):
+        context.connection.info["metrics_query_start"].pop()
@@ -0,0 +1,181 @@
+"""
+Versioned schema migrations, create_app runs upgrade() so an
+existing database picks up the changes of the models in place.
+
+A fresh database is built by create_all straight from the models
+and stamped with every migration. On an existing database create_all
+only adds the missing tables, then the migrations that are not in
+the schema_version table are applied in order, each one in its own
+transaction. New migrations are appended to MIGRATIONS with the
+next version number, never edit one that was already released.
+"""
+import click
+from collections import namedtuple
+from flask.cli import with_appcontext
+from sqlalchemy import inspect, text
+from .models import db, Schema_Version, Users
+
+Migration = namedtuple("Migration", ["version", "description", "upgrade"])
+
+
+def run_sql(*statements):
+    """
+    Migration step that runs the given SQL statements.
+    """
+
+    def upgrade(connection):
+        for statement in statements:
+            connection.execute(text(statement))
+
+    return upgrade
+
+
+def type_invoice_prices(connection):
+    """
+    Convert the price and weight of the invoice lines from text to
+    numbers. SQLite can't change the type of a column, the table is
+    rebuilt and the rows copied over with the converted values.
+    """
+
+    if connection.dialect.name != "sqlite":
+        run_sql(
+            "ALTER TABLE invoice_product"
+            " ALTER COLUMN weight TYPE FLOAT USING CAST(weight AS FLOAT),"
+            " ALTER COLUMN price TYPE INTEGER USING CAST(ROUND(CAST(price AS NUMERIC)) AS INTEGER)")(connection)
+        return
+
+    run_sql(
+        "DROP INDEX IF EXISTS ix_invoice_product_invoice_id",
+        "ALTER TABLE invoice_product RENAME TO invoice_product_text",
+        "CREATE TABLE invoice_product ("
+        " id INTEGER NOT NULL, name VARCHAR(50) NOT NULL, weight FLOAT NOT NULL, price INTEGER NOT NULL,"
+        " unit VARCHAR(3) NOT NULL, quantity INTEGER, invoice_id INTEGER,"
+        " PRIMARY KEY (id), FOREIGN KEY(invoice_id) REFERENCES invoice (id))",
+        "INSERT INTO invoice_product (id, name, weight, price, unit, quantity, invoice_id)"
+        " SELECT id, name, CAST(weight AS FLOAT), CAST(ROUND(CAST(price AS REAL)) AS INTEGER), unit, quantity, invoice_id"
+        " FROM invoice_product_text",
+        "DROP TABLE invoice_product_text",
+        "CREATE INDEX ix_invoice_product_invoice_id ON invoice_product (invoice_id)")(connection)
+
+
+def autoincrement_product_ids(connection):
+    """
+    Never reuse the id of a deleted product, its stock movements
+    would belong to the next product created. PostgreSQL sequences
+    never go back, SQLite needs AUTOINCREMENT and can't add it to a
+    table, so the table is rebuilt and its sequence starts after
+    every product id known. The ledger tails of the products
+    already deleted are closed.
+    """
+
+    if connection.dialect.name == "sqlite":
+        run_sql(
+            "CREATE TABLE product_autoincrement ("
+            " id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, name VARCHAR(100) NOT NULL,"
+            " price INTEGER NOT NULL, weight FLOAT NOT NULL, unit VARCHAR(3) NOT NULL, UNIQUE (name))",
+            "INSERT INTO product_autoincrement (id, name, price, weight, unit)"
+            " SELECT id, name, price, weight, unit FROM product",
+            "DROP TABLE product",
+            "ALTER TABLE product_autoincrement RENAME TO product",
+            "DELETE FROM sqlite_sequence WHERE name = 'product'",
+            "INSERT INTO sqlite_sequence (name, seq) SELECT 'product', COALESCE(MAX(id), 0) FROM ("
+            " SELECT id FROM product UNION ALL SELECT product_id FROM stock_movement"
+            " UNION ALL SELECT product_id FROM product_quantity)")(connection)
+
+    run_sql(
+        "UPDATE stock_movement SET compacted = TRUE"
+        " WHERE compacted = FALSE AND product_id NOT IN (SELECT id FROM product)")(connection)
+
+
+def add_catalog_nonce(connection):
+    """
+    Add the nonce of the Catalog_Version row. Databases older than
+    the product cache get the whole table from create_all, with
+    the column already.
+    """
+
+    if "nonce" not in [column["name"] for column in inspect(connection).get_columns("catalog_version")]:
+        run_sql("ALTER TABLE catalog_version ADD COLUMN nonce VARCHAR(32)")(connection)
+
+
+MIGRATIONS = [
+    Migration(1, "index the lookup columns", run_sql(
+        "CREATE INDEX IF NOT EXISTS ix_users_username ON users (username)",
+        "CREATE INDEX IF NOT EXISTS ix_users_public_id ON users (public_id)",
+        "CREATE INDEX IF NOT EXISTS ix_product_quantity_product_id ON product_quantity (product_id)",
+        "CREATE INDEX IF NOT EXISTS ix_invoice_date ON invoice (date)",
+        "CREATE INDEX IF NOT EXISTS ix_invoice_product_invoice_id ON invoice_product (invoice_id)",
+        "CREATE INDEX IF NOT EXISTS ix_currentinvoice_user_id ON currentinvoice (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_currentinvoice_product_currentinvoice_id ON currentinvoice_product (currentinvoice_id)",
+        "CREATE INDEX IF NOT EXISTS ix_currentinvoice_product_product_id ON currentinvoice_product (product_id)")),
+    Migration(2, "merge the current invoice lines of a product into a quantity", run_sql(
+        "ALTER TABLE currentinvoice_product ADD COLUMN quantity INTEGER NOT NULL DEFAULT 1",
+        "UPDATE currentinvoice_product SET quantity = ("
+        " SELECT COUNT(*) FROM currentinvoice_product AS line"
+        " WHERE line.currentinvoice_id = currentinvoice_product.currentinvoice_id"
+        " AND line.product_id = currentinvoice_product.product_id)",
+        "DELETE FROM currentinvoice_product WHERE id NOT IN ("
+        " SELECT MIN(id) FROM currentinvoice_product GROUP BY currentinvoice_id, product_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_currentinvoice_product ON currentinvoice_product (currentinvoice_id, product_id)")),
+    Migration(3, "index the invoice history of each cashier", run_sql(
+        "CREATE INDEX IF NOT EXISTS ix_invoice_user_id_date ON invoice (user_id, date, id)")),
+    Migration(4, "store the invoice line prices as numbers", type_invoice_prices),
+    Migration(5, "store the total and the item count of the invoices", run_sql(
+        "ALTER TABLE invoice ADD COLUMN total INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE invoice ADD COLUMN item_count INTEGER NOT NULL DEFAULT 0",
+        "UPDATE invoice SET"
+        " total = COALESCE((SELECT SUM(quantity * price) FROM invoice_product WHERE invoice_id = invoice.id), 0),"
+        " item_count = COALESCE((SELECT SUM(quantity) FROM invoice_product WHERE invoice_id = invoice.id), 0)")),
+    # A reused product id reads (and restocks) its first row, the one kept.
+    Migration(6, "drop the quantities left by deleted products", run_sql(
+        "DELETE FROM product_quantity WHERE product_id NOT IN (SELECT id FROM product)"
+        " OR id NOT IN (SELECT MIN(id) FROM product_quantity GROUP BY product_id)")),
+    Migration(7, "never reuse the id of a deleted product", autoincrement_product_ids),
+    Migration(8, "store the ETag nonce of the catalog", add_catalog_nonce),
+]
+
+
+def current_version():
+    return db.session.query(db.func.max(Schema_Version.version)).scalar() or 0
+
+
+def upgrade():
+    """
+    Bring the database of the current app up to the latest
+    migration, return the list of applied migration versions.
+    """
+
+    engine = db.engine
+    fresh = not inspect(engine).has_table(Users.__tablename__)
+
+    db.create_all()
+
+    applied = {version for (version,) in db.session.query(Schema_Version.version)}
+    db.session.remove()
+
+    upgraded = []
+    for migration in MIGRATIONS:
+
+        if migration.version in applied:
+            continue
+
+        with engine.begin() as connection:
+            if not fresh:
+                migration.upgrade(connection)
+            connection.execute(Schema_Version.__table__.insert().values(
+                version=migration.version, description=migration.description))
+
+        upgraded.append(migration.version)
+
+    return upgraded
+
+
+@click.command("upgrade-db")
+@with_appcontext
+def upgrade_db_command():
+    """
+    Apply the pending schema migrations.
+    """
+
+    upgraded = upgrade()
+    click.echo("Applied migrations: {}".format(upgraded or "none, the schema is up to date"))
@@ -3,42 +3,121 @@ from flask_sqlalchemy import SQLAlchemy
 
 db = SQLAlchemy()
 
+class Schema_Version(db.Model):
+    """
+    One row per migration of src/migrations.py applied
+    to the database.
+    """
+    __tablename__ = "schema_version"
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 class Users(db.Model):
     __tablename__ = "users"
     id = db.Column(db.Integer, primary_key=True)
-    public_id = db.Column(db.Integer)
-    username = db.Column(db.String(50))
-    password = db.Column(db.String(50))
+    public_id = db.Column(db.String(50), index=True)
+    username = db.Column(db.String(50), index=True)
+    password = db.Column(db.String(255))
     admin = db.Column(db.Boolean, default=False)
 
 class Product(db.Model):
+    """
+    The ids are never reused (AUTOINCREMENT on SQLite), the stock
+    movements of a deleted product keep pointing to it.
+    """
     __tablename__ = "product"
+    __table_args__ = {"sqlite_autoincrement": True}
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), unique=True, nullable=False)
     price = db.Column(db.Integer, nullable=False)
     weight = db.Column(db.Float, nullable=False)
     unit = db.Column(db.String(3), nullable=False)
 
+class Refresh_Token(db.Model):
+    """
+    Long lived token exchanged for new access tokens without
+    sending the password again, only its sha256 is stored.
+    """
+    __tablename__ = "refresh_token"
+    id = db.Column(db.Integer, primary_key=True)
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), index=True, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    revoked = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class Catalog_Version(db.Model):
+    """
+    Single row counter bumped in the same transaction as every
+    change to the products, each worker process compares it with
+    the version of its product cache to detect stale entries.
+    The nonce is drawn once per database and prefixes the ETag
+    of /products.
+    """
+    __tablename__ = "catalog_version"
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    nonce = db.Column(db.String(32))
+
+class Rollup_Version(db.Model):
+    """
+    Single row counter bumped by rebuild-rollups, the cached
+    reports of every worker belong to a version of the rollups.
+    """
+    __tablename__ = "rollup_version"
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
 class Product_Quantity(db.Model):
     """
-    TODO: Implement logic when creating products, and adding them to invoice.
-    Table to relate a product to its available quantity.
+    Snapshot of the stock of a product, the available quantity
+    is this snapshot plus the Stock_Movement rows that were not
+    compacted into it yet.
     """
     __tablename__ = "product_quantity"
     id = db.Column(db.Integer, primary_key=True)
     quantity = db.Column(db.Integer, default=0)
-    product_id = db.Column(db.Integer, db.ForeignKey("product.id"))
-    
+    product_id = db.Column(db.Integer, db.ForeignKey("product.id"), index=True)
+
+class Stock_Movement(db.Model):
+    """
+    Append-only ledger of the stock changes (restock, reserve,
+    sale, release). quantity is the number of products moved and
+    delta the change of the available stock, a sale doesn't change
+    it because its products were reserved when scanned. The rows
+    are only flagged once compacted into the snapshot, and they
+    outlive their product like the invoice lines.
+    """
+    __tablename__ = "stock_movement"
+    __table_args__ = (db.Index("ix_stock_movement_product_id", "product_id", "id"),
+                      db.Index("ix_stock_movement_tail", "product_id", "compacted", "delta",
+                               sqlite_where=db.text("compacted = 0"),
+                               postgresql_where=db.text("compacted = false")))
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String(10), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    delta = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    invoice_id = db.Column(db.Integer, db.ForeignKey("invoice.id"))
+    date = db.Column(db.DateTime, default=datetime.utcnow)
+    compacted = db.Column(db.Boolean, nullable=False, default=False)
+
 class Invoice(db.Model):
     """
     The invoice has a creation time and an user who
     created it, the products of an invoice is selected
-    from the invoice_product table.
+    from the invoice_product table. The total and the
+    number of items are stored when it is confirmed.
     """
     __tablename__ = "invoice"
+    __table_args__ = (db.Index("ix_invoice_user_id_date", "user_id", "date", "id"),)
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
-    date = db.Column(db.DateTime, default=datetime.utcnow().date())
+    date = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    item_count = db.Column(db.Integer, nullable=False, default=0)
 
 class Invoice_Product(db.Model):
     """
@@ -50,11 +129,27 @@ class Invoice_Product(db.Model):
     __tablename__ = "invoice_product"
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), nullable=False)
-    weight = db.Column(db.String(20), nullable=False)
-    price = db.Column(db.String(50), nullable=False)
+    weight = db.Column(db.Float, nullable=False)
+    price = db.Column(db.Integer, nullable=False)
     unit = db.Column(db.String(3), nullable=False)
     quantity = db.Column(db.Integer, default=1)
-    invoice_id = db.Column(db.Integer, db.ForeignKey("invoice.id"))
+    invoice_id = db.Column(db.Integer, db.ForeignKey("invoice.id"), index=True)
+
+class Daily_Sales(db.Model):
+    """
+    Sales rollup per day and per product, it is updated by
+    confirm_purchase in the same transaction as the invoice
+    so the report reads one row per (day, product) instead
+    of every invoice line. Products are identified by name
+    like in Invoice_Product.
+    """
+    __tablename__ = "daily_sales"
+    __table_args__ = (db.UniqueConstraint("day", "name"),)
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    name = db.Column(db.String(50), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Integer, nullable=False, default=0)
 
 class CurrentInvoice(db.Model):
     """
@@ -63,10 +158,33 @@ class CurrentInvoice(db.Model):
     """
     __tablename__ = "currentinvoice"
     id = db.Column(db.Integer, primary_key=True, nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), index=True)
 
 class CurrentInvoice_Product(db.Model):
+    """
+    A line of the current invoice, scanning the same product
+    again increments its quantity.
+    """
     __tablename__ = "currentinvoice_product"
+    __table_args__ = (db.Index("uq_currentinvoice_product", "currentinvoice_id", "product_id", unique=True),)
     id = db.Column(db.Integer, primary_key=True)
-    currentinvoice_id = db.Column(db.Integer, db.ForeignKey("currentinvoice.id"))
-    product_id = db.Column(db.Integer, db.ForeignKey("product.id"))
+    currentinvoice_id = db.Column(db.Integer, db.ForeignKey("currentinvoice.id"), index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey("product.id"), index=True)
+    quantity = db.Column(db.Integer, nullable=False, default=1)
+
+def upsert(model, dialect=None):
+    """
+    INSERT ... ON CONFLICT statement for the dialect in use (or
+    the given dialect name), both SQLite and PostgreSQL support
+    the same syntax.
+    """
+
+    if dialect is None:
+        dialect = db.engine.dialect.name
+
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+
+    return insert(model.__table__)
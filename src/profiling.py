@@ -0,0 +1,166 @@
+"""
+Opt-in profiler of the API views. A request is profiled when it is
+picked at random (PROFILE_SAMPLE_RATE of the requests, 0 disables
+it) or when it carries a valid x-profile header, a signed token
+that admins get from /profile/token.
+
+PROFILE_MODE selects the collector: "sample" reads the stack of the
+request thread every PROFILE_INTERVAL seconds (low overhead, can stay
+on in production) and writes it in the collapsed stack format used by
+flamegraph.pl and speedscope, "cprofile" traces every call and writes
+a pstats file. The profiles are written to PROFILE_DIR, one file per
+request.
+"""
+import cProfile
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from functools import wraps
+from flask import current_app, request
+from itsdangerous import BadSignature, TimestampSigner
+
+MODES = ["sample", "cprofile"]
+
+HEADER = "x-profile"
+
+
+class StackSampler:
+    """
+    Count the stacks of a thread sampled every interval seconds
+    from a background thread.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapse(frame)] += 1
+
+    def write(self, path):
+        with open(path, "w") as output:
+            for stack, count in self.stacks.most_common():
+                output.write("{} {}\n".format(stack, count))
+
+
+def collapse(frame):
+    """
+    Return the stack of a frame as root;...;leaf.
+    """
+
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+
+    return ";".join(reversed(names))
+
+
+def signer():
+    return TimestampSigner(current_app.config["SECRET_KEY"], salt="profile")
+
+
+def issue_token():
+    return signer().sign(uuid.uuid4().hex).decode()
+
+
+def valid_token(token):
+    """
+    A token is valid for PROFILE_TOKEN_MAX_AGE seconds.
+    """
+
+    try:
+        signer().unsign(token, max_age=current_app.config["PROFILE_TOKEN_MAX_AGE"])
+    except BadSignature:
+        return False
+
+    return True
+
+
+def should_profile():
+
+    token = request.headers.get(HEADER)
+
+    if token is not None:
+        return valid_token(token)
+
+    rate = current_app.config["PROFILE_SAMPLE_RATE"]
+
+    return rate > 0 and random.random() < rate
+
+
+def profile_path(elapsed, extension):
+
+    endpoint = re.sub(r"[^A-Za-z0-9]+", "_", request.url_rule.rule if request.url_rule else request.path).strip("_")
+    name = "{}-{}-{}-{:.0f}ms-{}.{}".format(time.strftime("%Y%m%d%H%M%S"), request.method, endpoint or "root",
+                                           elapsed * 1000, uuid.uuid4().hex[:8], extension)
+
+    return os.path.join(current_app.config["PROFILE_DIR"], name)
+
+
+def run_profiled(view, args, kwargs):
+
+    os.makedirs(current_app.config["PROFILE_DIR"], exist_ok=True)
+
+    mode = current_app.config["PROFILE_MODE"]
+    start = time.perf_counter()
+
+    if mode == "cprofile":
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(view, *args, **kwargs)
+        finally:
+            profiler.dump_stats(profile_path(time.perf_counter() - start, "prof"))
+
+    sampler = StackSampler(threading.get_ident(), current_app.config["PROFILE_INTERVAL"])
+    sampler.start()
+    try:
+        return view(*args, **kwargs)
+    finally:
+        sampler.stop()
+        sampler.write(profile_path(time.perf_counter() - start, "folded"))
+
+
+def profiled(view):
+    @wraps(view)
+    def decorated(*args, **kwargs):
+
+        if not should_profile():
+            return view(*args, **kwargs)
+
+        return run_profiled(view, args, kwargs)
+
+    return decorated
+
+
+def init_app(app, blueprint):
+    """
+    Wrap the views of the blueprint, must run after the blueprint
+    is registered.
+    """
+
+    if app.config["PROFILE_MODE"] not in MODES:
+        raise ValueError("invalid PROFILE_MODE, must be {}".format(", ".join(MODES)))
+
+    for endpoint, view in app.view_functions.items():
+        if endpoint.startswith(blueprint.name + "."):
+            app.view_functions[endpoint] = profiled(view)
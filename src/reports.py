@@ -0,0 +1,306 @@
+"""
+Sales report engine, the totals are computed by the database
+with a single aggregated query instead of walking every invoice
+in Python, either over the Daily_Sales rollups, over the totals
+stored on each invoice or over invoice JOIN invoice_product
+GROUP BY <dimension>.
+
+The rows of each (from, to, group_by) are kept in the report cache,
+the sales of the days before today never change so those ranges are
+only computed once, until rebuild-rollups recomputes the rollups.
+"""
+import calendar
+import json
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from .cache import TTLCache
+from .models import db, Invoice, Invoice_Product, Daily_Sales, Rollup_Version
+from .utils import columns
+
+# Each dimension maps to the key of the report where its rows are
+# stored and to the SQL expression the rows are grouped by.
+GROUP_BY = {
+    "product": ("products", lambda: Invoice_Product.name),
+    "day": ("days", lambda: db.func.date(Invoice.date)),
+    "cashier": ("cashiers", lambda: Invoice.user_id),
+}
+
+# Dimensions that can be answered from the Daily_Sales rollups.
+ROLLUP_GROUP_BY = {
+    "product": lambda: Daily_Sales.name,
+    "day": lambda: Daily_Sales.day,
+}
+
+# Dimensions of the invoice itself, summed from Invoice.total and
+# Invoice.item_count without reading the invoice lines.
+INVOICE_GROUP_BY = ["day", "cashier"]
+
+DEFAULT_GROUP_BY = "product"
+
+
+def parse_date(value):
+    """
+    Parse a 'YYYY-MM-DD' string (a full timestamp is truncated
+    to its day), return None if the value is not a valid date.
+    """
+
+    try:
+        return datetime.strptime(str(value)[:10], "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+
+def date_bounds(initial_date, final_date):
+    """
+    Convert an inclusive [from, to] day interval into the half open
+    datetime interval [from 00:00, to + 1 day 00:00) used to filter
+    Invoice.date, so the whole last day is part of the report.
+    """
+
+    start = datetime.combine(initial_date, datetime.min.time())
+    end = datetime.combine(final_date + timedelta(days=1), datetime.min.time())
+
+    return start, end
+
+
+def sales_totals(initial_date, final_date, group_by=DEFAULT_GROUP_BY):
+    """
+    Return a list of (key, quantity, total_price) tuples with the sales
+    between the two dates grouped by the given dimension. Product and
+    day totals are read from the Daily_Sales rollups, the rollups have
+    no cashier so that grouping sums the totals of the invoices.
+    """
+
+    if group_by in ROLLUP_GROUP_BY:
+        return rollup_totals(initial_date, final_date, group_by)
+
+    return invoice_totals(initial_date, final_date, group_by)
+
+
+def rollup_totals(initial_date, final_date, group_by):
+    """
+    Aggregate the Daily_Sales rows between the two (inclusive) days.
+    """
+
+    key = ROLLUP_GROUP_BY[group_by]()
+
+    rows = db.session.query(key, db.func.sum(Daily_Sales.quantity), db.func.sum(Daily_Sales.revenue))\
+        .filter(Daily_Sales.day >= initial_date, Daily_Sales.day <= final_date)\
+        .group_by(key)\
+        .order_by(key)\
+        .all()
+
+    return rows
+
+
+def invoice_totals(initial_date, final_date, group_by):
+    """
+    Aggregate the invoices between the two days. The dimensions of
+    the invoice itself sum the totals stored on each invoice, the
+    product dimension needs the invoice lines.
+    """
+
+    _, key_expression = GROUP_BY[group_by]
+    key = key_expression()
+    start, end = date_bounds(initial_date, final_date)
+
+    if group_by in INVOICE_GROUP_BY:
+        query = db.session.query(key, db.func.sum(Invoice.item_count), db.func.sum(Invoice.total))
+    else:
+        query = db.session.query(key,
+                                 db.func.sum(Invoice_Product.quantity),
+                                 db.func.sum(Invoice_Product.quantity * Invoice_Product.price))\
+            .join(Invoice, Invoice.id == Invoice_Product.invoice_id)
+
+    rows = query.filter(Invoice.date >= start, Invoice.date < end)\
+        .group_by(key)\
+        .order_by(key)\
+        .all()
+
+    return rows
+
+
+def build_report(initial_date, final_date, group_by=DEFAULT_GROUP_BY, compact=False):
+    """
+    Build the /report response body. The default (product) grouping
+    keeps the historical shape:
+
+    {"date": {"from", "to"}, "total_profits", "products": {name: {"quantity", "total_price"}}}
+
+    other groupings store their rows under "days" or "cashiers".
+    The compact shape stores the rows as columns instead:
+
+    {..., "products": {"key": [name, ...], "quantity": [...], "total_price": [...]}}
+    """
+
+    report_key, _ = GROUP_BY[group_by]
+    rows = report_rows(initial_date, final_date, group_by)
+
+    report = {}
+    report["date"] = {"from": initial_date.isoformat(), "to": final_date.isoformat()}
+    report["total_profits"] = sum(total_price for _, _, total_price in rows)
+
+    if compact:
+        report[report_key] = columns(["key", "quantity", "total_price"], rows)
+    else:
+        report[report_key] = {key: {"quantity": quantity, "total_price": total_price}
+                              for key, quantity, total_price in rows}
+
+    return report
+
+
+def report_rows(initial_date, final_date, group_by=DEFAULT_GROUP_BY):
+    """
+    Return the (key, quantity, total_price) rows of sales_totals
+    as strings and integers, from the report cache if possible.
+    """
+
+    cache = report_cache()
+    key = (cache.sync(), initial_date.isoformat(), final_date.isoformat(), group_by)
+    rows = cache.get(key)
+
+    if rows is None:
+        rows = [(str(key), int(quantity or 0), int(total_price or 0))
+                for key, quantity, total_price in sales_totals(initial_date, final_date, group_by)]
+        cache.set(key, rows, closed=cache.closed(final_date))
+
+    return rows
+
+
+class ReportCache:
+    """
+    Report rows per (from, to, group_by), bounded to maxsize ranges.
+
+    Ranges that end before today are closed, they are kept until they
+    are evicted and are written to path (if any) to survive restarts.
+    A day is only closed close_delay seconds after its midnight, a
+    purchase dated before midnight can commit a bit later. The other
+    ranges are open: confirm_purchase drops them from the cache of
+    its process, and they expire after open_ttl seconds (or at
+    midnight) for the purchases confirmed by other workers.
+
+    Every range belongs to a version of the rollups (the Rollup_Version
+    row, read again at most every open_ttl seconds), a rebuild-rollups
+    run by any process drops the ranges of every worker and of the file.
+    """
+
+    def __init__(self, maxsize, open_ttl, path=None, close_delay=0):
+        self.entries = TTLCache(maxsize)
+        self.open_ttl = open_ttl
+        self.path = path
+        self.close_delay = close_delay
+        self.version = None
+        self.synced_at = None
+        self.file_lock = threading.Lock()
+
+        if path is not None:
+            self.load()
+
+    def sync(self):
+        """
+        Return the version of the rollups, the ranges of another
+        version are dropped.
+        """
+
+        now = time.monotonic()
+
+        if self.synced_at is not None and now - self.synced_at < self.open_ttl:
+            return self.version
+
+        version = rollup_version()
+        self.synced_at = now
+
+        if version != self.version:
+            self.version = version
+            self.entries.clear()
+
+        return version
+
+    def closed(self, final_date):
+        return final_date < (datetime.utcnow() - timedelta(seconds=self.close_delay)).date()
+
+    def get(self, key):
+
+        entry = self.entries.get(key)
+
+        return None if entry is None else entry[1]
+
+    def set(self, key, rows, closed):
+
+        if closed:
+            self.entries.set(key, (False, rows), math.inf)
+            self.save()
+            return
+
+        midnight = calendar.timegm((datetime.utcnow().date() + timedelta(days=1)).timetuple())
+        self.entries.set(key, (True, rows), min(time.time() + self.open_ttl, midnight))
+
+    def purchase_confirmed(self):
+        self.entries.discard(lambda entry: entry[0])
+
+    def clear(self):
+
+        self.entries.clear()
+
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def stats(self):
+        return self.entries.stats()
+
+    def load(self):
+        """
+        Read the closed ranges of path and the version of the
+        rollups they belong to, a missing or unreadable file
+        leaves the cache empty.
+        """
+
+        try:
+            with open(self.path) as source:
+                saved = json.load(source)
+        except (OSError, ValueError):
+            return
+
+        if not isinstance(saved, dict):
+            return
+
+        self.version = saved["version"]
+
+        for key, rows in saved["ranges"]:
+            self.entries.set(tuple(key), (False, rows), math.inf)
+
+    def save(self):
+        """
+        Write the closed ranges to path, the file is replaced
+        atomically so a reader never sees a partial file.
+        """
+
+        if self.path is None:
+            return
+
+        closed = [[key, entry[1]] for key, entry in self.entries.items() if not entry[0]]
+        temporary = "{}.{}".format(self.path, os.getpid())
+
+        with self.file_lock:
+            with open(temporary, "w") as output:
+                json.dump({"version": self.version, "ranges": closed}, output)
+            os.replace(temporary, self.path)
+
+
+def init_app(app):
+    app.extensions["report_cache"] = ReportCache(app.config["REPORT_CACHE_SIZE"],
+                                                 app.config["REPORT_CACHE_OPEN_TTL"],
+                                                 app.config["REPORT_CACHE_FILE"],
+                                                 app.config["REPORT_CACHE_CLOSE_DELAY"])
+
+
+def report_cache():
+    return current_app.extensions["report_cache"]
+
+
+def rollup_version():
+    return db.session.query(Rollup_Version.version).filter_by(id=1).scalar() or 0
@@ -0,0 +1,97 @@
+"""
+Daily sales rollups, one Daily_Sales row per (day, product)
+holding the sold quantity and the revenue. confirm_purchase
+keeps them up to date and the rebuild-rollups command
+backfills them from the invoice and invoice_product tables.
+"""
+import click
+from flask.cli import with_appcontext
+from .models import db, upsert, Invoice, Invoice_Product, Daily_Sales, Rollup_Version
+from .reports import report_cache
+
+
+def record_sales_statement(dialect=None):
+    """
+    Executemany upsert adding sales rows to their rollup.
+    """
+
+    table = Daily_Sales.__table__
+    stmt = upsert(Daily_Sales, dialect)
+
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.day, table.c.name],
+        set_={"quantity": table.c.quantity + stmt.excluded.quantity,
+              "revenue": table.c.revenue + stmt.excluded.revenue})
+
+
+def sales_rows(day, lines):
+    return [{"day": day, "name": name, "quantity": quantity, "revenue": revenue}
+            for name, quantity, revenue in lines]
+
+
+def record_sales(day, lines):
+    """
+    Add the (name, quantity, revenue) lines of an invoice to the
+    rollup of the given day with a single executemany upsert, the
+    caller owns the transaction.
+    """
+
+    rows = sales_rows(day, lines)
+
+    if not rows:
+        return
+
+    db.session.execute(record_sales_statement(), rows)
+
+
+def bump_rollup_version():
+    """
+    Increment the Rollup_Version row inside the caller transaction,
+    every worker then drops its cached reports.
+    """
+
+    table = Rollup_Version.__table__
+    stmt = upsert(Rollup_Version).values(id=1, version=1)
+    stmt = stmt.on_conflict_do_update(index_elements=[table.c.id],
+                                      set_={"version": table.c.version + 1})
+
+    db.session.execute(stmt)
+
+
+def rebuild_rollups():
+    """
+    Recompute every rollup row from the invoices with one
+    INSERT ... SELECT ... GROUP BY, return the number of rows.
+    The cached reports of every process (and their file) are
+    dropped through the rollup version.
+    """
+
+    day = db.func.date(Invoice.date)
+    select = db.session.query(day,
+                              Invoice_Product.name,
+                              db.func.sum(Invoice_Product.quantity),
+                              db.func.sum(Invoice_Product.quantity * Invoice_Product.price))\
+        .join(Invoice, Invoice.id == Invoice_Product.invoice_id)\
+        .group_by(day, Invoice_Product.name)
+
+    table = Daily_Sales.__table__
+
+    db.session.execute(table.delete())
+    db.session.execute(table.insert().from_select(
+        [table.c.day, table.c.name, table.c.quantity, table.c.revenue], select.subquery().select()))
+    bump_rollup_version()
+    db.session.commit()
+    report_cache().clear()
+
+    return Daily_Sales.query.count()
+
+
+@click.command("rebuild-rollups")
+@with_appcontext
+def rebuild_rollups_command():
+    """
+    Backfill the daily sales rollups from the existing invoices.
+    """
+
+    count = rebuild_rollups()
+    click.echo("Rebuilt {} daily sales rollup rows.".format(count))
@@ -1,16 +1,16 @@
-from queue import Empty
-from flask import request, jsonify, Blueprint, current_app
+from flask import request, jsonify, make_response, Blueprint, Response, current_app, stream_with_context
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
 from .models import *
-from . import http_status
+from . import http_status, auth, cart, catalog, exports, imports, invoices, metrics, profiling, reports, rollups, stock
+from .reports import parse_date
 from .utils import *
 import uuid
-import jwt
-import datetime
 
 main = Blueprint("main", __name__)
 
+MAX_RESTOCK_ITEMS = 5000
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -24,8 +24,7 @@ def token_required(f):
             return jsonify({'message': 'a valid token is missing'}), http_status.UNAUTHORIZED
 
         try:
-            data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms="HS256")
-            current_user = Users.query.filter_by(public_id=data['public_id']).first()
+            current_user = auth.authenticate(token)
         except Exception as e:
             print("Exception: ", e)
             return jsonify({'message': 'token is invalid'}), http_status.UNAUTHORIZED
@@ -45,7 +44,7 @@ def signup_user():
     """
     Register a new user, if the username already existis in DB it fails,
     if not it creates the new user and stores its password hashed with
-    sha256.
+    PASSWORD_HASH_METHOD (sha256 by default).
 
     Also, if admin key is given, and it is correct, creates an admin user.
     """
@@ -61,7 +60,7 @@ def signup_user():
         return jsonify({'message': 'user already exists'}), http_status.CONFLICT
     
 
-    hashed_password = generate_password_hash(data['password'], method='sha256')
+    hashed_password = generate_password_hash(data['password'], method=current_app.config['PASSWORD_HASH_METHOD'])
 
     is_admin = False
     if 'admin_key' in data and data['admin_key'] == current_app.config['ADMIN_KEY']:
@@ -85,25 +84,68 @@ def login_user():
     """
     Sign in as a registered user, if the user doesn't exists or the
     password doesn't match, fail, else create a JWT and return the token
-    to be used by other methods.
+    to be used by other methods, along with a refresh token for /token/refresh.
     """
  
-    auth = request.authorization
+    authorization = request.authorization
 
-    if not auth or not auth.username or not auth.password:
+    if not authorization or not authorization.username or not authorization.password:
         return jsonify({'message': 'authorization resquest data not found'}), http_status.FORBIDDEN
 
-    user = Users.query.filter_by(username=auth.username).first()
+    user = Users.query.filter_by(username=authorization.username).first()
         
-    if user is not None and check_password_hash(user.password, auth.password):
-        token = jwt.encode({'public_id': user.public_id, 'exp' :\
-                datetime.datetime.utcnow() + datetime.timedelta(minutes=15)}, current_app.config['SECRET_KEY'])
+    if user is not None and check_password_hash(user.password, authorization.password):
+        token = auth.encode_token(user.public_id)
+        refresh_token = auth.issue_refresh_token(user.id)
+
+        db.session.commit()
 
-        return jsonify({'token' : token})
+        return jsonify({'token' : token, 'refresh_token': refresh_token})
 
     return jsonify({'message': 'invalid username or password'}), http_status.UNAUTHORIZED
 
 
+@main.route('/token/refresh', methods=['POST'])
+def refresh_access_token():
+    """
+    Exchange a refresh token (given by /login) for a new access
+    token, no password is checked so it is cheap to call every
+    time the access token expires.
+    """
+
+    data = request.get_json()
+
+    if not isinstance(data, dict) or not isinstance(data.get('refresh_token'), str):
+        return jsonify({'message': 'refresh token not found'}), http_status.FORBIDDEN
+
+    public_id = auth.refresh_token_owner(data['refresh_token'])
+
+    if public_id is None:
+        return jsonify({'message': 'refresh token is invalid'}), http_status.UNAUTHORIZED
+
+    return jsonify({'token' : auth.encode_token(public_id)})
+
+
+@main.route('/token/revoke', methods=['POST'])
+def revoke_refresh_token():
+    """
+    Revoke a refresh token (e.g. on logout or a lost terminal),
+    it can't be exchanged for access tokens anymore.
+    """
+
+    data = request.get_json()
+
+    if not isinstance(data, dict) or not isinstance(data.get('refresh_token'), str):
+        return jsonify({'message': 'refresh token not found'}), http_status.FORBIDDEN
+
+    if not auth.revoke_refresh_token(data['refresh_token']):
+        return jsonify({'message': 'refresh token does not exist'}), http_status.NOTFOUND
+
+    db.session.commit()
+
+    return jsonify({'message': 'refresh token revoked'})
+
+
 @main.route('/product/create', methods=['POST', 'GET'])
 @token_required
 def create_product(current_user):
@@ -122,35 +164,12 @@ def create_product(current_user):
     if product is not None:
         return jsonify({'message': 'product already exists'}), http_status.CONFLICT
     
-    _name = data['name']
-    if len(_name) < 3 or len(_name) > 100 or len(_name) == 0 or not _name.replace(' ', '').isalpha():
-        return jsonify({'message': 'invalid name for product'}), http_status.FORBIDDEN
-    
-    if not data['price'].isnumeric():
-        return jsonify({'message': 'invalid value for price, must be an integer'}), http_status.FORBIDDEN
-    
-    _price = int(data['price'])
-
-    if _price <= 0 or _price > 10**6:
-        return jsonify({'message': 'invalid value for price, 0 < price <= 1000000'}), http_status.FORBIDDEN
-    
-    if not is_float(data['weight']):
-        return jsonify({'message': 'invalid value for weight, must be a float'}), http_status.FORBIDDEN
-
-    _weight = float(data['weight'])
-
-    if _weight <= 0 or _weight >= 1000:
-        return jsonify({'message': 'invalid value for weight, 0 < weight < 1000'}), http_status.FORBIDDEN
+    values, message = validate_product(data)
 
-    _unit = data['unit']
+    if values is None:
+        return jsonify({'message': message}), http_status.FORBIDDEN
 
-    if not _unit.isalpha() or _unit not in ['mg', 'g', 'kg']:
-        return jsonify({'message': 'invalid value for unit, must be mg, g or kg'}), http_status.FORBIDDEN
-
-    new_product = Product(name=_name,
-                          price=_price,
-                          weight=_weight,
-                          unit=_unit)
+    new_product = Product(**values)
     
     db.session.add(new_product)
 
@@ -159,8 +178,11 @@ def create_product(current_user):
     new_product_quantity = Product_Quantity(product_id=new_product.id)
 
     db.session.add(new_product_quantity)
+
+    catalog.bump_shared_version()
     
     db.session.commit()
+    catalog.products_changed()
 
     return jsonify({'message' : 'new product created'})
 
@@ -176,49 +198,174 @@ def add_product(current_user):
         return jsonify({'message': 'admin required for this action'}), http_status.UNAUTHORIZED
     
     data = request.get_json()
-    product = Product.query.filter_by(name=data['name']).first()
+    product = catalog.get_product_by_name(data['name'])
 
     if product is None:
         return jsonify({'message': 'product does not exist'}), http_status.NOTFOUND
     
-    if not data['quantity'].isnumeric():
+    if not is_integer(str(data['quantity'])):
         return jsonify({'message': 'invalid value for quantity'}), http_status.FORBIDDEN
 
-    product_quantity = Product_Quantity.query.filter_by(product_id=product.id).first()
-
-    product_quantity.quantity += int(data['quantity'])
+    stock.restock({product.id: int(data['quantity'])}, current_user.id)
 
     db.session.commit()
 
     return jsonify({'message' : 'new product quantity added'})
 
+@main.route('/product/restock', methods=['POST'])
+@token_required
+def restock_products(current_user):
+    """
+    Sum the available quantity of many products at once, the body
+    is {"items": [{"name" or "id": ..., "quantity": ...}, ...]}.
+    Every item is validated before anything is written, if one of
+    them fails nothing is applied. The increments are applied in
+    a single transaction and the response has a result per item.
+    Must be an admin.
+    """
+
+    if not current_user.admin:
+        return jsonify({'message': 'admin required for this action'}), http_status.UNAUTHORIZED
+
+    data = request.get_json()
+    items = data.get('items') if isinstance(data, dict) else None
+
+    if not isinstance(items, list) or len(items) == 0 or len(items) > MAX_RESTOCK_ITEMS:
+        return jsonify({'message': 'invalid value for items, must be a list of 1 to {} items'.format(MAX_RESTOCK_ITEMS)}), http_status.FORBIDDEN
+
+    for item in items:
+        if isinstance(item, dict) and 'id' in item and is_integer(str(item['id'])):
+            item['id'] = int(item['id'])
+
+    ids = [item['id'] for item in items if isinstance(item, dict) and isinstance(item.get('id'), int)]
+    names = [item['name'] for item in items if isinstance(item, dict) and isinstance(item.get('name'), str)]
+    by_id, by_name = catalog.product_ids(ids, names)
+
+    results = []
+    increments = {}
+    status = http_status.OK
+
+    for item in items:
+
+        result = {'status': 'ok'}
+        results.append(result)
+
+        if isinstance(item, dict) and isinstance(item.get('id'), int):
+            result['id'] = item['id']
+            product_id = item['id'] if item['id'] in by_id else None
+        elif isinstance(item, dict) and isinstance(item.get('name'), str):
+            result['name'] = item['name']
+            product_id = by_name.get(item['name'])
+        else:
+            result['status'] = 'invalid item, must have a name or an id'
+            status = http_status.FORBIDDEN
+            continue
+
+        quantity = str(item.get('quantity', ''))
+        result['quantity'] = quantity
+
+        if not is_integer(quantity):
+            result['status'] = 'invalid value for quantity'
+            status = http_status.FORBIDDEN
+            continue
+
+        if product_id is None:
+            result['status'] = 'product does not exist'
+            if status == http_status.OK:
+                status = http_status.NOTFOUND
+            continue
+
+        increments[product_id] = increments.get(product_id, 0) + int(quantity)
+
+    if status != http_status.OK:
+        return jsonify({'message': 'no product quantity added', 'results': results}), status
+
+    stock.restock(increments, current_user.id)
+
+    db.session.commit()
+
+    return jsonify({'message' : 'new product quantities added', 'results': results})
+
+@main.route('/product/import', methods=['POST'])
+@token_required
+def import_products(current_user):
+    """
+    Create many products from a CSV (name,price,weight,unit header)
+    or NDJSON body, the format is taken from '?format=csv|ndjson' or
+    from the Content-Type. The body is streamed and inserted in
+    batches, products that already exist or don't pass the same
+    validation as /product/create are reported as rejected rows.
+    Must be an admin.
+    """
+
+    if not current_user.admin:
+        return jsonify({'message': 'admin required for this action'}), http_status.UNAUTHORIZED
+
+    file_format = imports.detect_format(request.args.get('format'), request.mimetype)
+
+    if file_format is None:
+        return jsonify({'message': 'invalid format, must be {}'.format(' or '.join(imports.FORMATS))}), http_status.FORBIDDEN
+
+    summary = imports.import_products(imports.read_rows(request.stream, file_format))
+
+    return jsonify(dict(summary, message='products imported'))
+
 @main.route('/products', methods=['GET'])
 @token_required
 def get_products(current_user):
     """
-    Get a json with all the products in DB (product list).
+    Get a json with the products in DB (product list), ordered by id.
+
+    The list is paginated by id: '?after_id=' is the last id of the
+    previous page (next_after_id in the response, null on the last page)
+    and '?limit=' the page size. '?fields=id,name,...' selects the keys
+    of each product. The response carries the catalog version and the
+    last stock movement as ETag, if it matches If-None-Match only those
+    are queried.
+
+    '?compact=1' gives the list as columns, {field: [values]}, instead
+    of one object per product, the keys aren't repeated on every item.
     """
 
-    products = Product.query.filter_by().all()
+    compact = request.args.get('compact', '').lower() in ['1', 'true']
+    etag = catalog.products_etag()
 
-    output = []
-    for product in products:
+    if compact:
+        etag += '-compact'
 
-        product_quantity = Product_Quantity.query.filter_by(product_id=product.id).first()
+    # Compressed responses carry the ETag as weak.
+    if request.if_none_match.contains_weak(etag):
+        response = make_response('', http_status.NOTMODIFIED)
+        response.set_etag(etag)
+        return response
 
-        if product_quantity is None:
-            return jsonify({'message' : 'no quantity found for {}'.format(product.name)}), http_status.NOTFOUND
+    arguments, message = catalog.page_arguments(request.args)
 
-        product_data = {}
-        product_data['id'] = product.id
-        product_data['name'] = product.name
-        product_data['weight'] = product.weight
-        product_data['price'] = product.price
-        product_data['unit'] = product.unit
-        product_data['quantity'] = product_quantity.quantity
-        output.append(product_data)
+    if arguments is None:
+        return jsonify({'message': message}), http_status.FORBIDDEN
+
+    fields, after_id, limit = arguments
+    rows = catalog.products_page(fields, after_id, limit)
+
+    if 'quantity' in fields:
+        quantity = fields.index('quantity')
+        for product_id, values in rows:
+            if values[quantity] is None:
+                return jsonify({'message' : 'no quantity found for product {}'.format(product_id)}), http_status.NOTFOUND
+
+    if compact:
+        output = columns(fields, [values for _, values in rows])
+    else:
+        output = [dict(zip(fields, values)) for _, values in rows]
+
+    next_after_id = None
+    if len(rows) == limit:
+        next_after_id = rows[-1][0]
 
-    return jsonify({'list_of_products' : output})
+    response = jsonify({'list_of_products' : output, 'next_after_id': next_after_id})
+    response.set_etag(etag)
+
+    return response
 
 
 @main.route('/products/<product_id>', methods=['DELETE'])
@@ -228,7 +375,8 @@ def delete_product(current_user, product_id):
     Remove a product from the DB, if the product id is not 
     found at the DB or the user is not an admin, fail, else 
     remove the product from the DB (this is why its important
-    to store the product info for each invoice).
+    to store the product info for each invoice) along with
+    its quantity, its stock movements are kept as history.
     """
 
     if not current_user.admin:
@@ -245,52 +393,96 @@ def delete_product(current_user, product_id):
     if current_product is not None:
         return jsonify({'message': 'cannot delete a product while in current invoice'}), http_status.FORBIDDEN
 
+    Product_Quantity.query.filter_by(product_id=product.id).delete()
+    stock.close(product.id)
     db.session.delete(product)
+    catalog.bump_shared_version()
     db.session.commit()
+    catalog.products_changed()
 
     return jsonify({'message': 'Product deleted'})
 
+@main.route('/products/<int:product_id>/movements', methods=['GET'])
+@token_required
+def get_stock_movements(current_user, product_id):
+    """
+    Get the stock movements (restock, reserve, sale, release) of a
+    product, oldest first, with its available quantity (null once the
+    product is deleted). Paginated by id like /products with '?after_id='
+    and '?limit='. Must be an admin.
+    """
+
+    if not current_user.admin:
+        return jsonify({'message': 'admin required for this action'}), http_status.UNAUTHORIZED
+
+    after_id = request.args.get('after_id', '0')
+    limit = request.args.get('limit', str(stock.DEFAULT_PAGE_SIZE))
+
+    if not is_integer(after_id) or not is_integer(limit) or not 0 < int(limit) <= stock.MAX_PAGE_SIZE:
+        return jsonify({'message': 'invalid value for after_id or limit, 0 < limit <= {}'.format(stock.MAX_PAGE_SIZE)}), http_status.FORBIDDEN
+
+    movements = stock.movements_page(product_id, int(after_id), int(limit))
+
+    next_after_id = None
+    if len(movements) == int(limit):
+        next_after_id = movements[-1].id
+
+    output = [{'id': movement.id, 'kind': movement.kind, 'quantity': movement.quantity, 'delta': movement.delta,
+               'user_id': movement.user_id, 'invoice_id': movement.invoice_id, 'date': movement.date.isoformat()}
+              for movement in movements]
+
+    return jsonify({'available': stock.available(product_id), 'movements': output, 'next_after_id': next_after_id})
+
 @main.route('/add/<product_id>', methods=['POST', 'GET'])
 @token_required
 def add_to_invoice(current_user, product_id):
     """
     Add (or scan) a product by its id to an invoice,
     the invoice will be a temporary one until its confirmed
-    by the confirm_purchase function. The product quantity
-    doesn't matter in this representation, just add as many 
-    repeated products as neeeded.
+    by the confirm_purchase function. Scanning a product that
+    is already in the invoice increments its quantity.
+
+    The stock is reserved with a conditional insert into the stock
+    ledger, the scan is retried while the database is busy with
+    other cashiers.
     """
 
-    product = Product.query.filter_by(id=product_id).first()
+    product = catalog.get_product(product_id)
 
     if product is None:
        return jsonify({'message': 'product does not exist'}), http_status.NOTFOUND
     
-    product_quantity = Product_Quantity.query.filter_by(product_id=product_id).first()
+    def scan():
 
-    if product_quantity is None:
-        return jsonify({'message': 'product quantity not found'}), http_status.NOTFOUND
-    
-    if product_quantity.quantity <= 0:
-        return jsonify({'message': 'not enough products in inventory'}), http_status.FORBIDDEN
-    
-    product_quantity.quantity -= 1
+        if not stock.reserve(product.id, user_id=current_user.id):
+            return False
 
-    db.session.flush()
+        curr_invoice = CurrentInvoice.query.filter_by(user_id=current_user.id).first()
 
-    curr_invoice = CurrentInvoice.query.filter_by(id=current_user.id).first()
+        if curr_invoice is None:
+            curr_invoice = CurrentInvoice(user_id=current_user.id)
+            db.session.add(curr_invoice)
+            db.session.flush()
 
-    if curr_invoice is None:
-        curr_invoice = CurrentInvoice(user_id=current_user.id)
-        db.session.add(curr_invoice)
-    
-    db.session.flush()
+        cart.add_line(curr_invoice.id, product.id)
 
-    invoice_product = CurrentInvoice_Product(currentinvoice_id=curr_invoice.id,\
-                                            product_id=product.id)
-    
-    db.session.add(invoice_product)
-    db.session.commit()
+        db.session.commit()
+
+        return True
+
+    try:
+        reserved = stock.with_retries(scan)
+    except stock.StockBusyError:
+        return jsonify({'message': 'the inventory is busy, try again'}), http_status.SERVICEUNAVAILABLE
+
+    if not reserved:
+
+        db.session.rollback()
+
+        if Product_Quantity.query.filter_by(product_id=product.id).first() is None:
+            return jsonify({'message': 'product quantity not found'}), http_status.NOTFOUND
+
+        return jsonify({'message': 'not enough products in inventory'}), http_status.FORBIDDEN
 
     return jsonify({'message' : 'product added to your invoice'})
 
@@ -299,23 +491,22 @@ def add_to_invoice(current_user, product_id):
 @token_required
 def get_current_invoice(current_user):
     """
-    Get all the products included in the current invoice (by the current_user).
+    Get all the products included in the current invoice (by the current_user),
+    with the quantity scanned of each one.
     """
     currentInv = CurrentInvoice.query.filter_by(user_id=current_user.id).first()
 
     if currentInv is None:
         return jsonify({'message': 'no current invoice associated to {}'.format(current_user.username)}), http_status.NOTFOUND
 
-    currentInvProducts = CurrentInvoice_Product.query.filter_by(currentinvoice_id=currentInv.id).all()
-
     products = []
-    for inv in currentInvProducts:
-        product = Product.query.filter_by(id=inv.product_id).first()
+    for name, weight, unit, price, quantity in cart.lines(currentInv.id):
         product_data = {}
-        product_data['name'] = product.name
-        product_data['weight'] = product.weight
-        product_data['unit'] = product.unit
-        product_data['price'] = product.price
+        product_data['name'] = name
+        product_data['weight'] = weight
+        product_data['unit'] = unit
+        product_data['price'] = price
+        product_data['quantity'] = quantity
         products.append(product_data)
 
     return jsonify({'cashier' : current_user.username, 'list_of_products' : products})
@@ -327,51 +518,31 @@ def confirm_purchase(current_user):
     """
     Confirm a purchase with the current invoice associated
     to the current user, the product info will be stored in
-    Invoice_Product as well as the quantity.
+    Invoice_Product as well as the quantity, the invoice
+    keeps its total and item count and the daily sales
+    rollups are updated in the same transaction.
+    The cart is moved with set based statements, so the
+    cost doesn't depend on the number of products.
     """
 
-    invoice = Invoice(user_id=current_user.id)
-    db.session.add(invoice)
     currentInv = CurrentInvoice.query.filter_by(user_id=current_user.id).first()
 
     if currentInv is None:
         return jsonify({'message': 'no current invoice associated to {}'.format(current_user.username)}), http_status.NOTFOUND
-    
-    currentInvProducts = CurrentInvoice_Product.query.filter_by(currentinvoice_id=currentInv.id).all()
-
-    db.session.delete(currentInv)
-
-    allProducts = {}
-    for inv in currentInvProducts:
-        product = Product.query.filter_by(id=inv.product_id).first()
-
-        if product.name not in allProducts:
-            allProducts[product.name] = \
-                {
-                "name": product.name,
-                "weight": product.weight,
-                "price": product.price,
-                "unit": product.unit,
-                "quantity": 1,
-                "invoice_id": invoice.id
-                }
-        else:
-            allProducts[product.name]["quantity"] += 1
-        
-        db.session.delete(inv)
-
-    for products in allProducts.values():
-        invProduct  = Invoice_Product(
-            name = products["name"],
-            weight = products["weight"],
-            price = products["price"],
-            unit = products["unit"],
-            quantity = products["quantity"],
-            invoice_id = products["invoice_id"]
-            )
-        db.session.add(invProduct)
+
+    sales = cart.sales(currentInv.id)
+    total, item_count = cart.totals(sales)
+
+    invoice = Invoice(user_id=current_user.id, total=total, item_count=item_count)
+    db.session.add(invoice)
+    db.session.flush()
+
+    cart.checkout(currentInv.id, invoice.id, current_user.id)
+
+    rollups.record_sales(invoice.date.date(), sales)
 
     db.session.commit()
+    reports.report_cache().purchase_confirmed()
 
     return jsonify({'message' : 'invoice confirmed'})
 
@@ -383,44 +554,146 @@ def sales_report(current_user):
     The report includes the date interval, the products,
     each product quantity, total price given the quantity
     and the total profits for all invoices over the date range.
+
+    The totals are aggregated by the database, an optional
+    "group_by" key ('product', 'day' or 'cashier') selects the
+    dimension, by default the report is grouped by product.
+    "compact": true gives the rows as columns. The rows of a
+    range are cached, see reports.ReportCache.
     """
 
     if not current_user.admin:
         return jsonify({'message': 'admin required for this action'}), http_status.UNAUTHORIZED
 
     data = request.get_json()
-    initial_date = data["from"]
-    final_date = data["to"]
+    initial_date = parse_date(data["from"])
+    final_date = parse_date(data["to"])
 
-    invoices = Invoice.query.filter(Invoice.date.between(initial_date, final_date)).all()
+    if initial_date is None or final_date is None:
+        return jsonify({'message': 'invalid date range, dates must be YYYY-MM-DD'}), http_status.FORBIDDEN
 
-    if invoices is None or invoices is Empty:
-        return jsonify({'message': 'could not find a table entry from \
-            Invoice with dates [{}, {}]'.format(initial_date, final_date)}), http_status.NOTFOUND
+    group_by = data.get("group_by", reports.DEFAULT_GROUP_BY)
 
-    report = {}
-    report["date"] = {"from": initial_date, "to": final_date}
-    report['total_profits'] = 0
-    report['products'] = {}
+    if not isinstance(group_by, str) or group_by not in reports.GROUP_BY:
+        return jsonify({'message': 'invalid value for group_by, must be {}'.format(', '.join(reports.GROUP_BY))}), http_status.FORBIDDEN
 
-    for inv in invoices:
-        products = Invoice_Product.query.filter_by(invoice_id=inv.id).all()
+    report = reports.build_report(initial_date, final_date, group_by, compact=data.get("compact") is True)
 
-        if products is None:
-            return jsonify({'message': 'could not find a table entry from \
-                Invoice_Product with invoice_id = {}'.format(inv.id)}), http_status.NOTFOUND
+    return jsonify({'report' : report})
 
-        for product in products:
 
-            if product.name not in report['products']:
-                report['products'][product.name] = {}
-                report['products'][product.name]['quantity'] = product.quantity
-                report['products'][product.name]['total_price'] = (int(product.quantity) * int(product.price))
-            else:
-                report['products'][product.name]['quantity'] += product.quantity
-                report['products'][product.name]['total_price'] += (int(product.quantity) * int(product.price))
-            report['total_profits'] += report['products'][product.name]['total_price'] 
-        
+@main.route('/export', methods=['GET'])
+@token_required
+def export_line_items(current_user):
+    """
+    Export the line items of the invoices within a date interval
+    ('?from=YYYY-MM-DD&to=YYYY-MM-DD') as CSV or NDJSON ('?format=').
+    The response is streamed while the rows are fetched in batches.
+    Must be an admin.
+    """
 
-    return jsonify({'report' : report})
+    if not current_user.admin:
+        return jsonify({'message': 'admin required for this action'}), http_status.UNAUTHORIZED
+
+    initial_date = parse_date(request.args.get('from', ''))
+    final_date = parse_date(request.args.get('to', ''))
+
+    if initial_date is None or final_date is None:
+        return jsonify({'message': 'invalid date range, dates must be YYYY-MM-DD'}), http_status.FORBIDDEN
+
+    file_format = request.args.get('format', 'csv')
+
+    if file_format not in exports.FORMATS:
+        return jsonify({'message': 'invalid format, must be {}'.format(' or '.join(exports.FORMATS))}), http_status.FORBIDDEN
+
+    chunks = exports.export_chunks(file_format, initial_date, final_date)
+    filename = 'invoices-{}-{}.{}'.format(initial_date.isoformat(), final_date.isoformat(), file_format)
+
+    return Response(stream_with_context(chunks),
+                    mimetype=exports.FORMATS[file_format],
+                    headers={'Content-Disposition': 'attachment; filename={}'.format(filename)})
+
+
+@main.route('/invoices', methods=['GET'])
+@token_required
+def get_invoices(current_user):
+    """
+    Get the past invoices with their products, newest first.
+    '?from=YYYY-MM-DD&to=YYYY-MM-DD' and '?cashier_id=' filter them,
+    '?limit=' is the page size and '?cursor=' the next_cursor of the
+    previous page (null on the last page). Cashiers only get their
+    own invoices, admins get all of them.
+    """
+
+    arguments, message = invoices.page_arguments(request.args)
+
+    if arguments is None:
+        return jsonify({'message': message}), http_status.FORBIDDEN
+
+    filters, cursor, limit = arguments
+
+    if not current_user.admin:
+        filters['cashier_id'] = current_user.id
+
+    page, next_cursor = invoices.invoices_page(filters, cursor, limit)
+
+    return jsonify({'invoices': page, 'next_cursor': next_cursor})
+
+
+@main.route('/invoices/<int:invoice_id>', methods=['GET'])
+@token_required
+def get_invoice(current_user, invoice_id):
+    """
+    Get a past invoice with its products, e.g. to reprint the
+    receipt. Cashiers only get their own invoices.
+    """
+
+    invoice = invoices.get_invoice(invoice_id, None if current_user.admin else current_user.id)
+
+    if invoice is None:
+        return jsonify({'message': 'invoice {} not found'.format(invoice_id)}), http_status.NOTFOUND
+
+    return jsonify({'invoice': invoice})
+
+
+@main.route('/catalog/cache', methods=['GET'])
+@token_required
+def product_cache_stats(current_user):
+    """
+    Get the hit/miss counters and the size of the product cache,
+    to tune PRODUCT_CACHE_SIZE. Must be an admin.
+    """
+
+    if not current_user.admin:
+        return jsonify({'message': 'admin required for this action'}), http_status.UNAUTHORIZED
+
+    catalog.product_cache().sync()
+
+    return jsonify({'product_cache': catalog.product_cache().stats()})
+
+
+@main.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Request latency, SQL statements and database time per
+    endpoint in the Prometheus text format, for the scraper.
+    """
+
+    return Response(metrics.metrics().render(), mimetype='text/plain; version=0.0.4')
+
+
+@main.route('/profile/token', methods=['GET'])
+@token_required
+def profile_token(current_user):
+    """
+    Get a signed token to profile requests, sent as the x-profile
+    header it writes the profile of the request to PROFILE_DIR.
+    It expires after PROFILE_TOKEN_MAX_AGE seconds. Must be an admin.
+    """
+
+    if not current_user.admin:
+        return jsonify({'message': 'admin required for this action'}), http_status.UNAUTHORIZED
 
+    return jsonify({'header': profiling.HEADER,
+                    'token': profiling.issue_token(),
+                    'expires_in': current_app.config['PROFILE_TOKEN_MAX_AGE']})
@@ -0,0 +1,81 @@
+"""
+JSON provider of the app. orjson serializes the large /products,
+/invoice and /report payloads several times faster than the json
+module of the stdlib, it is used when it is installed unless
+JSON_PROVIDER says otherwise ("auto", "orjson" or "stdlib").
+
+The output is the same JSON as the default provider gives: sorted
+keys, dates as HTTP dates and indented in debug mode, only the
+non-ASCII characters are written as UTF-8 instead of escaped.
+"""
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+PROVIDERS = ["auto", "orjson", "stdlib"]
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    DefaultJSONProvider on orjson, the calls with extra json.dumps
+    or json.loads arguments are left to the stdlib.
+    """
+
+    def options(self, indent=False):
+
+        # Dates go through self.default like in the default provider.
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+
+        return option
+
+    def dumps(self, obj, **kwargs):
+
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+
+        return orjson.dumps(obj, default=self.default, option=self.options()).decode()
+
+    def loads(self, s, **kwargs):
+
+        if kwargs:
+            return super().loads(s, **kwargs)
+
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = self.compact is False or (self.compact is None and self._app.debug)
+        data = orjson.dumps(obj, default=self.default, option=self.options(indent))
+
+        return self._app.response_class(data + b"\n", mimetype=self.mimetype)
+
+
+def provider_class(name):
+    """
+    Return the provider class for a JSON_PROVIDER value, raise
+    ValueError if it is invalid or orjson is not installed.
+    """
+
+    if name not in PROVIDERS:
+        raise ValueError("invalid JSON_PROVIDER, must be {}".format(", ".join(PROVIDERS)))
+
+    if name == "orjson" and orjson is None:
+        raise ValueError("JSON_PROVIDER is orjson but orjson is not installed")
+
+    if name == "stdlib" or orjson is None:
+        return DefaultJSONProvider
+
+    return OrjsonProvider
+
+
+def init_app(app):
+    app.json = provider_class(app.config["JSON_PROVIDER"])(app)
@@ -0,0 +1,330 @@
+"""
+Stock of the products as an append-only ledger: every restock,
+reservation (a scan), sale (a confirmed purchase) and release is a
+Stock_Movement row, and the available quantity of a product is its
+Product_Quantity snapshot plus the movements not compacted yet.
+
+A reservation is a conditional INSERT ... SELECT, it only adds the
+movement when the snapshot plus the tail covers it, so concurrent
+cashiers can't sell more products than available. The other
+movements are plain inserts, nothing updates a hot counter row. The
+compactor folds the tail into the snapshots in the background.
+"""
+import click
+import random
+import threading
+import time
+from datetime import datetime
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import literal, select
+from sqlalchemy.exc import OperationalError
+from .models import db, CurrentInvoice_Product, Product_Quantity, Stock_Movement
+
+# Messages of the errors raised when the database is busy with
+# another writer, the transaction can be retried from scratch.
+BUSY_ERRORS = ["database is locked", "database is busy", "deadlock detected", "could not serialize access"]
+
+# Sign of the stock change of each kind of movement, the products
+# of a sale were already taken by their reservation.
+KINDS = {
+    "restock": 1,
+    "reserve": -1,
+    "sale": 0,
+    "release": 1,
+}
+
+MOVEMENT_COLUMNS = ["product_id", "kind", "quantity", "delta", "user_id", "invoice_id", "date", "compacted"]
+
+# First key of the PostgreSQL advisory locks taken by reservations.
+RESERVE_LOCK = 1
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+class StockBusyError(Exception):
+    """
+    The transaction kept failing because of concurrent writers.
+    """
+
+
+def tail_delta(product_id):
+    """
+    Sum of the movements of a product that are not compacted yet,
+    product_id is usually a column so the sum is correlated.
+    """
+
+    return select(db.func.coalesce(db.func.sum(Stock_Movement.delta), 0))\
+        .where(Stock_Movement.product_id == product_id)\
+        .where(Stock_Movement.compacted == False)\
+        .scalar_subquery()
+
+
+def available_quantity():
+    """
+    Available stock of the product of a Product_Quantity row.
+    """
+
+    return Product_Quantity.quantity + tail_delta(Product_Quantity.product_id)
+
+
+def available(product_id):
+    """
+    Return the available stock of a product, None if it has no
+    Product_Quantity row.
+    """
+
+    return db.session.execute(select(available_quantity())
+                              .where(Product_Quantity.product_id == product_id)).scalar()
+
+
+def movement(kind, product_id, quantity, user_id=None, invoice_id=None):
+    return {"product_id": product_id, "kind": kind, "quantity": quantity, "delta": KINDS[kind] * quantity,
+            "user_id": user_id, "invoice_id": invoice_id, "date": datetime.utcnow(), "compacted": False}
+
+
+def record(movements):
+    """
+    Append the movements with one executemany INSERT, the caller
+    owns the transaction.
+    """
+
+    if movements:
+        db.session.execute(Stock_Movement.__table__.insert(), movements)
+
+
+def restock(increments, user_id=None):
+    """
+    Record the {product_id: quantity} increments as restocks.
+    """
+
+    record([movement("restock", product_id, quantity, user_id) for product_id, quantity in increments.items()])
+
+
+def reserve_statements(product_id, quantity=1, user_id=None, dialect=None):
+    """
+    INSERT INTO stock_movement ... SELECT ... WHERE snapshot + tail >= n,
+    it only adds the reservation if there are enough products.
+
+    On PostgreSQL the reservations of a product first take an advisory
+    lock for the transaction, the INSERT (a new statement, so a new
+    snapshot under READ COMMITTED) then sees every committed
+    reservation. SQLite runs one writer at a time.
+    """
+
+    if dialect is None:
+        dialect = db.engine.dialect.name
+
+    values = movement("reserve", product_id, quantity, user_id)
+    rows = select(Product_Quantity.product_id,
+                  *[literal(values[column], Stock_Movement.__table__.c[column].type)
+                    for column in MOVEMENT_COLUMNS[1:]])\
+        .where(Product_Quantity.product_id == product_id)\
+        .where(available_quantity() >= quantity)
+
+    statements = [Stock_Movement.__table__.insert().from_select(MOVEMENT_COLUMNS, rows)]
+
+    if dialect == "postgresql":
+        statements.insert(0, select(db.func.pg_advisory_xact_lock(RESERVE_LOCK, product_id)))
+
+    return statements
+
+
+def reserve(product_id, quantity=1, user_id=None):
+    """
+    Reserve the quantity of the product, return False if there are
+    not enough products (or no stock row). The caller owns the
+    transaction.
+    """
+
+    for stmt in reserve_statements(product_id, quantity, user_id):
+        result = db.session.execute(stmt)
+
+    return result.rowcount == 1
+
+
+def sale_statement(currentinvoice_id, invoice_id, user_id=None):
+    """
+    INSERT ... SELECT recording the lines of a cart as the sales
+    of an invoice, must run before the cart lines are deleted.
+    """
+
+    lines = select(CurrentInvoice_Product.product_id,
+                   literal("sale"),
+                   CurrentInvoice_Product.quantity,
+                   literal(0),
+                   literal(user_id, db.Integer),
+                   literal(invoice_id, db.Integer),
+                   literal(datetime.utcnow(), db.DateTime),
+                   literal(False, db.Boolean))\
+        .where(CurrentInvoice_Product.currentinvoice_id == currentinvoice_id)
+
+    return Stock_Movement.__table__.insert().from_select(MOVEMENT_COLUMNS, lines)
+
+
+def close(product_id):
+    """
+    Flag the tail of a deleted product as compacted, it is never
+    summed again nor folded into a snapshot. The movements stay
+    as its history, the caller owns the transaction.
+    """
+
+    db.session.execute(Stock_Movement.__table__.update()
+                       .where(Stock_Movement.product_id == product_id, Stock_Movement.compacted == False)
+                       .values(compacted=True))
+
+
+def movements_page(product_id, after_id=0, limit=DEFAULT_PAGE_SIZE):
+    """
+    Return the movements of a product after the given id, oldest
+    first, read from ix_stock_movement_product_id.
+    """
+
+    return Stock_Movement.query\
+        .filter(Stock_Movement.product_id == product_id, Stock_Movement.id > after_id)\
+        .order_by(Stock_Movement.id)\
+        .limit(limit)\
+        .all()
+
+
+def compact_statements():
+    """
+    The UPDATE adding the tail of every product to its snapshot and
+    the UPDATE flagging the tail as compacted.
+    """
+
+    table = Product_Quantity.__table__
+    tail = Stock_Movement.compacted == False
+
+    return [table.update()
+            .where(table.c.product_id.in_(select(Stock_Movement.product_id).where(tail)))
+            .values(quantity=table.c.quantity + tail_delta(table.c.product_id)),
+            Stock_Movement.__table__.update().where(tail).values(compacted=True)]
+
+
+def compact():
+    """
+    Fold the movements that are not compacted yet into the
+    snapshots, return the number of movements folded.
+
+    Both statements must see the same movements: on PostgreSQL the
+    transaction runs in REPEATABLE READ, so a movement committed
+    in between is left for the next run, SQLite runs one writer at
+    a time. The readers see the snapshot and the tail before or
+    after the commit, never a mix.
+    """
+
+    if db.engine.dialect.name == "postgresql":
+        db.session.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+
+    snapshots, tail = compact_statements()
+
+    db.session.execute(snapshots)
+    folded = db.session.execute(tail).rowcount
+    db.session.commit()
+
+    return folded
+
+
+def is_busy(error):
+    message = str(error.orig).lower()
+    return any(busy in message for busy in BUSY_ERRORS)
+
+
+def backoff_delay(backoff, attempt):
+    return backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+def with_retries(work):
+    """
+    Run work(), a function that runs and commits a transaction, again
+    when the database reports it is busy. Waits an exponential backoff
+    with jitter between the STOCK_RETRY_ATTEMPTS attempts, then raises
+    StockBusyError.
+    """
+
+    attempts = current_app.config["STOCK_RETRY_ATTEMPTS"]
+    backoff = current_app.config["STOCK_RETRY_BACKOFF"]
+
+    for attempt in range(attempts):
+
+        try:
+            return work()
+        except OperationalError as error:
+            db.session.rollback()
+            if not is_busy(error):
+                raise
+
+        if attempt < attempts - 1:
+            time.sleep(backoff_delay(backoff, attempt))
+
+    raise StockBusyError("stock is busy after {} attempts".format(attempts))
+
+
+class Compactor:
+    """
+    Daemon thread running compact() every interval seconds in every
+    process serving the app: it is started by the first request of
+    the process (or right after the fork of a gunicorn worker, see
+    src.after_fork). A concurrent run in another process only makes
+    one of them retry.
+    """
+
+    def __init__(self, app, interval):
+        self.app = app
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the thread unless it already runs in this process,
+        a thread started before a fork doesn't run in the child.
+        """
+
+        if self.interval <= 0 or (self.thread is not None and self.thread.is_alive()):
+            return
+
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.stopped = threading.Event()
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def stop(self):
+
+        self.stopped.set()
+
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+
+        while not self.stopped.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    with_retries(compact)
+                except Exception:
+                    self.app.logger.exception("stock compaction failed")
+                finally:
+                    db.session.remove()
+
+
+def init_app(app):
+
+    compactor = Compactor(app, app.config["STOCK_COMPACT_INTERVAL"])
+    app.extensions["stock_compactor"] = compactor
+    app.before_request(compactor.start)
+
+
+@click.command("compact-stock")
+@with_appcontext
+def compact_stock_command():
+    """
+    Fold the stock movements into the product quantity snapshots.
+    """
+
+    folded = with_retries(compact)
+    click.echo("Compacted {} stock movements.".format(folded))
@@ -4,3 +4,57 @@ def is_float(n):
         return True
     except ValueError:
         return False
+
+def is_integer(value):
+    """
+    Whether value is a string of ASCII digits, str.isnumeric also
+    accepts characters like '²' or '½' that int() rejects.
+    """
+
+    return isinstance(value, str) and value.isascii() and value.isdecimal()
+
+def columns(names, rows):
+    """
+    Return a list of row tuples as a {name: [values]} dict of
+    columns, the compact shape of the list responses.
+    """
+
+    return {name: [row[index] for row in rows] for index, name in enumerate(names)}
+
+def validate_product(data):
+    """
+    Validate the name, price, weight and unit of a new product.
+    Returns a (product, message) tuple, product is a dict with the
+    parsed values, or None and message says why it's invalid.
+    """
+
+    for key in ['name', 'price', 'weight', 'unit']:
+        if not isinstance(data.get(key), (str, int, float)):
+            return None, 'missing value for {}'.format(key)
+
+    _name = str(data['name'])
+    if len(_name) < 3 or len(_name) > 100 or len(_name) == 0 or not _name.replace(' ', '').isalpha():
+        return None, 'invalid name for product'
+
+    if not is_integer(str(data['price'])):
+        return None, 'invalid value for price, must be an integer'
+
+    _price = int(data['price'])
+
+    if _price <= 0 or _price > 10**6:
+        return None, 'invalid value for price, 0 < price <= 1000000'
+
+    if not is_float(str(data['weight'])):
+        return None, 'invalid value for weight, must be a float'
+
+    _weight = float(data['weight'])
+
+    if _weight <= 0 or _weight >= 1000:
+        return None, 'invalid value for weight, 0 < weight < 1000'
+
+    _unit = str(data['unit'])
+
+    if not _unit.isalpha() or _unit not in ['mg', 'g', 'kg']:
+        return None, 'invalid value for unit, must be mg, g or kg'
+
+    return {'name': _name, 'price': _price, 'weight': _weight, 'unit': _unit}, None
@@ -4,10 +4,34 @@ They depend on each other, so they aren't strictly unit tests.
 This was configured like that because of compatibility problems
 of mocking data in pytest @ the current versions.
 """
-from src.models import Users, Product, Product_Quantity, CurrentInvoice, CurrentInvoice_Product
+from src.models import Users, Product, Product_Quantity, Invoice, Invoice_Product, CurrentInvoice, CurrentInvoice_Product, Daily_Sales, Stock_Movement, Refresh_Token
+from src import create_app, bootstrap_database, after_fork, db, catalog, migrations
 from os import environ
 from dotenv import load_dotenv
 import src.utils
+import src.imports
+import src.stock
+import src.exports
+import src.asgi
+import src.compression
+import src.profiling
+import src.reports
+import src.routes
+import src.serialization
+import flask.json.provider
+import decimal
+import uuid
+import pstats
+import asyncio
+import gzip
+import pytest
+import datetime
+import json
+import re
+import sqlite3
+import threading
+import time
+import sqlalchemy
 
 load_dotenv()
 
@@ -26,6 +50,17 @@ DEFAULT_PRODUCT = {"name": "Rice",
                    "weight": "2.5",
                    "unit": "kg"}
 
+# Schema of the tables before the migrations existed, without indexes.
+BASELINE_SCHEMA = [
+    "CREATE TABLE users (id INTEGER PRIMARY KEY, public_id INTEGER, username VARCHAR(50), password VARCHAR(50), admin BOOLEAN)",
+    "CREATE TABLE product (id INTEGER PRIMARY KEY, name VARCHAR(100) NOT NULL UNIQUE, price INTEGER NOT NULL, weight FLOAT NOT NULL, unit VARCHAR(3) NOT NULL)",
+    "CREATE TABLE product_quantity (id INTEGER PRIMARY KEY, quantity INTEGER, product_id INTEGER REFERENCES product (id))",
+    "CREATE TABLE invoice (id INTEGER PRIMARY KEY, user_id INTEGER REFERENCES users (id), date DATETIME)",
+    "CREATE TABLE invoice_product (id INTEGER PRIMARY KEY, name VARCHAR(50) NOT NULL, weight VARCHAR(20) NOT NULL, price VARCHAR(50) NOT NULL, unit VARCHAR(3) NOT NULL, quantity INTEGER, invoice_id INTEGER REFERENCES invoice (id))",
+    "CREATE TABLE currentinvoice (id INTEGER PRIMARY KEY, user_id INTEGER REFERENCES users (id))",
+    "CREATE TABLE currentinvoice_product (id INTEGER PRIMARY KEY, currentinvoice_id INTEGER REFERENCES currentinvoice (id), product_id INTEGER REFERENCES product (id))",
+]
+
 # HELPER FUNCTIONS
 def register(client, is_admin=False):
 
@@ -119,6 +154,67 @@ def add_to_invoice(client, token):
 
     return response
 
+def confirm_purchase(client, token):
+
+    headers = {"Content-Type": "application/json",
+               "x-access-tokens": token}
+
+    response = client.get("/confirm", headers=headers)
+
+    return response
+
+def sales_report(client, token, group_by=None):
+
+    headers = {"Content-Type": "application/json",
+               "x-access-tokens": token}
+
+    today = datetime.datetime.utcnow().date().isoformat()
+    data = {"from": today,
+            "to": today}
+
+    if group_by is not None:
+        data["group_by"] = group_by
+
+    response = client.post("/report", json=data, headers=headers)
+
+    return response
+
+def create_baseline_app(tmp_path, *statements):
+
+    path = tmp_path / "baseline.db"
+
+    with sqlite3.connect(path) as connection:
+        for statement in BASELINE_SCHEMA + list(statements):
+            connection.execute(statement)
+
+    return create_app("sqlite:///{}".format(path))
+
+def assert_query_budget(app, endpoint, budget, send, method="GET"):
+    """
+    Send a request with send() and check the SQL statements it ran,
+    counted by the /metrics instrumentation, are within the budget.
+    """
+
+    statements = app.extensions["metrics"].statements
+    before = statements.sum((endpoint, method))
+    response = send()
+    spent = statements.sum((endpoint, method)) - before
+
+    assert spent <= budget, "{} {} ran {} SQL statements, the budget is {}".format(method, endpoint, spent, budget)
+
+    return response
+
+def query_plan(query):
+    """
+    Return the EXPLAIN QUERY PLAN details of an ORM query.
+    """
+
+    compiled = query.statement.compile(db.engine)
+    parameters = tuple(compiled.params[name] for name in compiled.positiontup)
+    rows = db.session.connection().exec_driver_sql("EXPLAIN QUERY PLAN " + str(compiled), parameters)
+
+    return " ".join(row[-1] for row in rows)
+
 # TESTS
 
 def test_init(client):
@@ -229,7 +325,7 @@ def test_add_product_quantity(client, app):
 
     with app.app_context():
         assert Product_Quantity.query.count() == 1
-        assert Product_Quantity.query.first().quantity == N
+        assert src.stock.available(1) == N
 
 def test_view_products_and_delete(client, app):
 
@@ -260,6 +356,24 @@ def test_view_products_and_delete(client, app):
 
     with app.app_context():
         assert Product.query.count() == 0
+        assert Product_Quantity.query.count() == 0
+
+    client.post("/product/create", json=dict(DEFAULT_PRODUCT, name="Corn"), headers={"x-access-tokens": token_admin})
+
+    assert [product["name"] for product in get_products(client, token).json["list_of_products"]] == ["Corn"]
+
+
+def test_migrations_drop_orphan_quantities(tmp_path):
+
+    # Product 1 was deleted and its id reused by the product of row 3,
+    # the stock of the new product went to the first row.
+    app = create_baseline_app(tmp_path,
+        "INSERT INTO product (id, name, price, weight, unit) VALUES (1, 'Corn', 100, 1, 'kg')",
+        "INSERT INTO product_quantity (id, quantity, product_id) VALUES (1, 7, 1), (2, 3, 2), (3, 0, 1)")
+
+    with app.app_context():
+        assert db.session.query(Product_Quantity.id, Product_Quantity.product_id).all() == [(1, 1)]
+        assert src.stock.available(1) == 7
 
 
 def test_add_to_invoice(client, app):
@@ -284,6 +398,1313 @@ def test_add_to_invoice(client, app):
         assert response.status_code == 200
 
     with app.app_context():
-        assert Product_Quantity.query.first().quantity == (N-M)
-        assert CurrentInvoice_Product.query.count() == M
+        assert src.stock.available(1) == (N-M)
+        assert CurrentInvoice_Product.query.count() == 1
+        assert CurrentInvoice_Product.query.first().quantity == M
         assert CurrentInvoice.query.count() == 1
+
+    response = client.get("/invoice", headers={"x-access-tokens": token})
+
+    assert response.json["list_of_products"] == [{"name": DEFAULT_PRODUCT["name"],
+                                                  "weight": float(DEFAULT_PRODUCT["weight"]),
+                                                  "unit": DEFAULT_PRODUCT["unit"],
+                                                  "price": int(DEFAULT_PRODUCT["price"]),
+                                                  "quantity": M}]
+
+    response = confirm_purchase(client, token)
+
+    assert response.status_code == 200
+
+    with app.app_context():
+        assert CurrentInvoice_Product.query.count() == 0
+        assert CurrentInvoice.query.count() == 0
+        assert Invoice_Product.query.one().quantity == M
+        assert Invoice_Product.query.one().price == int(DEFAULT_PRODUCT["price"])
+        assert Invoice.query.one().total == M * int(DEFAULT_PRODUCT["price"])
+        assert Invoice.query.one().item_count == M
+
+    response = confirm_purchase(client, token)
+
+    assert response.status_code == 404
+
+
+def test_sales_report(client, app):
+
+    N = 5
+    M = 3
+
+    register(client, is_admin=True)
+    token_admin = get_token(client, is_admin=True)
+    create_product(client, token_admin)
+
+    for _ in range(N):
+        add_product(client, token_admin)
+
+    for _ in range(M):
+        add_to_invoice(client, token_admin)
+
+    response = confirm_purchase(client, token_admin)
+
+    assert response.status_code == 200
+
+    response = sales_report(client, token_admin)
+
+    assert response.status_code == 200
+
+    report = response.json["report"]
+    total = M * int(DEFAULT_PRODUCT["price"])
+
+    assert report["total_profits"] == total
+    assert report["products"][DEFAULT_PRODUCT["name"]]["quantity"] == M
+    assert report["products"][DEFAULT_PRODUCT["name"]]["total_price"] == total
+
+    response = sales_report(client, token_admin, group_by="day")
+    days = response.json["report"]["days"]
+
+    assert list(days.values()) == [{"quantity": M, "total_price": total}]
+
+    response = sales_report(client, token_admin, group_by="cashier")
+    cashiers = response.json["report"]["cashiers"]
+
+    assert cashiers == {"1": {"quantity": M, "total_price": total}}
+
+    response = sales_report(client, token_admin, group_by="weekday")
+
+    assert response.status_code == 403
+
+    for group_by in [[], {}]:
+        response = sales_report(client, token_admin, group_by=group_by)
+
+        assert response.status_code == 403
+
+
+def test_daily_sales_rollup(client, app):
+
+    N = 5
+    M = 3
+
+    register(client, is_admin=True)
+    token_admin = get_token(client, is_admin=True)
+    create_product(client, token_admin)
+
+    for _ in range(N):
+        add_product(client, token_admin)
+
+    for _ in range(M):
+        add_to_invoice(client, token_admin)
+
+    confirm_purchase(client, token_admin)
+
+    total = M * int(DEFAULT_PRODUCT["price"])
+
+    with app.app_context():
+        rollup = Daily_Sales.query.one()
+        assert rollup.name == DEFAULT_PRODUCT["name"]
+        assert rollup.day == datetime.datetime.utcnow().date()
+        assert rollup.quantity == M
+        assert rollup.revenue == total
+
+        Daily_Sales.query.delete()
+        db.session.commit()
+
+    response = sales_report(client, token_admin)
+
+    assert response.json["report"]["products"] == {}
+
+    result = app.test_cli_runner().invoke(args=["rebuild-rollups"])
+
+    assert result.exit_code == 0
+    assert "Rebuilt 1 " in result.output
+
+    response = sales_report(client, token_admin)
+
+    assert response.json["report"]["total_profits"] == total
+    assert response.json["report"]["products"][DEFAULT_PRODUCT["name"]]["quantity"] == M
+
+
+def test_products_pagination_and_etag(client, app):
+
+    register(client, is_admin=True)
+    token_admin = get_token(client, is_admin=True)
+    create_product(client, token_admin)
+
+    headers = {"Content-Type": "application/json",
+               "x-access-tokens": token_admin}
+
+    for name in ["Beans", "Sugar"]:
+        data = dict(DEFAULT_PRODUCT, name=name)
+        client.post("/product/create", json=data, headers=headers)
+
+    response = client.get("/products?limit=2&fields=id,name", headers=headers)
+
+    assert response.status_code == 200
+    assert response.json["list_of_products"] == [{"id": 1, "name": "Rice"}, {"id": 2, "name": "Beans"}]
+    assert response.json["next_after_id"] == 2
+
+    response = client.get("/products?limit=2&after_id=2", headers=headers)
+
+    assert response.json["list_of_products"][0]["name"] == "Sugar"
+    assert response.json["list_of_products"][0]["quantity"] == 0
+    assert response.json["next_after_id"] is None
+
+    response = client.get("/products?fields=id,barcode", headers=headers)
+
+    assert response.status_code == 403
+
+    for arguments in ["limit=²", "after_id=½"]:
+        assert client.get("/products?" + arguments, headers=headers).status_code == 403
+
+    assert client.post("/product/create", json=dict(DEFAULT_PRODUCT, name="Corn", price="²"), headers=headers).status_code == 403
+
+    response = get_products(client, token_admin)
+    etag = response.headers["ETag"]
+
+    response = client.get("/products", headers=dict(headers, **{"If-None-Match": etag}))
+
+    assert response.status_code == 304
+
+    add_product(client, token_admin)
+
+    response = client.get("/products", headers=dict(headers, **{"If-None-Match": etag}))
+
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.json["list_of_products"][0]["quantity"] == 1
+
+
+def test_products_etag_across_processes(tmp_path):
+
+    uri = "sqlite:///{}".format(tmp_path / "workers.db")
+    first = create_app(uri).test_client()
+    second = create_app(uri).test_client()
+
+    register(first, is_admin=True)
+    token_admin = get_token(first, is_admin=True)
+    create_product(first, token_admin)
+
+    headers = {"x-access-tokens": token_admin}
+    etag = first.get("/products", headers=headers).headers["ETag"]
+
+    # Every change served by the other process gives a new ETag.
+    changes = [lambda: add_product(second, token_admin),
+               lambda: add_to_invoice(second, token_admin),
+               lambda: second.post("/product/create", json=dict(DEFAULT_PRODUCT, name="Beans"), headers=headers)]
+
+    for change in changes:
+
+        assert change().status_code == 200
+
+        response = first.get("/products", headers=dict(headers, **{"If-None-Match": etag}))
+
+        assert response.status_code == 200
+        assert response.json == second.get("/products", headers=headers).json
+
+        etag = response.headers["ETag"]
+
+    assert response.json["list_of_products"][0]["quantity"] == 0
+    assert first.get("/products", headers=dict(headers, **{"If-None-Match": etag})).status_code == 304
+
+    # Both processes give the same ETag, the nonce belongs to the database.
+    assert second.get("/products", headers=dict(headers, **{"If-None-Match": etag})).status_code == 304
+
+
+def test_product_cache(client, app):
+
+    M = 3
+
+    register(client, is_admin=True)
+    token_admin = get_token(client, is_admin=True)
+    create_product(client, token_admin)
+
+    for _ in range(M):
+        add_product(client, token_admin)
+        add_to_invoice(client, token_admin)
+
+    headers = {"x-access-tokens": token_admin}
+    stats = client.get("/catalog/cache", headers=headers).json["product_cache"]
+
+    assert stats["misses"] == 1
+    assert stats["hits"] == 2 * M - 1
+    assert stats["version"] == 1
+
+    # Another worker renames the product, the shared version tells this one.
+    with app.app_context():
+        Product.query.first().name = "Brown Rice"
+        catalog.bump_shared_version()
+        db.session.commit()
+
+    app.extensions["product_cache"].synced_at = None
+
+    response = client.get("/invoice", headers=headers)
+
+    assert response.json["list_of_products"][0]["name"] == "Brown Rice"
+
+    stats = client.get("/catalog/cache", headers=headers).json["product_cache"]
+
+    assert stats["version"] == 2
+
+    register(client)
+    token = get_token(client)
+    response = client.get("/catalog/cache", headers={"x-access-tokens": token})
+
+    assert response.status_code == 401
+
+
+def test_authenticated_user_cache(client, app):
+
+    register(client, is_admin=True)
+    token_admin = get_token(client, is_admin=True)
+    headers = {"x-access-tokens": token_admin}
+
+    statements = []
+
+    def count_statements(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        sqlalchemy.event.listen(db.engine, "before_cursor_execute", count_statements)
+
+    client.get("/authorize", headers=headers)
+    client.get("/authorize", headers=headers)
+
+    assert len([s for s in statements if "FROM users" in s]) == 1
+    assert app.extensions["auth_cache"].stats()["hits"] == 1
+
+    with app.app_context():
+        Users.query.first().admin = False
+        db.session.commit()
+
+    response = client.get("/catalog/cache", headers=headers)
+
+    assert response.status_code == 401
+
+    with app.app_context():
+        db.session.delete(Users.query.first())
+        db.session.commit()
+
+    response = client.get("/authorize", headers=headers)
+
+    assert response.status_code == 401
+
+
+def test_migrations_upgrade_existing_database(tmp_path):
+
+    app = create_baseline_app(tmp_path)
+
+    with app.app_context():
+        indexes = sqlalchemy.inspect(db.engine).get_indexes("invoice_product")
+
+        assert [index["name"] for index in indexes] == ["ix_invoice_product_invoice_id"]
+
+        columns = sqlalchemy.inspect(db.engine).get_columns("currentinvoice_product")
+
+        assert "quantity" in [column["name"] for column in columns]
+        assert migrations.current_version() == migrations.MIGRATIONS[-1].version
+        assert migrations.upgrade() == []
+
+
+def test_migrations_merge_current_invoice_lines(tmp_path):
+
+    app = create_baseline_app(tmp_path,
+        "INSERT INTO currentinvoice_product (currentinvoice_id, product_id) VALUES (1, 1), (1, 2), (1, 1), (2, 1)")
+
+    with app.app_context():
+        lines = db.session.query(CurrentInvoice_Product.currentinvoice_id,
+                                 CurrentInvoice_Product.product_id,
+                                 CurrentInvoice_Product.quantity).order_by(CurrentInvoice_Product.id).all()
+
+        assert lines == [(1, 1, 2), (1, 2, 1), (2, 1, 1)]
+
+
+def test_migrations_type_invoice_prices(tmp_path):
+
+    app = create_baseline_app(tmp_path,
+        "INSERT INTO invoice (id, user_id, date) VALUES (1, 1, '2023-05-01 10:00:00.000000'), (2, 1, '2023-05-01 11:00:00.000000')",
+        "INSERT INTO invoice_product (name, weight, price, unit, quantity, invoice_id) VALUES"
+        " ('Rice', '2.5', '21500', 'kg', 2, 1), ('Beans', '1', '3000', 'kg', 1, 1)")
+
+    with app.app_context():
+        lines = db.session.query(Invoice_Product.name, Invoice_Product.weight, Invoice_Product.price)\
+            .order_by(Invoice_Product.id).all()
+
+        assert lines == [("Rice", 2.5, 21500), ("Beans", 1.0, 3000)]
+        assert db.session.query(Invoice.id, Invoice.total, Invoice.item_count).order_by(Invoice.id).all() == [(1, 46000, 3), (2, 0, 0)]
+
+        stored = db.session.connection().exec_driver_sql("SELECT DISTINCT typeof(weight), typeof(price) FROM invoice_product").all()
+
+        assert stored == [("real", "integer")]
+        assert "ix_invoice_product_invoice_id" in [index["name"] for index in sqlalchemy.inspect(db.engine).get_indexes("invoice_product")]
+
+
+def test_hot_queries_use_indexes(tmp_path):
+
+    app = create_baseline_app(tmp_path)
+    today = datetime.datetime.utcnow()
+
+    with app.app_context():
+        hot_queries = {
+            "ix_users_username": Users.query.filter_by(username=DEFAULT_USERNAME),
+            "ix_users_public_id": Users.query.filter_by(public_id="public-id"),
+            "ix_product_quantity_product_id": Product_Quantity.query.filter_by(product_id=1),
+            "ix_stock_movement_tail": db.session.query(db.func.sum(Stock_Movement.delta))
+                                                .filter(Stock_Movement.product_id == 1, Stock_Movement.compacted == False),
+            "ix_stock_movement_product_id": Stock_Movement.query.filter(Stock_Movement.product_id == 1, Stock_Movement.id > 0)
+                                                              .order_by(Stock_Movement.id),
+            "ix_invoice_date": Invoice.query.filter(Invoice.date >= today, Invoice.date < today),
+            "ix_invoice_user_id_date": Invoice.query.filter(Invoice.user_id == 1, Invoice.date < today)
+                                                    .order_by(Invoice.date.desc(), Invoice.id.desc()),
+            "ix_invoice_product_invoice_id": Invoice_Product.query.filter_by(invoice_id=1),
+            "ix_currentinvoice_user_id": CurrentInvoice.query.filter_by(user_id=1),
+            "(ix_currentinvoice_product_currentinvoice_id|uq_currentinvoice_product)": CurrentInvoice_Product.query.filter_by(currentinvoice_id=1),
+            "ix_currentinvoice_product_product_id": CurrentInvoice_Product.query.filter_by(product_id=1),
+        }
+
+        for index, query in hot_queries.items():
+            assert re.search("USING (COVERING )?INDEX {} ".format(index), query_plan(query))
+
+
+def test_restock_products(client, app):
+
+    register(client, is_admin=True)
+    token_admin = get_token(client, is_admin=True)
+    create_product(client, token_admin)
+
+    headers = {"Content-Type": "application/json",
+               "x-access-tokens": token_admin}
+
+    client.post("/product/create", json=dict(DEFAULT_PRODUCT, name="Beans"), headers=headers)
+
+    data = {"items": [{"name": "Rice", "quantity": "5"},
+                      {"id": 2, "quantity": 7},
+                      {"id": "1", "quantity": "2"}]}
+
+    response = client.post("/product/restock", json=data, headers=headers)
+
+    assert response.status_code == 200
+    assert [result["status"] for result in response.json["results"]] == ["ok", "ok", "ok"]
+
+    with app.app_context():
+        assert src.stock.available(1) == 7
+        assert src.stock.available(2) == 7
+
+    data = {"items": [{"name": "Rice", "quantity": "5"},
+                      {"name": "Sugar", "quantity": "1"},
+                      {"id": 2, "quantity": "-1"}]}
+
+    response = client.post("/product/restock", json=data, headers=headers)
+
+    assert response.status_code == 403
+    assert [result["status"] for result in response.json["results"]] == \
+        ["ok", "product does not exist", "invalid value for quantity"]
+
+    data = {"items": [{"id": "²", "quantity": "1"},
+                      {"name": "Rice", "quantity": "½"}]}
+
+    response = client.post("/product/restock", json=data, headers=headers)
+
+    assert response.status_code == 403
+    assert [result["status"] for result in response.json["results"]] == \
+        ["invalid item, must have a name or an id", "invalid value for quantity"]
+    assert client.post("/product/add", json={"name": "Rice", "quantity": "½"}, headers=headers).status_code == 403
+
+    with app.app_context():
+        assert src.stock.available(1) == 7
+
+
+def test_import_products(client, app, monkeypatch):
+
+    monkeypatch.setattr(src.imports, "BATCH_SIZE", 2)
+
+    register(client, is_admin=True)
+    token_admin = get_token(client, is_admin=True)
+    create_product(client, token_admin)
+
+    headers = {"Content-Type": "text/csv",
+               "x-access-tokens": token_admin}
+
+    data = "\n".join(["name,price,weight,unit",
+                      "Beans,3200,1,kg",
+                      "Rice,21500,2.5,kg",
+                      "Sugar,4100,500,g",
+                      "Salt,-1,1,kg",
+                      "Sugar,4100,500,g",
+                      "Coffee,15000,250,g"])
+
+    response = client.post("/product/import", data=data, headers=headers)
+
+    assert response.status_code == 200
+    assert response.json["imported"] == 3
+    assert response.json["rejected"] == 3
+    assert [row["line"] for row in response.json["rejected_rows"]] == [3, 5, 6]
+
+    headers["Content-Type"] = "application/x-ndjson"
+    data = '{"name": "Flour", "price": 2800, "weight": 1, "unit": "kg"}\n[]\n'
+
+    response = client.post("/product/import", data=data, headers=headers)
+
+    assert response.json["imported"] == 1
+    assert response.json["rejected_rows"] == [{"line": 2, "message": "invalid row"}]
+
+    with app.app_context():
+        assert Product.query.count() == 5
+        assert Product_Quantity.query.count() == 5
+        assert Product.query.filter_by(name="Coffee").first().unit == "g"
+
+    headers["Content-Type"] = "text/csv"
+    data = "\ufeffname,price,weight,unit\nTea,9000,100,g\n".encode("utf-8")
+
+    response = client.post("/product/import", data=data, headers=headers)
+
+    assert response.json["imported"] == 1
+    assert response.json["rejected"] == 0
+    assert "error" not in response.json
+
+    data = "name,price,weight,unit\nCheese,1200,1,kg\nCrème,2300,200,g\nButter,5000,250,g\n".encode("latin-1")
+
+    response = client.post("/product/import", data=data, headers=headers)
+
+    assert response.status_code == 200
+    assert response.json["imported"] == 1
+    assert response.json["error"] == {"line": 3, "message": "invalid encoding, must be UTF-8"}
+
+    with app.app_context():
+        assert Product.query.count() == 7
+        assert Product.query.filter_by(name="Butter").first() is None
+
+    response = client.post("/product/import?format=xml", data=data, headers=headers)
+
+    assert response.status_code == 403
+
+
+def test_concurrent_stock_reservation(tmp_path):
+
+    STOCK = 60
+    THREADS = 8
+    SCANS = 10
+
+    app = create_app("sqlite:///{}".format(tmp_path / "stress.db"))
+    client = app.test_client()
+
+    register(client, is_admin=True)
+    token_admin = get_token(client, is_admin=True)
+    create_product(client, token_admin)
+
+    headers = {"x-access-tokens": token_admin}
+    client.post("/product/restock", json={"items": [{"id": 1, "quantity": STOCK}]}, headers=headers)
+
+    tokens = []
+    for thread in range(THREADS):
+        user = ("Cashier{}".format(thread), DEFAULT_PASSWORD)
+        client.post("/register", json={"username": user[0], "password": user[1]})
+        tokens.append(client.post("/login", auth=user).json['token'])
+
+    status_codes = []
+
+    def cashier(token):
+        thread_client = app.test_client()
+        for _ in range(SCANS):
+            status_codes.append(add_to_invoice(thread_client, token).status_code)
+
+    threads = [threading.Thread(target=cashier, args=(token,)) for token in tokens]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    # Every scan is either reserved or refused, never lost or oversold.
+    assert len(status_codes) == THREADS * SCANS
+    assert status_codes.count(200) == STOCK
+    assert status_codes.count(403) == THREADS * SCANS - STOCK
+
+    with app.app_context():
+        assert src.stock.available(1) == 0
+        assert db.session.query(db.func.sum(CurrentInvoice_Product.quantity)).scalar() == STOCK
+
+    assert THREADS * SCANS / elapsed > 20
+
+
+def test_stock_retries_when_busy(app, monkeypatch):
+
+    attempts = []
+    sleeps = []
+
+    def busy():
+        attempts.append(1)
+        raise sqlalchemy.exc.OperationalError("UPDATE", {}, sqlite3.OperationalError("database is locked"))
+
+    monkeypatch.setattr(src.stock.time, "sleep", sleeps.append)
+
+    with app.app_context():
+        with pytest.raises(src.stock.StockBusyError):
+            src.stock.with_retries(busy)
+
+    # No wait after the last attempt.
+    assert len(attempts) == app.config["STOCK_RETRY_ATTEMPTS"]
+    assert len(sleeps) == app.config["STOCK_RETRY_ATTEMPTS"] - 1
+
+
+def test_sqlite_profile(tmp_path, monkeypatch):
+
+    def pragmas(app):
+        with app.app_context():
+            connection = db.session.connection()
+            return [connection.exec_driver_sql("PRAGMA {}".format(pragma)).scalar()
+                    for pragma in ["journal_mode", "synchronous", "busy_timeout"]]
+
+    app = create_app("sqlite:///{}".format(tmp_path / "production.db"))
+
+    assert pragmas(app) == ["wal", 1, 5000]
+
+    monkeypatch.setenv("SQLITE_SYNCHRONOUS", "full")
+    app = create_app("sqlite:///{}".format(tmp_path / "production.db"))
+
+    assert pragmas(app) == ["wal", 2, 5000]
+
+    monkeypatch.setenv("SQLITE_PROFILE", "default")
+    monkeypatch.delenv("SQLITE_SYNCHRONOUS")
+    app = create_app("sqlite:///{}".format(tmp_path / "default.db"))
+
+    assert pragmas(app) == ["delete", 2, 5000]
+
+    monkeypatch.setenv("SQLITE_TEMP_STORE", "RAM")
+
+    with pytest.raises(ValueError):
+        create_app("sqlite://")
+
+
+def test_refresh_token(client, app):
+
+    register(client)
+    response = login(client)
+    refresh_token = response.json["refresh_token"]
+
+    response = client.post("/token/refresh", json={"refresh_token": refresh_token})
+
+    assert response.status_code == 200
+
+    response = client.get("/authorize", headers={"x-access-tokens": response.json["token"]})
+
+    assert response.json["username"] == DEFAULT_USERNAME
+
+    response = client.post("/token/refresh", json={"refresh_token": "not-a-token"})
+
+    assert response.status_code == 401
+
+    response = client.post("/token/revoke", json={"refresh_token": refresh_token})
+
+    assert response.status_code == 200
+
+    response = client.post("/token/refresh", json={"refresh_token": refresh_token})
+
+    assert response.status_code == 401
+
+    app.config["REFRESH_TOKEN_DAYS"] = -1
+    refresh_token = login(client).json["refresh_token"]
+    response = client.post("/token/refresh", json={"refresh_token": refresh_token})
+
+    assert response.status_code == 401
+
+    # Logins delete the revoked and expired tokens of the user.
+    app.config["REFRESH_TOKEN_DAYS"] = 30
+    login(client)
+
+    with app.app_context():
+        assert Refresh_Token.query.count() == 1
+
+
+def test_password_hash_method(client, app):
+
+    app.config["PASSWORD_HASH_METHOD"] = "pbkdf2:sha256:1000"
+    register(client)
+
+    with app.app_context():
+        assert Users.query.first().password.startswith("pbkdf2:sha256:1000$")
+
+    assert login(client).status_code == 200
+
+
+def test_export_line_items(client, app):
+
+    M = 3
+
+    register(client, is_admin=True)
+    token_admin = get_token(client, is_admin=True)
+    create_product(client, token_admin)
+
+    for _ in range(M):
+        add_product(client, token_admin)
+        add_to_invoice(client, token_admin)
+
+    confirm_purchase(client, token_admin)
+
+    headers = {"x-access-tokens": token_admin}
+    today = datetime.datetime.utcnow().date().isoformat()
+
+    response = client.get("/export?from={0}&to={0}".format(today), headers=headers)
+
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert response.mimetype == "text/csv"
+
+    lines = response.get_data(as_text=True).splitlines()
+
+    assert lines[0] == ",".join(src.exports.COLUMNS)
+    assert lines[1].startswith("1,{}".format(today))
+    assert lines[1].endswith(",Rice,2.5,21500,kg,{}".format(M))
+
+    response = client.get("/export?from={0}&to={0}&format=ndjson".format(today), headers=headers)
+    items = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    assert len(items) == 1
+    assert items[0]["quantity"] == M
+    assert items[0]["cashier"] == 1
+
+    response = client.get("/export?from=2000-01-01&to=2000-01-31&format=ndjson", headers=headers)
+
+    assert response.get_data() == b""
+
+    response = client.get("/export?from={0}&to={0}&format=xlsx".format(today), headers=headers)
+
+    assert response.status_code == 403
+
+
+def test_async_app(tmp_path):
+
+    uri = "sqlite:///{}".format(tmp_path / "async.db")
+
+    app = create_app(uri)
+    client = app.test_client()
+
+    register(client, is_admin=True)
+    token_admin = get_token(client, is_admin=True)
+    create_product(client, token_admin)
+    add_product(client, token_admin)
+
+    headers = {"x-access-tokens": token_admin}
+    async_app = src.asgi.create_async_app(uri)
+
+    async def requests():
+
+        async with async_app.test_app() as test_app:
+            async_client = test_app.test_client()
+
+            response = await async_client.get("/products", headers=headers)
+            etag = response.headers["ETag"]
+            products = (await response.get_json())["list_of_products"]
+
+            assert products[0]["name"] == DEFAULT_PRODUCT["name"]
+
+            response = await async_client.get("/products", headers=dict(headers, **{"If-None-Match": etag}))
+
+            assert response.status_code == 304
+
+            # Same ETags as the sync app, weak ones match too.
+            sync_etag = client.get("/products", headers=headers).headers["ETag"]
+
+            assert sync_etag == etag
+
+            response = await async_client.get("/products?compact=1", headers=dict(headers, **{"If-None-Match": etag}))
+
+            assert response.status_code == 200
+            assert (await response.get_json())["list_of_products"]["name"] == [DEFAULT_PRODUCT["name"]]
+
+            compact_etag = "W/" + response.headers["ETag"]
+
+            assert (await async_client.get("/products?compact=1", headers=dict(headers, **{"If-None-Match": compact_etag}))).status_code == 304
+
+            for _ in range(products[0]["quantity"]):
+                response = await async_client.get("/add/1", headers=headers)
+                assert response.status_code == 200
+
+            assert (await async_client.get("/add/1", headers=headers)).status_code == 403
+            assert (await async_client.get("/add/2", headers=headers)).status_code == 404
+            assert (await async_client.get("/products", headers=dict(headers, **{"If-None-Match": etag}))).status_code == 200
+            # The reservations of the async app change the ETag of the sync one.
+            assert client.get("/products", headers=dict(headers, **{"If-None-Match": sync_etag})).status_code == 200
+
+            invoice = await (await async_client.get("/invoice", headers=headers)).get_json()
+
+            assert invoice["list_of_products"][0]["quantity"] == products[0]["quantity"]
+
+            assert (await async_client.get("/confirm", headers=headers)).status_code == 200
+            assert (await async_client.get("/confirm", headers=headers)).status_code == 404
+            assert (await async_client.get("/invoice")).status_code == 401
+
+        return products[0]
+
+    product = asyncio.run(requests())
+
+    # The sync app reads what the async app wrote.
+    report = sales_report(client, token_admin).json["report"]
+
+    assert report["products"][product["name"]]["quantity"] == product["quantity"]
+    assert report["total_profits"] == product["quantity"] * product["price"]
+
+    with pytest.raises(ValueError):
+        src.asgi.create_async_app("sqlite://")
+
+
+def test_bootstrap_once_and_after_fork(tmp_path):
+
+    uri = "sqlite:///{}".format(tmp_path / "workers.db")
+
+    # A worker app doesn't touch the schema.
+    worker = create_app(uri, bootstrap=False)
+
+    with worker.app_context():
+        assert not sqlalchemy.inspect(db.engine).has_table(Users.__tablename__)
+
+    bootstrap_database(create_app(uri, bootstrap=False))
+
+    with worker.app_context():
+        assert migrations.current_version() == len(migrations.MIGRATIONS)
+        engine = db.engine
+        etag = catalog.products_etag()
+
+    after_fork(worker)
+
+    with worker.app_context():
+        assert db.engine is engine
+        assert engine.pool.checkedin() == 0
+        assert catalog.products_etag() == etag
+
+
+def test_read_rows_from_wsgi_input():
+
+    class Body:
+        """
+        WSGI input with readline() only, like the one of gunicorn.
+        """
+
+        def __init__(self, data):
+            self.lines = data.splitlines(keepends=True)
+
+        def readline(self):
+            return self.lines.pop(0) if self.lines else b""
+
+    rows = list(src.imports.read_rows(Body(b"name,price,weight,unit\nRice,100,1,kg\n"), "csv"))
+
+    assert rows == [(2, {"name": "Rice", "price": "100", "weight": "1", "unit": "kg"})]
+
+    rows = list(src.imports.read_rows(Body('{"name": "Caf\u00e9"}\nnot json\n'.encode()), "ndjson"))
+
+    assert rows == [(1, {"name": "Caf\u00e9"}), (2, None)]
+
+
+# SQL statements allowed per request, whatever the number of products.
+QUERY_BUDGETS = {
+    "/products": 2,
+    "/add/<product_id>": 5,
+    "/invoice": 2,
+    "/confirm": 8,
+    "/invoices": 2,
+    # The sales and the rollup version (read at most every REPORT_CACHE_OPEN_TTL).
+    "/report": 2,
+}
+
+# On PostgreSQL a reservation first takes its advisory lock (stock.RESERVE_LOCK).
+POSTGRESQL_EXTRA_STATEMENTS = {
+    "/add/<product_id>": 1,
+}
+
+
+def test_query_budgets(client, app):
+
+    N = 5
+
+    register(client, is_admin=True)
+    token_admin = get_token(client, is_admin=True)
+    headers = {"x-access-tokens": token_admin}
+
+    products = [{"name": "Product {}".format(name), "price": 100, "weight": 1, "unit": "kg"} for name in "abcde"[:N]]
+    client.post("/product/import", data="".join(json.dumps(product) + "\n" for product in products),
+                headers=dict(headers, **{"Content-Type": "application/x-ndjson"}))
+    client.post("/product/restock", json={"items": [{"id": id, "quantity": 10} for id in range(1, N + 1)]},
+                headers=headers)
+
+    today = datetime.datetime.utcnow().date().isoformat()
+
+    requests = [("/products", "GET", lambda: client.get("/products", headers=headers))]
+    requests += [("/add/<product_id>", "GET", lambda id=id: client.get("/add/{}".format(id), headers=headers))
+                 for id in range(1, N + 1)]
+    requests += [("/invoice", "GET", lambda: client.get("/invoice", headers=headers)),
+                 ("/confirm", "GET", lambda: client.get("/confirm", headers=headers)),
+                 ("/report", "POST", lambda: client.post("/report", json={"from": today, "to": today}, headers=headers)),
+                 ("/invoices", "GET", lambda: client.get("/invoices", headers=headers))]
+
+    with app.app_context():
+        extra = POSTGRESQL_EXTRA_STATEMENTS if db.engine.dialect.name == "postgresql" else {}
+
+    for endpoint, method, send in requests:
+        budget = QUERY_BUDGETS[endpoint] + extra.get(endpoint, 0)
+        response = assert_query_budget(app, endpoint, budget, send, method)
+        assert response.status_code == 200
+
+    assert sales_report(client, token_admin).json["report"]["total_profits"] == N * 100
+
+    metrics = client.get("/metrics")
+
+    assert metrics.mimetype == "text/plain"
+    assert 'pos_sql_statements_per_request_count{endpoint="/add/<product_id>",method="GET"} 5' in metrics.get_data(as_text=True)
+
+
+def test_profiler(client, app, tmp_path):
+
+    register(client)
+    register(client, is_admin=True)
+    token = get_token(client)
+    token_admin = get_token(client, is_admin=True)
+
+    app.config["PROFILE_DIR"] = str(tmp_path)
+
+    assert client.get("/profile/token", headers={"x-access-tokens": token}).status_code == 401
+
+    response = client.get("/profile/token", headers={"x-access-tokens": token_admin})
+    profile_headers = {"x-access-tokens": token_admin, response.json["header"]: response.json["token"]}
+
+    # Only signed tokens enable the profiler.
+    client.get("/products", headers={"x-access-tokens": token_admin, "x-profile": "forged"})
+    assert list(tmp_path.iterdir()) == []
+
+    app.config["PROFILE_INTERVAL"] = 0.0001
+    client.get("/products", headers=profile_headers)
+    profiles = list(tmp_path.glob("*-GET-products-*.folded"))
+
+    assert len(profiles) == 1
+    for line in profiles[0].read_text().splitlines():
+        stack, count = line.rsplit(" ", 1)
+        assert int(count) > 0
+
+    app.config["PROFILE_MODE"] = "cprofile"
+    client.get("/invoice", headers=profile_headers)
+    profiles = list(tmp_path.glob("*-GET-invoice-*.prof"))
+
+    assert len(profiles) == 1
+    functions = {function for _, _, function in pstats.Stats(str(profiles[0])).stats}
+    assert "authenticate" in functions
+
+    # PROFILE_SAMPLE_RATE profiles requests without the header.
+    app.config["PROFILE_SAMPLE_RATE"] = 1
+    client.get("/authorize", headers={"x-access-tokens": token})
+
+    assert len(list(tmp_path.glob("*-GET-authorize-*.prof"))) == 1
+
+    with pytest.raises(ValueError):
+        app.config["PROFILE_MODE"] = "perf"
+        src.profiling.init_app(app, src.routes.main)
+
+
+def test_json_provider(client, app, monkeypatch):
+
+    payload = {"date": datetime.datetime(2023, 5, 1, 12, 30), "day": datetime.date(2023, 5, 1),
+               "price": decimal.Decimal("21500.5"), "id": uuid.UUID(int=1), "name": "Caf\u00e9",
+               "lines": {2: "b", 1: "a"}, "empty": None}
+
+    stdlib = flask.json.provider.DefaultJSONProvider(app)
+
+    if src.serialization.orjson is not None:
+        assert isinstance(app.json, src.serialization.OrjsonProvider)
+
+    with app.app_context():
+        assert json.loads(app.json.response(payload).get_data()) == json.loads(stdlib.response(payload).get_data())
+        assert app.json.loads(app.json.dumps(payload)) == stdlib.loads(stdlib.dumps(payload))
+        assert app.json.dumps(payload, indent=4) == stdlib.dumps(payload, indent=4)
+
+    # Invalid bodies are still a bad request.
+    response = client.post("/register", data="{", headers={"Content-Type": "application/json"})
+
+    assert response.status_code == 400
+
+    with pytest.raises(ValueError):
+        src.serialization.provider_class("ujson")
+
+    monkeypatch.setattr(src.serialization, "orjson", None)
+
+    assert src.serialization.provider_class("auto") is flask.json.provider.DefaultJSONProvider
+
+    with pytest.raises(ValueError):
+        src.serialization.provider_class("orjson")
+
+
+def test_compression_and_compact_mode(client, app):
+
+    M = 3
+
+    register(client, is_admin=True)
+    token_admin = get_token(client, is_admin=True)
+    create_product(client, token_admin)
+
+    headers = {"Content-Type": "application/json",
+               "x-access-tokens": token_admin}
+
+    for number in range(40):
+        data = dict(DEFAULT_PRODUCT, name="Product" + "".join("abcdefghij"[int(digit)] for digit in str(number)))
+        client.post("/product/create", json=data, headers=headers)
+
+    plain = client.get("/products", headers=headers)
+
+    assert "Content-Encoding" not in plain.headers
+    assert plain.headers["Vary"] == "Accept-Encoding"
+
+    response = client.get("/products", headers=dict(headers, **{"Accept-Encoding": "gzip"}))
+
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.content_length < plain.content_length
+    assert json.loads(gzip.decompress(response.data)) == plain.json
+
+    # The compressed representation has a weak ETag, it still validates.
+    etag = response.headers["ETag"]
+
+    assert etag == "W/" + plain.headers["ETag"]
+
+    response = client.get("/products", headers=dict(headers, **{"Accept-Encoding": "gzip", "If-None-Match": etag}))
+
+    assert response.status_code == 304
+
+    if src.compression.brotli is not None:
+        response = client.get("/products", headers=dict(headers, **{"Accept-Encoding": "gzip, br"}))
+
+        assert response.headers["Content-Encoding"] == "br"
+        assert json.loads(src.compression.brotli.decompress(response.data)) == plain.json
+
+    # Below the threshold the body is sent as it is.
+    response = client.get("/products?limit=1", headers=dict(headers, **{"Accept-Encoding": "gzip"}))
+
+    assert "Content-Encoding" not in response.headers
+
+    response = client.get("/products?limit=2&fields=id,name&compact=1", headers=headers)
+
+    assert response.json["list_of_products"] == {"id": [1, 2], "name": ["Rice", "Producta"]}
+    assert response.json["next_after_id"] == 2
+    assert response.headers["ETag"] != plain.headers["ETag"]
+
+    compact = client.get("/products?compact=1", headers=headers)
+
+    assert compact.content_length < plain.content_length
+
+    for _ in range(M):
+        add_product(client, token_admin)
+        add_to_invoice(client, token_admin)
+
+    confirm_purchase(client, token_admin)
+
+    today = datetime.datetime.utcnow().date().isoformat()
+    response = client.post("/report", json={"from": today, "to": today, "compact": True}, headers=headers)
+    total = M * int(DEFAULT_PRODUCT["price"])
+
+    assert response.json["report"]["products"] == {"key": [DEFAULT_PRODUCT["name"]], "quantity": [M], "total_price": [total]}
+    assert response.json["report"]["total_profits"] == total
+
+
+def test_invoice_history(client, app):
+
+    M = 3
+
+    register(client, is_admin=True)
+    token_admin = get_token(client, is_admin=True)
+    register(client)
+    token_user = get_token(client)
+    create_product(client, token_admin)
+
+    for token in [token_admin, token_user, token_admin]:
+        for _ in range(M):
+            add_product(client, token_admin)
+            add_to_invoice(client, token)
+        confirm_purchase(client, token)
+
+    headers = {"x-access-tokens": token_admin}
+    line = {"name": DEFAULT_PRODUCT["name"], "weight": 2.5, "price": int(DEFAULT_PRODUCT["price"]),
+            "unit": DEFAULT_PRODUCT["unit"], "quantity": M}
+
+    response = client.get("/invoices?limit=2", headers=headers)
+
+    assert response.status_code == 200
+    assert [invoice["id"] for invoice in response.json["invoices"]] == [3, 2]
+    assert response.json["invoices"][0]["cashier_id"] == 1
+    assert response.json["invoices"][0]["total"] == M * int(DEFAULT_PRODUCT["price"])
+    assert response.json["invoices"][0]["item_count"] == M
+    assert response.json["invoices"][0]["list_of_products"] == [line]
+
+    cursor = response.json["next_cursor"]
+    response = client.get("/invoices", query_string={"limit": 2, "cursor": cursor}, headers=headers)
+
+    assert [invoice["id"] for invoice in response.json["invoices"]] == [1]
+    assert response.json["next_cursor"] is None
+
+    today = datetime.datetime.utcnow().date()
+    tomorrow = (today + datetime.timedelta(days=1)).isoformat()
+
+    response = client.get("/invoices", query_string={"cashier_id": 2, "from": today.isoformat()}, headers=headers)
+
+    assert [invoice["id"] for invoice in response.json["invoices"]] == [2]
+    assert client.get("/invoices?from=" + tomorrow, headers=headers).json["invoices"] == []
+
+    for query in ["limit=0", "cursor=abc", "from=yesterday", "cashier_id=me", "limit=²", "cashier_id=½"]:
+        assert client.get("/invoices?" + query, headers=headers).status_code == 403
+
+    # Cashiers only see their own invoices.
+    headers_user = {"x-access-tokens": token_user}
+    response = client.get("/invoices?cashier_id=1", headers=headers_user)
+
+    assert [invoice["id"] for invoice in response.json["invoices"]] == [2]
+
+    response = client.get("/invoices/2", headers=headers_user)
+
+    assert response.status_code == 200
+    assert response.json["invoice"]["list_of_products"] == [line]
+    assert client.get("/invoices/1", headers=headers_user).status_code == 404
+    assert client.get("/invoices/1", headers=headers).json["invoice"]["id"] == 1
+    assert client.get("/invoices/9", headers=headers).status_code == 404
+
+
+def test_report_cache(client, app, tmp_path):
+
+    M = 3
+
+    register(client, is_admin=True)
+    token_admin = get_token(client, is_admin=True)
+    create_product(client, token_admin)
+
+    headers = {"x-access-tokens": token_admin}
+    yesterday = (datetime.datetime.utcnow() - datetime.timedelta(days=1)).date()
+    past = {"from": yesterday.isoformat(), "to": yesterday.isoformat()}
+
+    with app.app_context():
+        db.session.add(Daily_Sales(day=yesterday, name="Beans", quantity=2, revenue=6000))
+        db.session.commit()
+
+    response = client.post("/report", json=past, headers=headers)
+
+    assert response.json["report"]["products"] == {"Beans": {"quantity": 2, "total_price": 6000}}
+
+    # Days before today are answered from the cache.
+    response = assert_query_budget(app, "/report", 0, lambda: client.post("/report", json=dict(past, compact=True), headers=headers), "POST")
+
+    assert response.json["report"]["products"] == {"key": ["Beans"], "quantity": [2], "total_price": [6000]}
+
+    # Ranges with today are dropped when a purchase is confirmed.
+    assert sales_report(client, token_admin).json["report"]["total_profits"] == 0
+
+    for _ in range(M):
+        add_product(client, token_admin)
+        add_to_invoice(client, token_admin)
+    confirm_purchase(client, token_admin)
+
+    assert sales_report(client, token_admin).json["report"]["total_profits"] == M * int(DEFAULT_PRODUCT["price"])
+
+    result = app.test_cli_runner().invoke(args=["rebuild-rollups"])
+
+    assert result.exit_code == 0
+    assert client.post("/report", json=past, headers=headers).json["report"]["products"] == {}
+
+    # Closed ranges survive restarts in the cache file.
+    path = str(tmp_path / "reports.json")
+    cache = src.reports.ReportCache(2, 5, path)
+    rows = [("Beans", 2, 6000)]
+
+    cache.set(("2023-05-01", "2023-05-01", "product"), rows, closed=True)
+    cache.set((yesterday.isoformat(), "2999-01-01", "product"), rows, closed=False)
+
+    cache = src.reports.ReportCache(2, 5, path)
+
+    assert cache.get(("2023-05-01", "2023-05-01", "product")) == [["Beans", 2, 6000]]
+    assert cache.get((yesterday.isoformat(), "2999-01-01", "product")) is None
+
+    cache.clear()
+
+    assert not (tmp_path / "reports.json").exists()
+
+    # A day is only closed once the purchases confirmed around its midnight are committed.
+    cache = src.reports.ReportCache(2, 5, path, close_delay=2 * 24 * 3600)
+
+    assert cache.closed(yesterday - datetime.timedelta(days=2))
+    assert not cache.closed(yesterday)
+
+
+def test_report_cache_after_rebuild_in_another_process(tmp_path, monkeypatch):
+
+    monkeypatch.setenv("REPORT_CACHE_FILE", str(tmp_path / "reports.json"))
+
+    uri = "sqlite:///{}".format(tmp_path / "reports.db")
+    worker = create_app(uri)
+    client = worker.test_client()
+
+    register(client, is_admin=True)
+    token_admin = get_token(client, is_admin=True)
+    headers = {"x-access-tokens": token_admin}
+
+    yesterday = (datetime.datetime.utcnow() - datetime.timedelta(days=2)).date()
+    past = {"from": yesterday.isoformat(), "to": yesterday.isoformat()}
+
+    with worker.app_context():
+        db.session.add(Daily_Sales(day=yesterday, name="Beans", quantity=2, revenue=6000))
+        db.session.commit()
+
+    assert client.post("/report", json=past, headers=headers).json["report"]["total_profits"] == 6000
+
+    # The rollups have no invoice behind them, the rebuild drops them.
+    result = create_app(uri).test_cli_runner().invoke(args=["rebuild-rollups"])
+
+    assert result.exit_code == 0
+
+    worker.extensions["report_cache"].synced_at = None
+
+    assert client.post("/report", json=past, headers=headers).json["report"]["total_profits"] == 0
+
+    # The file only has the ranges of the new version.
+    restarted = create_app(uri)
+
+    assert restarted.extensions["report_cache"].version == 1
+    assert restarted.test_client().post("/report", json=past, headers=headers).json["report"]["total_profits"] == 0
+
+
+def test_stock_ledger(client, app):
+
+    N = 5
+    M = 3
+
+    register(client, is_admin=True)
+    token_admin = get_token(client, is_admin=True)
+    create_product(client, token_admin)
+
+    for _ in range(N):
+        add_product(client, token_admin)
+
+    for _ in range(M):
+        add_to_invoice(client, token_admin)
+
+    confirm_purchase(client, token_admin)
+
+    headers = {"x-access-tokens": token_admin}
+    response = client.get("/products/1/movements", headers=headers)
+
+    assert response.status_code == 200
+    assert response.json["available"] == N - M
+    assert [(movement["kind"], movement["delta"]) for movement in response.json["movements"]] == \
+        [("restock", 1)] * N + [("reserve", -1)] * M + [("sale", 0)]
+    assert response.json["movements"][-1]["quantity"] == M
+    assert response.json["movements"][-1]["invoice_id"] == 1
+
+    response = client.get("/products/1/movements?after_id=2&limit=2", headers=headers)
+
+    assert [movement["id"] for movement in response.json["movements"]] == [3, 4]
+    assert response.json["next_after_id"] == 4
+    assert client.get("/products/1/movements?limit=0", headers=headers).status_code == 403
+    assert client.get("/products/1/movements?limit=²", headers=headers).status_code == 403
+
+    result = app.test_cli_runner().invoke(args=["compact-stock"])
+
+    assert result.exit_code == 0
+    assert "Compacted {} ".format(N + M + 1) in result.output
+
+    with app.app_context():
+        db.session.add(Stock_Movement(**src.stock.movement("release", 1, 2)))
+        db.session.commit()
+
+        assert Product_Quantity.query.first().quantity == N - M
+        assert src.stock.available(1) == N - M + 2
+        assert Stock_Movement.query.count() == N + M + 2
+
+    assert get_products(client, token_admin).json["list_of_products"][0]["quantity"] == N - M + 2
+
+
+def test_delete_product_keeps_its_ledger(client, app):
+
+    register(client, is_admin=True)
+    token_admin = get_token(client, is_admin=True)
+    headers = {"x-access-tokens": token_admin}
+
+    for name in ["Rice", "Beans"]:
+        client.post("/product/create", json=dict(DEFAULT_PRODUCT, name=name), headers=headers)
+
+    client.post("/product/restock", json={"items": [{"id": 2, "quantity": 9}]}, headers=headers)
+
+    assert client.delete("/products/2", headers=headers).status_code == 200
+
+    client.post("/product/create", json=dict(DEFAULT_PRODUCT, name="Corn"), headers=headers)
+    products = get_products(client, token_admin).json["list_of_products"]
+
+    assert [(product["id"], product["name"], product["quantity"]) for product in products] == [(1, "Rice", 0), (3, "Corn", 0)]
+    assert client.get("/products/3/movements", headers=headers).json["movements"] == []
+
+    history = client.get("/products/2/movements", headers=headers).json
+
+    assert [movement["kind"] for movement in history["movements"]] == ["restock"]
+    assert history["available"] is None
+
+    with app.app_context():
+        assert src.stock.compact() == 0
+
+
+def test_migrations_catalog_nonce(tmp_path):
+
+    app = create_baseline_app(tmp_path,
+        "CREATE TABLE catalog_version (id INTEGER PRIMARY KEY, version INTEGER NOT NULL)",
+        "INSERT INTO catalog_version (id, version) VALUES (1, 4)")
+
+    with app.app_context():
+        etag = catalog.products_etag()
+
+        assert re.fullmatch("[0-9a-f]{8}-4-0", etag)
+
+    # Another bootstrap of the same database keeps the nonce.
+    bootstrap_database(app)
+
+    with app.app_context():
+        assert catalog.products_etag() == etag
+
+
+def test_migrations_autoincrement_product_ids(tmp_path):
+
+    # Product 2 was deleted after a restock.
+    app = create_baseline_app(tmp_path,
+        "INSERT INTO product (id, name, price, weight, unit) VALUES (1, 'Rice', 100, 1, 'kg')",
+        "INSERT INTO product_quantity (quantity, product_id) VALUES (0, 1)",
+        "CREATE TABLE stock_movement (id INTEGER NOT NULL PRIMARY KEY, product_id INTEGER NOT NULL,"
+        " kind VARCHAR(10) NOT NULL, quantity INTEGER NOT NULL, delta INTEGER NOT NULL, user_id INTEGER,"
+        " invoice_id INTEGER, date DATETIME, compacted BOOLEAN NOT NULL)",
+        "INSERT INTO stock_movement (product_id, kind, quantity, delta, compacted) VALUES"
+        " (1, 'restock', 4, 4, 0), (2, 'restock', 9, 9, 0)")
+
+    with app.app_context():
+        db.session.add(Product(name="Corn", price=100, weight=1, unit="kg"))
+        db.session.commit()
+
+        assert Product.query.filter_by(name="Corn").one().id == 3
+        assert db.session.query(Stock_Movement.product_id, Stock_Movement.compacted).all() == [(1, False), (2, True)]
+        assert src.stock.available(1) == 4
+
+
+def test_stock_compactor(tmp_path, monkeypatch):
+
+    N = 5
+
+    monkeypatch.setenv("STOCK_COMPACT_INTERVAL", "0.01")
+
+    app = create_app("sqlite:///{}".format(tmp_path / "ledger.db"))
+    client = app.test_client()
+
+    register(client, is_admin=True)
+    token_admin = get_token(client, is_admin=True)
+    create_product(client, token_admin)
+
+    for _ in range(N):
+        add_product(client, token_admin)
+
+    # Started by the first request, like under flask run.
+    assert app.extensions["stock_compactor"].thread.is_alive()
+
+    with app.app_context():
+        deadline = time.monotonic() + 5
+        while Stock_Movement.query.filter_by(compacted=False).count() and time.monotonic() < deadline:
+            db.session.remove()
+            time.sleep(0.01)
+
+    app.extensions["stock_compactor"].stop()
+
+    with app.app_context():
+        assert Product_Quantity.query.first().quantity == N
+        assert src.stock.available(1) == N